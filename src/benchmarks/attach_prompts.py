@@ -0,0 +1,53 @@
+import argparse
+import time
+from transformers import AutoConfig, AutoModelForSeq2SeqLM
+
+from prompt_tuning import PromptTuningConfig, TaskType, get_prompt_tuning_model
+from prompt_tuning import prompt_tuning
+
+
+def prompt_config(args):
+    return PromptTuningConfig(
+        task_type=TaskType.SEQ_2_SEQ_LM,
+        num_virtual_tokens=args.num_virtual_tokens,
+        fusion=args.fusion,
+    )
+
+
+def attach(base_model, args, cached):
+    start = time.perf_counter()
+    model = get_prompt_tuning_model(base_model, prompt_config(args), adapter_name='prompt_0')
+    for i in range(1, args.num_prompts):
+        if not cached:
+            # resolving the backbone on every attach is what _setup_prompt_encoder used to do
+            prompt_tuning._backbone_cache.clear()
+        model.add_adapter(f'prompt_{i}', prompt_config(args))
+    return model, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Time of attaching many prompts to one base model')
+    parser.add_argument('--model_name_or_path', type=str, default='bigscience/mt0-base')
+    parser.add_argument('--num_prompts', type=int, default=64)
+    parser.add_argument('--num_virtual_tokens', type=int, default=50)
+    parser.add_argument('--fusion', type=str, default='cat')
+    args = parser.parse_args()
+
+    # weights are irrelevant for the benchmark, only the shapes are taken from the config
+    base_model = AutoModelForSeq2SeqLM.from_config(AutoConfig.from_pretrained(args.model_name_or_path))
+
+    results = {}
+    for cached in (False, True):
+        prompt_tuning._backbone_cache.clear()
+        for param in base_model.parameters():
+            param.requires_grad = True
+        model, elapsed = attach(base_model, args, cached)
+        assert len(model.prompt_encoder) == args.num_prompts
+        assert not any(param.requires_grad for param in base_model.parameters())
+        results['cached' if cached else 'uncached'] = elapsed
+
+    print(f"{'prompts':>8} {'uncached s':>11} {'cached s':>9} {'per prompt ms':>14}")
+    print(
+        f"{args.num_prompts:>8} {results['uncached']:>11.3f} {results['cached']:>9.3f} "
+        f"{results['cached'] / args.num_prompts * 1000:>14.3f}"
+    )
@@ -0,0 +1,98 @@
+"""
+Generation time of the test sets of many languages, each with its language adapter stacked under one task adapter,
+run one language after another against all languages in shared `BatchSplit` batches, e.g.
+
+python -m benchmarks.batch_split --languages english german czech slovak \
+    --task_adapter ../results/nli/xnli_en_adapter_100k/xnli --dataset_name xnli --max_predict_samples 100
+"""
+import argparse
+import math
+import time
+import numpy as np
+import adapters
+from adapters import AdapterConfig
+from functools import partial
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+
+from task_modeling.adapter_weights import use_safetensors_weights
+from task_modeling.args import DataTrainingArguments
+from task_modeling.batch_split import BatchSplitGenerator
+from task_modeling.utils import get_path
+from tasks import dataset_factory
+
+
+def load_adapter(model, path, name):
+    path = get_path(path)
+    model.load_adapter(path, config=AdapterConfig.load(f'{path}/adapter_config.json'), load_as=name)
+    return name
+
+
+def get_features(tokenizer, language, args):
+    dataset = dataset_factory(dataset_name=args.dataset_name, language=language)
+    examples = dataset.get_dataset('test')
+    examples = examples.select(range(min(len(examples), args.max_predict_samples)))
+    data_args = DataTrainingArguments(
+        dataset_name=args.dataset_name, max_seq_length=args.max_seq_length, max_answer_length=args.max_answer_length)
+    return examples.map(
+        partial(dataset.preprocess_validation_function, tokenizer=tokenizer,
+                data_args=data_args, max_seq_length=args.max_seq_length),
+        batched=True,
+        remove_columns=dataset.get_columns('test'),
+    )
+
+
+def pad(token_ids, width, pad_token_id):
+    return np.pad(token_ids, ((0, 0), (0, width - token_ids.shape[1])), constant_values=pad_token_id)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Sequential against batch split multi-adapter inference')
+    parser.add_argument('--model_name_or_path', type=str, default='bigscience/mt0-base')
+    parser.add_argument('--languages', nargs='+', type=str, required=True)
+    parser.add_argument('--language_adapter', type=str, default='ivykopal/{language}_adapter_100k',
+                        help='Path of the language adapters, formatted with the language')
+    parser.add_argument('--task_adapter', type=str, required=True)
+    parser.add_argument('--dataset_name', type=str, default='xnli')
+    parser.add_argument('--max_seq_length', type=int, default=256)
+    parser.add_argument('--max_answer_length', type=int, default=10)
+    parser.add_argument('--num_beams', type=int, default=1)
+    parser.add_argument('--per_device_eval_batch_size', type=int, default=32)
+    parser.add_argument('--max_predict_samples', type=int, default=100)
+    args = parser.parse_args()
+    use_safetensors_weights()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    model = AutoModelForSeq2SeqLM.from_pretrained(args.model_name_or_path).eval()
+    adapters.init(model)
+    task_adapter = load_adapter(model, args.task_adapter, 'task_adapter')
+    setups = [
+        (load_adapter(model, args.language_adapter.format(language=language), f'{language}_adapter'), task_adapter)
+        for language in args.languages
+    ]
+    features = [get_features(tokenizer, language, args) for language in args.languages]
+    generator = BatchSplitGenerator(model)
+    gen_kwargs = dict(max_new_tokens=args.max_answer_length, num_beams=args.num_beams)
+
+    start = time.perf_counter()
+    sequential = [
+        generator.predict([dataset], [setup], tokenizer, args.per_device_eval_batch_size, **gen_kwargs)[0]
+        for dataset, setup in zip(features, setups)
+    ]
+    sequential_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    split = generator.predict(features, setups, tokenizer, args.per_device_eval_batch_size, **gen_kwargs)
+    split_s = time.perf_counter() - start
+
+    sequential_batches = sum(math.ceil(len(dataset) / args.per_device_eval_batch_size) for dataset in features)
+    split_batches = math.ceil(sum(len(dataset) for dataset in features) / args.per_device_eval_batch_size)
+    print(f"{'language':<12} {'features':>8} {'same tokens':>12}")
+    for language, dataset, (sequential_tokens, _), (split_tokens, _) in zip(
+            args.languages, features, sequential, split):
+        width = max(sequential_tokens.shape[1], split_tokens.shape[1])
+        same = pad(sequential_tokens, width, tokenizer.pad_token_id) == pad(split_tokens, width, tokenizer.pad_token_id)
+        print(f'{language:<12} {len(dataset):>8} {np.mean(same.all(axis=1)):>12.3f}')
+    print(f"{'mode':<12} {'batches':>8} {'seconds':>8}")
+    print(f"{'sequential':<12} {sequential_batches:>8} {sequential_s:>8.2f}")
+    print(f"{'batch split':<12} {split_batches:>8} {split_s:>8.2f}")
+    print(f'speedup {sequential_s / split_s:.2f}')
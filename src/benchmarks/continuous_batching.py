@@ -0,0 +1,126 @@
+"""
+Throughput and latency of a mixed-task request stream with batches run to their longest answer against continuous
+batching, e.g.
+
+python -m benchmarks.continuous_batching --prompt_bank ../results/prompts.safetensors \
+    --setups english:xnli:prompt:prompt english:wikiann:prompt:prompt german:mlqa:prompt:prompt \
+    --num_requests 500 --max_new_tokens 50
+
+A setup is language:dataset:language_adapter_type:task_adapter_type, the requests are the test inputs of the dataset
+and the stream interleaves the setups in random order. Both modes run the batchers of `serving.server` in this process,
+the requests are submitted at once or at `--request_rate` per second.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+import numpy as np
+
+from serving.batching import ContinuousBatcher, MicroBatcher
+from serving.continuous import ContinuousDecoder
+from serving.model import ServingModel, parse_named_paths
+from task_modeling.adapter_weights import use_safetensors_weights
+from tasks import dataset_factory
+
+
+def get_requests(setups, num_requests, max_samples, seed):
+    requests = []
+    for setup in setups:
+        language, dataset_name, language_adapter_type, task_adapter_type = setup.split(':')
+        dataset = dataset_factory(dataset_name=dataset_name, language=language)
+        examples = dataset.get_dataset('test')
+        examples = examples.select(range(min(len(examples), max_samples)))
+        inputs = dataset.preprocess(examples[:])[0]
+        requests.append([{
+            'inputs': text,
+            'language': language,
+            'task': dataset_name,
+            'language_adapter_type': language_adapter_type,
+            'task_adapter_type': task_adapter_type,
+        } for text in inputs])
+
+    stream = [next(cycle) for cycle in itertools.islice(
+        itertools.cycle([itertools.cycle(setup_requests) for setup_requests in requests]), num_requests)]
+    random.Random(seed).shuffle(stream)
+    return stream
+
+
+async def run_stream(batcher, model, stream, request_rate, seed):
+    rng = random.Random(seed)
+    latencies = [0.0] * len(stream)
+
+    async def submit(i, request):
+        start = time.perf_counter()
+        output = await batcher.submit(model.batch_key(request), request)
+        latencies[i] = time.perf_counter() - start
+        return output
+
+    batcher.start()
+    start = time.perf_counter()
+    tasks = []
+    for i, request in enumerate(stream):
+        tasks.append(asyncio.create_task(submit(i, request)))
+        if request_rate is not None:
+            await asyncio.sleep(rng.expovariate(request_rate))
+    outputs = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    await batcher.stop()
+    return outputs, latencies, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Static against continuous batching of a mixed-task request stream')
+    parser.add_argument('--model_name_or_path', type=str, default='bigscience/mt0-base')
+    parser.add_argument('--prompts', nargs='*', type=str, default=[],
+                        help='Prompts to attach as name=path, e.g. english_prompt=ivykopal/english_prompt_100k')
+    parser.add_argument('--prompt_bank', type=str, default=None)
+    parser.add_argument('--adapters', nargs='*', type=str, default=[],
+                        help='Adapters to attach as name=path, e.g. english_adapter=ivykopal/english_adapter_100k')
+    parser.add_argument('--setups', nargs='+', type=str, required=True,
+                        help='language:dataset:language_adapter_type:task_adapter_type of every task')
+    parser.add_argument('--num_requests', type=int, default=500)
+    parser.add_argument('--max_samples', type=int, default=1000, help='Test inputs per setup')
+    parser.add_argument('--request_rate', type=float, default=None,
+                        help='Poisson arrivals per second, all requests are submitted at once by default')
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_wait_ms', type=float, default=10.0)
+    parser.add_argument('--max_seq_length', type=int, default=256)
+    parser.add_argument('--max_new_tokens', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    use_safetensors_weights()
+
+    model = ServingModel(
+        args.model_name_or_path,
+        prompt_paths=parse_named_paths(args.prompts),
+        prompt_bank=args.prompt_bank,
+        adapter_paths=parse_named_paths(args.adapters),
+        max_seq_length=args.max_seq_length,
+        generation_kwargs={'max_new_tokens': args.max_new_tokens},
+    )
+    stream = get_requests(args.setups, args.num_requests, args.max_samples, args.seed)
+    batchers = {
+        'static': lambda: MicroBatcher(
+            model.run_batch, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms),
+        'continuous': lambda: ContinuousBatcher(
+            ContinuousDecoder(model, max_batch_size=args.max_batch_size, max_new_tokens=args.max_new_tokens),
+            max_wait_ms=args.max_wait_ms),
+    }
+
+    results = {}
+    print(f"{'mode':<12} {'seconds':>8} {'req/s':>8} {'tokens/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'rows':>6}")
+    for mode, get_batcher in batchers.items():
+        batcher = get_batcher()
+        outputs, latencies, elapsed = asyncio.run(
+            run_stream(batcher, model, stream, args.request_rate, args.seed))
+        num_tokens = sum(len(ids) for ids in model.tokenizer(outputs, add_special_tokens=False)['input_ids'])
+        # rows per batch of the static batcher, per decoding step of the continuous one
+        rows = batcher.stats['rows'] / batcher.stats['steps'] if mode == 'continuous' \
+            else batcher.stats['requests'] / batcher.stats['batches']
+        results[mode] = outputs
+        print(f'{mode:<12} {elapsed:>8.2f} {len(stream) / elapsed:>8.2f} {num_tokens / elapsed:>9.1f} '
+              f'{np.percentile(latencies, 50) * 1000:>8.0f} {np.percentile(latencies, 99) * 1000:>8.0f} {rows:>6.1f}')
+
+    same = np.mean([static == continuous for static, continuous in zip(results['static'], results['continuous'])])
+    print(f'same outputs {same:.3f}')
@@ -0,0 +1,82 @@
+"""
+Wall-clock time of predicting a test set padded to `max_seq_length` against length-bucketed batches, e.g.
+
+python -m benchmarks.eval_token_budget --dataset_name xnli --language english --eval_token_budget 8192
+"""
+import argparse
+import time
+import numpy as np
+from functools import partial
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, DataCollatorForSeq2Seq, Seq2SeqTrainingArguments
+
+from task_modeling.args import DataTrainingArguments
+from task_modeling.trainer_seq2seq_qa import QuestionAnsweringSeq2SeqTrainer
+from tasks import dataset_factory
+
+
+def tokenize(dataset, examples, tokenizer, args, pad_to_max_length):
+    data_args = DataTrainingArguments(
+        dataset_name=args.dataset_name,
+        max_seq_length=args.max_seq_length,
+        max_answer_length=args.max_answer_length,
+        pad_to_max_length=pad_to_max_length,
+    )
+    return examples.map(
+        partial(dataset.preprocess_validation_function, tokenizer=tokenizer,
+                data_args=data_args, max_seq_length=args.max_seq_length),
+        batched=True,
+        remove_columns=dataset.get_columns('test'),
+    )
+
+
+def predict(model, tokenizer, features, args, eval_token_budget):
+    trainer = QuestionAnsweringSeq2SeqTrainer(
+        model=model,
+        args=Seq2SeqTrainingArguments(
+            output_dir='../results/benchmarks',
+            per_device_eval_batch_size=args.per_device_eval_batch_size,
+            predict_with_generate=True,
+            report_to=[],
+        ),
+        tokenizer=tokenizer,
+        data_collator=DataCollatorForSeq2Seq(tokenizer, model=model, label_pad_token_id=-100),
+        # predictions are only generated when there are metrics to compute
+        compute_metrics=lambda p: {},
+        eval_token_budget=eval_token_budget,
+    )
+    start = time.perf_counter()
+    output = trainer.predict(features, None, max_new_tokens=args.max_answer_length)
+    elapsed = time.perf_counter() - start
+
+    predictions = np.where(output.predictions != -100, output.predictions, tokenizer.pad_token_id)
+    return tokenizer.batch_decode(predictions, skip_special_tokens=True), elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Prediction time with padded and with token-budgeted batches')
+    parser.add_argument('--model_name_or_path', type=str, default='bigscience/mt0-base')
+    parser.add_argument('--dataset_name', type=str, default='xnli')
+    parser.add_argument('--language', type=str, default='english')
+    parser.add_argument('--max_seq_length', type=int, default=256)
+    parser.add_argument('--max_answer_length', type=int, default=3)
+    parser.add_argument('--per_device_eval_batch_size', type=int, default=32)
+    parser.add_argument('--eval_token_budget', type=int, default=8192)
+    parser.add_argument('--max_predict_samples', type=int, default=1000)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    model = AutoModelForSeq2SeqLM.from_pretrained(args.model_name_or_path).eval()
+    dataset = dataset_factory(dataset_name=args.dataset_name, language=args.language)
+    examples = dataset.get_dataset('test')
+    examples = examples.select(range(min(len(examples), args.max_predict_samples)))
+
+    padded, padded_s = predict(
+        model, tokenizer, tokenize(dataset, examples, tokenizer, args, True), args, None)
+    bucketed_features = tokenize(dataset, examples, tokenizer, args, False)
+    bucketed, bucketed_s = predict(model, tokenizer, bucketed_features, args, args.eval_token_budget)
+
+    lengths = [len(input_ids) for input_ids in bucketed_features['input_ids']]
+    print(f'{args.dataset_name} {args.language}: {len(examples)} examples, mean length {np.mean(lengths):.1f}')
+    print(f"{'padded s':>10} {'bucketed s':>11} {'speedup':>8} {'same predictions':>17}")
+    print(f'{padded_s:>10.2f} {bucketed_s:>11.2f} {padded_s / bucketed_s:>8.2f} '
+          f'{np.mean([a == b for a, b in zip(padded, bucketed)]):>17.3f}')
@@ -0,0 +1,67 @@
+import argparse
+import torch
+
+from benchmarks.prompt_materialization import allocated_bytes, elapsed_ms
+from prompt_tuning import PartialPromptEmbedding, PromptTuningConfig, TaskType
+
+
+class LegacyPartialPromptEmbedding(torch.nn.Module):
+    # PartialPromptEmbedding before the fixed and trainable rows shared one storage
+    def __init__(self, weight, num_fixed):
+        super().__init__()
+        self.num_fixed = num_fixed
+        self.weight = weight.detach().clone()
+        self.trainable_weight = torch.nn.Parameter(weight[num_fixed:].detach().clone())
+
+    def get_weight(self):
+        self.weight.detach_()
+        self.weight[self.num_fixed:] = self.trainable_weight
+        return self.weight
+
+
+def step(prompt_encoder, batch_size, num_virtual_tokens):
+    prompt = prompt_encoder.get_weight()[:num_virtual_tokens].unsqueeze(0).expand(batch_size, -1, -1)
+    if prompt.requires_grad:
+        prompt.sum().backward()
+    return prompt
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Per-step cost of the partial prompt embedding')
+    parser.add_argument('--num_virtual_tokens', type=int, default=50)
+    parser.add_argument('--fixed_size', type=int, default=10)
+    parser.add_argument('--token_dim', type=int, default=768)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--iterations', type=int, default=1000)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    config = PromptTuningConfig(
+        task_type=TaskType.SEQ_2_SEQ_LM,
+        num_virtual_tokens=args.num_virtual_tokens,
+        num_transformer_submodules=2,
+        token_dim=args.token_dim,
+        partial_embedding=True,
+        fixed_size=args.fixed_size,
+    )
+    word_embeddings = torch.nn.Embedding(1, args.token_dim).to(device)
+    prompt_encoder = PartialPromptEmbedding(config, word_embeddings).to(device)
+    legacy = LegacyPartialPromptEmbedding(prompt_encoder.weight, args.fixed_size).to(device)
+    legacy.weight = legacy.weight.to(device)
+
+    step(prompt_encoder, args.batch_size, args.num_virtual_tokens)
+    step(legacy, args.batch_size, args.num_virtual_tokens)
+    assert torch.equal(prompt_encoder.get_weight(), legacy.get_weight())
+    assert torch.equal(prompt_encoder.trainable_weight.grad, legacy.trainable_weight.grad)
+
+    print(f"{'mode':<10} {'legacy ms':>10} {'view ms':>10} {'legacy KiB':>11} {'view KiB':>10}")
+    for mode in ('training', 'inference'):
+        with torch.set_grad_enabled(mode == 'training'):
+            def run_legacy(): return step(legacy, args.batch_size, args.num_virtual_tokens)
+            def run_view(): return step(prompt_encoder, args.batch_size, args.num_virtual_tokens)
+
+            print(
+                f'{mode:<10} '
+                f'{elapsed_ms(run_legacy, args.iterations):>10.4f} {elapsed_ms(run_view, args.iterations):>10.4f} '
+                f'{allocated_bytes(run_legacy) / 2 ** 10:>11.2f} {allocated_bytes(run_view) / 2 ** 10:>10.2f}'
+            )
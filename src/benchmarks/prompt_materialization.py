@@ -0,0 +1,102 @@
+import argparse
+import time
+import torch
+from torch.profiler import profile, ProfilerActivity
+from transformers import AutoConfig, AutoModelForSeq2SeqLM
+
+from prompt_tuning import PromptTuningConfig, TaskType, get_prompt_tuning_model
+
+
+def legacy_get_prompt(model, batch_size):
+    # PeftModel.get_prompt before the prompt was returned as an expanded view
+    prompt_config = model._peft_config[model.adapter_name]
+    prompt_encoder = model.prompt_encoder[model.adapter_name]
+    prompt_tokens = (
+        torch.arange(prompt_config.num_virtual_tokens * prompt_config.num_transformer_submodules)
+        .long()
+        .unsqueeze(0)
+        .expand(batch_size, -1)
+        .to(prompt_encoder.embeddings.weight.device)
+    )
+    if prompt_config.inference_mode:
+        prompts = prompt_encoder.embeddings.weight.repeat(batch_size, 1, 1)
+    else:
+        prompts = prompt_encoder(prompt_tokens)
+    return prompts[:, :model._get_num_virtual_tokens()]
+
+
+def allocated_bytes(fn):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        before = torch.cuda.memory_stats()['allocated_bytes.all.allocated']
+        fn()
+        torch.cuda.synchronize()
+        return torch.cuda.memory_stats()['allocated_bytes.all.allocated'] - before
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return sum(event.self_cpu_memory_usage for event in prof.events() if event.self_cpu_memory_usage > 0)
+
+
+def elapsed_ms(fn, iterations):
+    for _ in range(5):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def check_gradients(model, batch_size):
+    weight = model.prompt_encoder[model.adapter_name].embeddings.weight
+    grads = []
+    for get_prompt in (legacy_get_prompt, lambda m, b: m.get_prompt(b)):
+        weight.grad = None
+        prompts = get_prompt(model, batch_size)
+        (prompts * torch.arange(batch_size, device=prompts.device).view(-1, 1, 1)).sum().backward()
+        grads.append(weight.grad.clone())
+    weight.grad = None
+    assert torch.allclose(grads[0], grads[1]), 'Gradients of the expanded prompt differ from the legacy path'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Per-forward cost of prompt materialization')
+    parser.add_argument('--model_name_or_path', type=str, default='bigscience/mt0-base')
+    parser.add_argument('--num_virtual_tokens', type=int, default=50)
+    parser.add_argument('--fusion', type=str, default='none')
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[32, 64, 128, 256])
+    parser.add_argument('--iterations', type=int, default=100)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    # weights are irrelevant for the benchmark, only the shapes are taken from the config
+    base_model = AutoModelForSeq2SeqLM.from_config(
+        AutoConfig.from_pretrained(args.model_name_or_path)).to(device)
+    peft_config = PromptTuningConfig(
+        task_type=TaskType.SEQ_2_SEQ_LM,
+        num_virtual_tokens=args.num_virtual_tokens,
+        fusion=args.fusion,
+    )
+    model = get_prompt_tuning_model(base_model, peft_config)
+
+    check_gradients(model, args.batch_sizes[0])
+
+    print(f"{'mode':<10} {'batch':>6} {'legacy ms':>10} {'view ms':>10} {'legacy MiB':>11} {'view MiB':>10}")
+    for inference_mode in (False, True):
+        peft_config.inference_mode = inference_mode
+        mode = 'inference' if inference_mode else 'training'
+        for batch_size in args.batch_sizes:
+            with torch.set_grad_enabled(not inference_mode):
+                def legacy(): return legacy_get_prompt(model, batch_size)
+                def view(): return model.get_prompt(batch_size)
+
+                assert torch.equal(legacy(), view())
+                print(
+                    f'{mode:<10} {batch_size:>6} '
+                    f'{elapsed_ms(legacy, args.iterations):>10.3f} {elapsed_ms(view, args.iterations):>10.3f} '
+                    f'{allocated_bytes(legacy) / 2 ** 20:>11.2f} {allocated_bytes(view) / 2 ** 20:>10.2f}'
+                )
@@ -0,0 +1,73 @@
+"""
+Prediction time and metrics of a classification test set with generation against rank classification, e.g.
+
+python -m benchmarks.rank_classification --dataset_name xnli --language english
+"""
+import argparse
+import time
+import numpy as np
+from functools import partial
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, DataCollatorForSeq2Seq, Seq2SeqTrainingArguments
+
+from task_modeling.args import DataTrainingArguments
+from task_modeling.trainer_seq2seq_qa import QuestionAnsweringSeq2SeqTrainer
+from tasks import dataset_factory
+
+
+def predict(model, tokenizer, dataset, examples, features, args, rank_classification):
+    metric = dataset.get_metric()
+    post_processing_function = (
+        dataset.post_processing_rank_classification if rank_classification else dataset.post_processing_function)
+    trainer = QuestionAnsweringSeq2SeqTrainer(
+        model=model,
+        args=Seq2SeqTrainingArguments(
+            output_dir='../results/benchmarks',
+            per_device_eval_batch_size=args.per_device_eval_batch_size,
+            predict_with_generate=True,
+            report_to=[],
+        ),
+        tokenizer=tokenizer,
+        data_collator=DataCollatorForSeq2Seq(tokenizer, model=model, label_pad_token_id=-100),
+        compute_metrics=lambda p: metric.compute(predictions=p.predictions, references=p.label_ids),
+        post_process_function=partial(post_processing_function, tokenizer=tokenizer),
+        rank_classification_labels=dataset.label_names if rank_classification else None,
+    )
+    start = time.perf_counter()
+    output = trainer.predict(features, examples, max_new_tokens=args.max_answer_length)
+    return output, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Generation against rank classification')
+    parser.add_argument('--model_name_or_path', type=str, default='bigscience/mt0-base')
+    parser.add_argument('--dataset_name', type=str, default='xnli')
+    parser.add_argument('--language', type=str, default='english')
+    parser.add_argument('--max_seq_length', type=int, default=256)
+    parser.add_argument('--max_answer_length', type=int, default=3)
+    parser.add_argument('--per_device_eval_batch_size', type=int, default=32)
+    parser.add_argument('--max_predict_samples', type=int, default=1000)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    model = AutoModelForSeq2SeqLM.from_pretrained(args.model_name_or_path).eval()
+    dataset = dataset_factory(dataset_name=args.dataset_name, language=args.language)
+    examples = dataset.get_dataset('test')
+    examples = examples.select(range(min(len(examples), args.max_predict_samples)))
+    data_args = DataTrainingArguments(
+        dataset_name=args.dataset_name, max_seq_length=args.max_seq_length, max_answer_length=args.max_answer_length)
+    features = examples.map(
+        partial(dataset.preprocess_validation_function, tokenizer=tokenizer,
+                data_args=data_args, max_seq_length=args.max_seq_length),
+        batched=True,
+        remove_columns=dataset.get_columns('test'),
+    )
+
+    generated, generate_s = predict(model, tokenizer, dataset, examples, features, args, False)
+    ranked, rank_s = predict(model, tokenizer, dataset, examples, features, args, True)
+
+    print(f'{args.dataset_name} {args.language}: {len(examples)} examples, labels {dataset.label_names}')
+    print(f"{'mode':<8} {'seconds':>8} metrics")
+    print(f'{"generate":<8} {generate_s:>8.2f} {generated.metrics}')
+    print(f'{"rank":<8} {rank_s:>8.2f} {ranked.metrics}')
+    print(f'speedup {generate_s / rank_s:.2f}, same predictions '
+          f'{np.mean(np.asarray(generated.predictions) == np.asarray(ranked.predictions)):.3f}')
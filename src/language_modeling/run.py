@@ -30,11 +30,13 @@ from language_modeling.t5_mlm import compute_input_and_target_lengths, DataColla
 from language_modeling.args import ModelArguments, DataTrainingArguments, PromptTuningArguments
 from language_modeling.utils import get_model
 from language_modeling.PromptSeq2SeqTrainer import PromptSeq2SeqTrainer
+from task_modeling.adapter_weights import use_safetensors_weights
 
 logger = logging.getLogger(__name__)
 
 
 def main():
+    use_safetensors_weights()
     parser = HfArgumentParser(
         (ModelArguments, DataTrainingArguments, TrainingArguments, AdapterArguments, PromptTuningArguments))
     if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
@@ -1,8 +1,9 @@
+from prompt_tuning.bank import PromptBank
 from prompt_tuning.config import PromptTuningConfig, PromptTuningInit, TaskType
 from prompt_tuning.model import PromptEmbedding
 from prompt_tuning.partial_model import PartialPromptEmbedding
 from prompt_tuning.mapping import get_prompt_tuning_model
 from prompt_tuning.prompt_tuning import PromptTuningForSeq2SeqLM, PeftModelForCausalLM, PeftModel, PeftModelForQuestionAnswering
 
-__all__ = ["PromptTuningConfig", "PromptEmbedding", "PromptTuningInit", "PartialPromptEmbedding",
+__all__ = ["PromptBank", "PromptTuningConfig", "PromptEmbedding", "PromptTuningInit", "PartialPromptEmbedding",
            "TaskType", "get_prompt_tuning_model", "PeftModel", "PromptTuningForSeq2SeqLM", "PeftModelForCausalLM", "PeftModelForQuestionAnswering"]
@@ -0,0 +1,134 @@
+import json
+import os
+from functools import lru_cache
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from prompt_tuning.config import PromptTuningConfig
+from prompt_tuning.quantization import PROMPT_KEY, SCALE_SUFFIX, dequantize_prompt, quantize_prompt
+
+PROMPT_BANK_FORMAT = 'prompt_bank'
+PROMPTS_KEY = 'prompts'
+SCALES_KEY = 'scales'
+
+
+class PromptBank:
+    """
+    Prompts of many languages and tasks packed into one safetensors file.
+
+    The prompts are stored as one contiguous `[num_prompts, num_rows, token_dim]` tensor, the file
+    header holds the name and the `PromptTuningConfig` of every prompt. Opening a bank only maps the
+    file and parses the header, the rows of a prompt are read when the prompt is requested. Banks saved
+    with `quantization='int8'` also hold a `[num_prompts, num_rows, 1]` tensor of per-row scales.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = safe_open(path, framework='pt', device='cpu')
+
+        metadata = self._file.metadata() or {}
+        if metadata.get('format') != PROMPT_BANK_FORMAT:
+            raise ValueError(f"'{path}' is not a prompt bank")
+
+        self.index = json.loads(metadata['index'])
+        self.quantization = metadata.get('quantization')
+        self._rows = {entry['name']: row for row, entry in enumerate(self.index)}
+
+    @property
+    def names(self):
+        return [entry['name'] for entry in self.index]
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def __len__(self):
+        return len(self.index)
+
+    def _get_row(self, name):
+        if name not in self._rows:
+            raise KeyError(f"Prompt '{name}' not found in the prompt bank '{self.path}'")
+        return self._rows[name]
+
+    def get_config(self, name):
+        return PromptTuningConfig(**self.index[self._get_row(name)]['config'])
+
+    def get_state_dict(self, name, device=None):
+        """
+        Returns the prompt as stored, with its scales when the bank is quantized to int8.
+        """
+        row = self._get_row(name)
+        state_dict = {PROMPT_KEY: self._file.get_slice(PROMPTS_KEY)[row:row + 1][0]}
+        if self.quantization == 'int8':
+            state_dict[PROMPT_KEY + SCALE_SUFFIX] = self._file.get_slice(SCALES_KEY)[row:row + 1][0]
+        return {key: value.to(device) for key, value in state_dict.items()} if device is not None else state_dict
+
+    def get_prompt(self, name, device=None):
+        state_dict = self.get_state_dict(name, device=device)
+        if self.quantization is None:
+            return state_dict[PROMPT_KEY]
+        return dequantize_prompt(state_dict[PROMPT_KEY], state_dict.get(PROMPT_KEY + SCALE_SUFFIX))
+
+    def get_prompts(self, device=None):
+        prompts = self._file.get_tensor(PROMPTS_KEY)
+        scales = self._file.get_tensor(SCALES_KEY) if self.quantization == 'int8' else None
+        if self.quantization is not None:
+            prompts = dequantize_prompt(prompts, scales)
+        return prompts.to(device) if device is not None else prompts
+
+    @staticmethod
+    def save(path, prompts, configs, quantization=None):
+        """
+        Writes a prompt bank.
+
+        `prompts` maps prompt names to `[num_rows, token_dim]` tensors and `configs` maps the same names
+        to their `PromptTuningConfig`. All prompts need the same shape. With `quantization` set to
+        `float16` or `int8` the prompts are stored quantized and dequantized to float32 when read.
+        """
+        names = list(prompts.keys())
+        shapes = {tuple(prompts[name].shape) for name in names}
+        if len(shapes) != 1:
+            raise ValueError(
+                f"All prompts in a prompt bank need the same shape, got {sorted(shapes)}")
+
+        index = []
+        for name in names:
+            config = configs[name].to_dict()
+            config['inference_mode'] = True
+            index.append({'name': name, 'config': config})
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        metadata = {
+            'format': PROMPT_BANK_FORMAT,
+            'index': json.dumps(index, ensure_ascii=False),
+        }
+        tensors = {PROMPTS_KEY: torch.stack([prompts[name].detach().cpu() for name in names]).contiguous()}
+        if quantization is not None:
+            quantized, scales = zip(*(quantize_prompt(prompt, quantization) for prompt in tensors[PROMPTS_KEY]))
+            tensors[PROMPTS_KEY] = torch.stack(quantized).contiguous()
+            if scales[0] is not None:
+                tensors[SCALES_KEY] = torch.stack(scales).contiguous()
+            metadata['quantization'] = quantization
+        save_file(tensors, path, metadata=metadata)
+        # a bank rewritten within the timestamp resolution of the file system keeps its modification time
+        _open_prompt_bank.cache_clear()
+
+
+def is_prompt_bank(path):
+    if not (isinstance(path, str) and path.endswith('.safetensors') and os.path.isfile(path)):
+        return False
+    with safe_open(path, framework='pt', device='cpu') as f:
+        metadata = f.metadata() or {}
+    return metadata.get('format') == PROMPT_BANK_FORMAT
+
+
+@lru_cache(maxsize=None)
+def _open_prompt_bank(path, mtime_ns):
+    return PromptBank(path)
+
+
+def open_prompt_bank(path):
+    """
+    Returns the `PromptBank` at `path`, opened once per version of the file.
+    """
+    return _open_prompt_bank(path, os.stat(path).st_mtime_ns)
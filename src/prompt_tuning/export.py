@@ -0,0 +1,277 @@
+import inspect
+import json
+import os
+import numpy as np
+import torch
+from torch import nn
+
+from prompt_tuning.prompt_tuning import PeftModel
+
+ENCODER_FILE = 'encoder.onnx'
+DECODER_FILE = 'decoder.onnx'
+DECODER_WITH_PAST_FILE = 'decoder_with_past.onnx'
+CONFIG_FILE = 'onnx_config.json'
+
+
+class PromptedEncoder(nn.Module):
+    """
+    The encoder of a seq2seq model with the prompt as an input.
+
+    The `[batch_size, num_virtual_tokens, token_dim]` prompt embeddings are prepended to the embedded input ids and
+    the attention mask is extended to cover them, as `PromptTuningForSeq2SeqLM.get_prompted_inputs` does.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.word_embeddings = model.get_input_embeddings()
+        self.encoder = model.get_encoder()
+
+    def forward(self, input_ids, attention_mask, prompt_embeddings):
+        inputs_embeds = self.word_embeddings(input_ids)
+        inputs_embeds = torch.cat((prompt_embeddings.to(inputs_embeds.dtype), inputs_embeds), dim=1)
+        prefix_attention_mask = torch.ones_like(prompt_embeddings[:, :, 0], dtype=attention_mask.dtype)
+        attention_mask = torch.cat((prefix_attention_mask, attention_mask), dim=1)
+        encoder_outputs = self.encoder(inputs_embeds=inputs_embeds, attention_mask=attention_mask)
+        return encoder_outputs.last_hidden_state, attention_mask
+
+
+class Decoder(nn.Module):
+    """
+    The first decoding step of a seq2seq model, from the decoder start token.
+
+    Returns the logits of the step followed by the self-attention and cross-attention keys and values of every
+    layer, four tensors per layer.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask):
+        outputs = self.model(
+            encoder_outputs=(encoder_hidden_states,),
+            attention_mask=encoder_attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            use_cache=True,
+        )
+        return (outputs.logits[:, -1],) + tuple(tensor for layer in outputs.past_key_values for tensor in layer)
+
+
+class DecoderWithPast(nn.Module):
+    """
+    A decoding step of a seq2seq model on the cached keys and values of the previous steps.
+
+    Takes the four cached tensors of every layer after the inputs and returns the logits of the step followed by the
+    extended self-attention keys and values, two tensors per layer. The cross-attention ones do not change.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask, *past_key_values):
+        past_key_values = tuple(past_key_values[i:i + 4] for i in range(0, len(past_key_values), 4))
+        outputs = self.model(
+            encoder_outputs=(encoder_hidden_states,),
+            attention_mask=encoder_attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        return (outputs.logits[:, -1],) + tuple(tensor for layer in outputs.past_key_values for tensor in layer[:2])
+
+
+def get_past_names(prefix, num_layers, cross_attention=True):
+    kinds = ('key', 'value', 'cross_key', 'cross_value') if cross_attention else ('key', 'value')
+    return [f'{prefix}.{layer}.{kind}' for layer in range(num_layers) for kind in kinds]
+
+
+def get_prompt_embeddings(model, batch_size=1, prompt_ids=None):
+    """
+    Returns the `[batch_size, num_virtual_tokens, token_dim]` prompt embeddings a `PromptTuningForSeq2SeqLM`
+    prepends to its inputs, including the prompts of wrapped models, e.g. to pass them to `OnnxPromptedSeq2SeqLM`.
+    """
+    inputs_embeds = model.word_embeddings.weight.new_zeros(batch_size, 0, model.word_embeddings.embedding_dim)
+    with torch.no_grad():
+        prompt_embeddings, _ = model.get_prompted_inputs(inputs_embeds=inputs_embeds, prompt_ids=prompt_ids)
+    return prompt_embeddings
+
+
+def export_onnx(model, output_dir, num_virtual_tokens=None, opset_version=14):
+    """
+    Exports the encoder and the decoder of a seq2seq model, or of the backbone of a `PromptTuningForSeq2SeqLM`,
+    to `output_dir`. The decoder is exported as two graphs, the first step and the steps on cached keys and values.
+
+    The prompt is not part of the graphs, any prompt of the backbone, e.g. from a `PromptBank`, can be passed to
+    the exported encoder at runtime. The batch size, the input length and the number of virtual tokens are dynamic.
+    """
+    if isinstance(model, PeftModel):
+        num_virtual_tokens = num_virtual_tokens or model._get_num_virtual_tokens()
+        model = model.get_transformer_model()
+    num_virtual_tokens = num_virtual_tokens or 1
+    model = model.eval()
+    os.makedirs(output_dir, exist_ok=True)
+
+    # torch >= 2.5 has a second exporter, the graphs are traced with the TorchScript one
+    export_kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    batch_size, sequence_length = 2, 8
+    input_ids = torch.ones(batch_size, sequence_length, dtype=torch.long, device=model.device)
+    attention_mask = torch.ones_like(input_ids)
+    prompt_embeddings = torch.zeros(
+        batch_size, num_virtual_tokens, model.config.d_model, dtype=model.dtype, device=model.device)
+
+    # the exporter restores the training mode of the wrappers, which would also put the backbone back into training
+    encoder = PromptedEncoder(model).eval()
+    with torch.no_grad():
+        encoder_hidden_states, encoder_attention_mask = encoder(input_ids, attention_mask, prompt_embeddings)
+        torch.onnx.export(
+            encoder,
+            (input_ids, attention_mask, prompt_embeddings),
+            os.path.join(output_dir, ENCODER_FILE),
+            input_names=['input_ids', 'attention_mask', 'prompt_embeddings'],
+            output_names=['encoder_hidden_states', 'encoder_attention_mask'],
+            dynamic_axes={
+                'input_ids': {0: 'batch_size', 1: 'sequence_length'},
+                'attention_mask': {0: 'batch_size', 1: 'sequence_length'},
+                'prompt_embeddings': {0: 'batch_size', 1: 'num_virtual_tokens'},
+                'encoder_hidden_states': {0: 'batch_size', 1: 'encoder_sequence_length'},
+                'encoder_attention_mask': {0: 'batch_size', 1: 'encoder_sequence_length'},
+            },
+            opset_version=opset_version,
+            **export_kwargs,
+        )
+
+        num_layers = model.config.num_decoder_layers
+        decoder_input_ids = torch.full(
+            (batch_size, 1), model.config.decoder_start_token_id, dtype=torch.long, device=model.device)
+        decoder_inputs = (decoder_input_ids, encoder_hidden_states, encoder_attention_mask)
+        decoder_input_names = ['decoder_input_ids', 'encoder_hidden_states', 'encoder_attention_mask']
+        decoder_axes = {
+            'decoder_input_ids': {0: 'batch_size'},
+            'encoder_hidden_states': {0: 'batch_size', 1: 'encoder_sequence_length'},
+            'encoder_attention_mask': {0: 'batch_size', 1: 'encoder_sequence_length'},
+            'logits': {0: 'batch_size'},
+        }
+        present_names = get_past_names('present', num_layers)
+        present_axes = {
+            name: {0: 'batch_size', 2: 'encoder_sequence_length' if 'cross' in name else 'past_sequence_length'}
+            for name in present_names
+        }
+
+        decoder = Decoder(model).eval()
+        torch.onnx.export(
+            decoder,
+            decoder_inputs,
+            os.path.join(output_dir, DECODER_FILE),
+            input_names=decoder_input_names,
+            output_names=['logits'] + present_names,
+            dynamic_axes={**decoder_axes, **present_axes},
+            opset_version=opset_version,
+            **export_kwargs,
+        )
+
+        past_key_values = decoder(*decoder_inputs)[1:]
+        past_names = get_past_names('past_key_values', num_layers)
+        past_axes = {
+            name: {0: 'batch_size', 2: 'encoder_sequence_length' if 'cross' in name else 'past_sequence_length'}
+            for name in past_names
+        }
+        present_names = get_past_names('present', num_layers, cross_attention=False)
+        torch.onnx.export(
+            DecoderWithPast(model).eval(),
+            decoder_inputs + past_key_values,
+            os.path.join(output_dir, DECODER_WITH_PAST_FILE),
+            input_names=decoder_input_names + past_names,
+            output_names=['logits'] + present_names,
+            dynamic_axes={**decoder_axes, **past_axes, **{name: present_axes[name] for name in present_names}},
+            opset_version=opset_version,
+            **export_kwargs,
+        )
+
+    config = {
+        'model_name_or_path': model.config._name_or_path,
+        'decoder_start_token_id': model.config.decoder_start_token_id,
+        'eos_token_id': model.config.eos_token_id,
+        'pad_token_id': model.config.pad_token_id,
+    }
+    with open(os.path.join(output_dir, CONFIG_FILE), 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=2)
+
+
+class OnnxPromptedSeq2SeqLM:
+    """
+    Runs the graphs of `export_onnx` with onnxruntime and decodes greedily.
+    """
+
+    def __init__(self, path, intra_op_num_threads=None, providers=('CPUExecutionProvider',)):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('Running exported models needs onnxruntime, install it with `pip install onnxruntime`')
+
+        options = onnxruntime.SessionOptions()
+        if intra_op_num_threads is not None:
+            options.intra_op_num_threads = intra_op_num_threads
+        self.encoder = onnxruntime.InferenceSession(
+            os.path.join(path, ENCODER_FILE), options, providers=list(providers))
+        self.decoder = onnxruntime.InferenceSession(
+            os.path.join(path, DECODER_FILE), options, providers=list(providers))
+        self.decoder_with_past = onnxruntime.InferenceSession(
+            os.path.join(path, DECODER_WITH_PAST_FILE), options, providers=list(providers))
+        with open(os.path.join(path, CONFIG_FILE), 'r', encoding='utf-8') as f:
+            self.config = json.load(f)
+
+    def encode(self, input_ids, attention_mask, prompt_embeddings):
+        return self.encoder.run(None, {
+            'input_ids': np.asarray(input_ids, dtype=np.int64),
+            'attention_mask': np.asarray(attention_mask, dtype=np.int64),
+            'prompt_embeddings': np.asarray(prompt_embeddings, dtype=np.float32),
+        })
+
+    @staticmethod
+    def _run(session, inputs):
+        # inputs the exporter found unused, e.g. the encoder states of the cached decoder, are not in the graph
+        input_names = {graph_input.name for graph_input in session.get_inputs()}
+        return session.run(None, {name: value for name, value in inputs.items() if name in input_names})
+
+    def decode(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask, past_key_values=None):
+        """
+        Runs one decoding step on the `[batch_size, 1]` decoder input ids.
+
+        Returns the logits of the step and the keys and values of all steps so far, four per layer.
+        """
+        inputs = {
+            'decoder_input_ids': np.asarray(decoder_input_ids, dtype=np.int64),
+            'encoder_hidden_states': encoder_hidden_states,
+            'encoder_attention_mask': encoder_attention_mask,
+        }
+        if past_key_values is None:
+            logits, *past_key_values = self._run(self.decoder, inputs)
+            return logits, past_key_values
+
+        inputs.update(zip(get_past_names('past_key_values', len(past_key_values) // 4), past_key_values))
+        logits, *self_attention = self._run(self.decoder_with_past, inputs)
+        for i, tensor in enumerate(self_attention):
+            past_key_values[i // 2 * 4 + i % 2] = tensor
+        return logits, past_key_values
+
+    def generate(self, input_ids, attention_mask, prompt_embeddings, max_new_tokens=20):
+        """
+        Returns the greedily generated `[batch_size, <= max_new_tokens + 1]` token ids, starting with the decoder
+        start token and padded after the end of sequence token, as `generate` of the PyTorch model.
+        """
+        encoder_hidden_states, encoder_attention_mask = self.encode(input_ids, attention_mask, prompt_embeddings)
+
+        batch_size = encoder_hidden_states.shape[0]
+        decoder_input_ids = np.full((batch_size, 1), self.config['decoder_start_token_id'], dtype=np.int64)
+        finished = np.zeros(batch_size, dtype=bool)
+        past_key_values = None
+        for _ in range(max_new_tokens):
+            logits, past_key_values = self.decode(
+                decoder_input_ids[:, -1:], encoder_hidden_states, encoder_attention_mask, past_key_values)
+            next_tokens = np.where(finished, self.config['pad_token_id'], logits.argmax(-1))
+            decoder_input_ids = np.concatenate((decoder_input_ids, next_tokens[:, None]), axis=1)
+            finished |= next_tokens == self.config['eos_token_id']
+            if finished.all():
+                break
+        return decoder_input_ids
@@ -1,82 +1,78 @@
+import logging
 import torch
-from transformers import AutoTokenizer
 import math
 from prompt_tuning.config import PromptTuningInit
-from train.initialization import init_tokens, class_initialization
+from train.initialization import get_init_token_index
+
+
+def repeat_to_size(token_ids, size):
+    num_tokens = len(token_ids)
+    if num_tokens < size:
+        num_reps = math.ceil(size / num_tokens)
+        token_ids = token_ids * num_reps
+    return token_ids[:size]
+
+
+def embed_tokens(word_embeddings, token_ids, size):
+    """
+    Returns the word embeddings of `token_ids` repeated to `size` rows, or None if they are not all in the word
+    embeddings, e.g. for a prompt of the full vocabulary attached to a model with a pruned vocabulary, whose
+    weights are loaded afterwards.
+    """
+    if max(token_ids) >= word_embeddings.num_embeddings:
+        logging.warning('The init tokens are not in the word embeddings, the prompt is initialized randomly')
+        return None
+    token_ids = torch.LongTensor(
+        repeat_to_size(token_ids, size)).to(word_embeddings.weight.device)
+    with torch.no_grad():
+        word_embedding_weights = word_embeddings(token_ids).clone()
+    return word_embedding_weights.to(torch.float32)
+
+
+def init_prompt_weights(config, word_embeddings, size):
+    """
+    Returns `size` rows initialized from the word embeddings as set by `config.prompt_tuning_init`,
+    or None for random initialization.
+    """
+    init_type = config.prompt_tuning_init
+    if init_type not in (PromptTuningInit.TEXT, PromptTuningInit.SAMPLED, PromptTuningInit.CLASS):
+        return None
+
+    init_token_index = get_init_token_index(config.tokenizer_name_or_path)
+    if init_type == PromptTuningInit.TEXT:
+        token_ids = init_token_index.encode(config.prompt_tuning_init_text)
+    elif init_type == PromptTuningInit.SAMPLED:
+        token_ids = init_token_index.sample(size)
+    else:
+        classes = config.prompt_tuning_init_text.split(',')
+        token_ids = init_token_index.encode_classes(classes)
+
+    return embed_tokens(word_embeddings, token_ids, size)
 
 
 class PromptEmbedding(torch.nn.Module):
     def __init__(self, config, word_embeddings):
         super().__init__()
-        init_type = config.prompt_tuning_init
 
         total_virtual_tokens = config.num_virtual_tokens * \
             config.num_transformer_submodules
         self.embeddings = torch.nn.Embedding(
             total_virtual_tokens, config.token_dim)
-        
-        if init_type == PromptTuningInit.TEXT:
-            tokenizer = AutoTokenizer.from_pretrained(
-                config.tokenizer_name_or_path)
-            init_text = config.prompt_tuning_init_text
-            init_tokens_ids = tokenizer(init_text)['input_ids']
-            num_tokens = len(init_tokens_ids)
-            if num_tokens > total_virtual_tokens:
-                init_tokens_ids = init_tokens_ids[:total_virtual_tokens]
-            elif num_tokens < total_virtual_tokens:
-                num_reps = math.ceil(total_virtual_tokens / num_tokens)
-                init_tokens_ids = init_tokens_ids * num_reps
 
-            init_tokens_ids = init_tokens_ids[:total_virtual_tokens]
-            init_tokens_ids = torch.LongTensor(
-                init_tokens_ids).to(word_embeddings.weight.device)
-
-            word_embedding_weights = word_embeddings(
-                init_tokens_ids).detach().clone()
-            word_embedding_weights = word_embedding_weights.to(torch.float32)
+        word_embedding_weights = init_prompt_weights(
+            config, word_embeddings, total_virtual_tokens)
+        if word_embedding_weights is not None:
             self.embeddings.weight = torch.nn.Parameter(word_embedding_weights)
 
-        elif init_type == PromptTuningInit.SAMPLED:
-            tokenizer = AutoTokenizer.from_pretrained(
-                config.tokenizer_name_or_path)
-            sampled_tokens = init_tokens(tokenizer, total_virtual_tokens)
-            num_tokens = len(sampled_tokens)
-            if num_tokens > total_virtual_tokens:
-                sampled_tokens = sampled_tokens[:total_virtual_tokens]
-            elif num_tokens < total_virtual_tokens:
-                num_reps = math.ceil(total_virtual_tokens / num_tokens)
-                sampled_tokens = sampled_tokens * num_reps
-
-            sampled_tokens = sampled_tokens[:total_virtual_tokens]
-            sampled_tokens = torch.LongTensor(
-                sampled_tokens).to(word_embeddings.weight.device)
-
-            word_embedding_weights = word_embeddings(
-                sampled_tokens).detach().clone()
-            word_embedding_weights = word_embedding_weights.to(torch.float32)
-            self.embeddings.weight = torch.nn.Parameter(word_embedding_weights)
+    def get_weight(self):
+        return self.embeddings.weight
 
-        elif init_type == PromptTuningInit.CLASS:
-            tokenizer = AutoTokenizer.from_pretrained(
-                config.tokenizer_name_or_path)
-            class_tokens = config.prompt_tuning_init_text
-            classes = class_tokens.split(',')
-            class_tokens = class_initialization(tokenizer, classes)
-            num_tokens = len(class_tokens)
-            if num_tokens > total_virtual_tokens:
-                class_tokens = class_tokens[:total_virtual_tokens]
-            elif num_tokens < total_virtual_tokens:
-                num_reps = math.ceil(total_virtual_tokens / num_tokens)
-                class_tokens = class_tokens * num_reps
-
-            class_tokens = class_tokens[:total_virtual_tokens]
-            class_tokens = torch.LongTensor(
-                class_tokens).to(word_embeddings.weight.device)
-
-            word_embedding_weights = word_embeddings(
-                class_tokens).detach().clone()
-            word_embedding_weights = word_embedding_weights.to(torch.float32)
-            self.embeddings.weight = torch.nn.Parameter(word_embedding_weights)
+    def set_weight(self, weight):
+        # the loaded weight replaces the current one, so the prompt keeps the dtype it was saved in
+        if weight.shape != self.embeddings.weight.shape:
+            raise ValueError(
+                f"Expected prompt weight of shape {tuple(self.embeddings.weight.shape)}, got {tuple(weight.shape)}")
+        self.embeddings.weight.data = weight.detach().to(self.embeddings.weight.device, copy=True)
 
     def forward(self, indices):
         return self.embeddings(indices)
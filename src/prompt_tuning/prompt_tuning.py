@@ -1,24 +1,29 @@
 import torch
 import os
-from transformers import PreTrainedModel
-from copy import deepcopy
+from transformers import GenerationConfig, PreTrainedModel
 import inspect
 from huggingface_hub import hf_hub_download
 from transformers.utils import PushToHubMixin
 from accelerate import dispatch_model, infer_auto_device_map
 from accelerate.utils import get_balanced_memory
 from accelerate.hooks import AlignDevicesHook, add_hook_to_module, remove_hook_from_submodules
+import itertools
 import logging
+import weakref
+import safetensors.torch
 
+from prompt_tuning.bank import is_prompt_bank, open_prompt_bank
 from prompt_tuning.config import PromptTuningConfig
 from prompt_tuning.model import PromptEmbedding
 from prompt_tuning.partial_model import PartialPromptEmbedding
-from prompt_tuning.utils import _prepare_prompt_learning_config, _get_batch_size, get_peft_model_state_dict, infer_device, load_adapter_weights, set_peft_model_state_dict, _set_trainable
+from prompt_tuning.quantization import dequantize_state_dict, quantize_state_dict
+from prompt_tuning.utils import WEIGHTS_NAME, SAFETENSORS_WEIGHTS_NAME, _prepare_prompt_learning_config, _get_batch_size, get_peft_model_state_dict, infer_device, load_adapter_weights, set_peft_model_state_dict, _set_trainable
 
 logging.basicConfig(level=logging.INFO)
 
 
-WEIGHTS_NAME = 'adapter_model.bin'
+# word embeddings of every base model prompts were attached to, see PeftModel._resolve_backbone
+_backbone_cache = weakref.WeakKeyDictionary()
 
 
 class PeftModel(PushToHubMixin, torch.nn.Module):
@@ -30,6 +35,7 @@ class PeftModel(PushToHubMixin, torch.nn.Module):
         self.device = model.device
 
         self._peft_config = {adapter_name: peft_config}
+        self._prompt_cache = {}
         self.base_model = model
         self.config = getattr(self.base_model, "config",
                               {"model_type": "custom"})
@@ -38,7 +44,7 @@ class PeftModel(PushToHubMixin, torch.nn.Module):
         if hasattr(self.base_model, "config") and hasattr(self.base_model.config, "pretraining_tp"):
             self.base_model.config.pretraining_tp = 1
 
-    def save_pretrained(self, save_directory, **kwargs):
+    def save_pretrained(self, save_directory, safe_serialization=True, quantization=None, **kwargs):
         if os.path.isfile(save_directory):
             raise AssertionError(
                 "Provided path ({}) should be a directory, not a file".format(save_directory))
@@ -50,13 +56,21 @@ class PeftModel(PushToHubMixin, torch.nn.Module):
             prompt_config = self._peft_config[adapter_name]
             output_state_dict = get_peft_model_state_dict(
                 self, state_dict=kwargs.get("state_dict", None), adapter_name=adapter_name)
+            output_state_dict = quantize_state_dict(output_state_dict, quantization)
 
             output_dir = os.path.join(
                 save_directory, adapter_name) if adapter_name != "default" else save_directory
             os.makedirs(output_dir, exist_ok=True)
 
-            torch.save(output_state_dict, os.path.join(
-                output_dir, WEIGHTS_NAME))
+            if safe_serialization:
+                safetensors.torch.save_file(
+                    {key: value.detach().cpu().contiguous() for key, value in output_state_dict.items()},
+                    os.path.join(output_dir, SAFETENSORS_WEIGHTS_NAME),
+                    metadata={'format': 'pt'},
+                )
+            else:
+                torch.save(output_state_dict, os.path.join(
+                    output_dir, WEIGHTS_NAME))
 
             if prompt_config.base_model_name_or_path is None:
                 prompt_config.base_model_name_or_path = (
@@ -78,52 +92,109 @@ class PeftModel(PushToHubMixin, torch.nn.Module):
         return self.get_base_model()(*args, **kwargs)
 
     @classmethod
-    def from_pretrained(cls, model, model_id, adapter_name='default', is_trainable=False, config=None, **kwargs):
-        config = PromptTuningConfig.from_pretrained(model_id, **kwargs)
+    def from_pretrained(cls, model, model_id, adapter_name='default', is_trainable=False, config=None, prompt_name=None, **kwargs):
+        if is_prompt_bank(model_id):
+            # prompts in a bank are looked up by the adapter name unless another name is given
+            prompt_name = prompt_name or adapter_name
+            config = open_prompt_bank(model_id).get_config(prompt_name)
+        else:
+            config = PromptTuningConfig.from_pretrained(model_id, **kwargs)
 
         model = cls(model, config, adapter_name=adapter_name)
         model.load_adapter(model_id, adapter_name=adapter_name,
-                           is_trainable=is_trainable, **kwargs)
+                           is_trainable=is_trainable, prompt_name=prompt_name, **kwargs)
         return model
+
+    def load_prompt_bank(self, path, prompt_names=None, is_trainable=False):
+        """
+        Attaches prompts from a prompt bank (see `prompt_tuning.bank`) as adapters named after the prompts.
+
+        All prompts of the bank are attached if `prompt_names` is not given. Prompts that are already
+        attached get their weights replaced by the ones from the bank.
+        """
+        prompt_bank = open_prompt_bank(path)
+        prompt_names = prompt_names or prompt_bank.names
+
+        for prompt_name in prompt_names:
+            if prompt_name not in self._peft_config:
+                self.add_adapter(prompt_name, prompt_bank.get_config(prompt_name))
+            self.load_adapter(path, adapter_name=prompt_name,
+                              is_trainable=is_trainable, prompt_name=prompt_name)
+        return prompt_names
     
     def set_fixed(self, fixed_text, adapter_name='default'):
-        self.prompt_encoder[adapter_name].set_fixed(fixed_text)
+        self.prompt_encoder[adapter_name].set_fixed(fixed_text, self.word_embeddings)
         
 
-    def _setup_prompt_encoder(self, adapter_name):
-        config = self._peft_config[adapter_name]
+    def _resolve_backbone(self):
+        """
+        Freezes the base model and finds its word embeddings and config.
 
-        if not hasattr(self, "prompt_encoder"):
-            self.prompt_encoder = torch.nn.ModuleDict({})
-            self.prompt_tokens = {}
-        transformer_backbone = None
+        The result is cached per base model, so attaching further prompts to the same base model skips
+        the walk over its parameters.
+        """
+        backbone = _backbone_cache.get(self.base_model)
+        if backbone is not None:
+            return backbone
 
+        transformer_backbone = None
+        transformer_backbone_name = None
         for name, module in self.base_model.named_children():
             for param in module.parameters():
                 param.requires_grad = False
             if isinstance(module, PreTrainedModel):
                 if transformer_backbone is None:
                     transformer_backbone = module
-                    self.transformer_backbone_name = name
+                    transformer_backbone_name = name
 
         if transformer_backbone is None:
             transformer_backbone = self.base_model
 
+        word_embeddings = None
+        input_embeddings = getattr(self.base_model, 'get_input_embeddings', lambda: None)()
+        if isinstance(input_embeddings, torch.nn.Embedding) and \
+                input_embeddings.weight.shape[0] == self.base_model.config.vocab_size:
+            word_embeddings = input_embeddings
+        else:
+            for named_param, value in list(transformer_backbone.named_parameters()):
+                deepspeed_distributed_tensor_shape = getattr(
+                    value, "ds_shape", None)
+
+                if value.shape[0] == self.base_model.config.vocab_size or (
+                    deepspeed_distributed_tensor_shape is not None
+                    and deepspeed_distributed_tensor_shape[0] == self.base_model.config.vocab_size
+                ):
+                    word_embeddings = transformer_backbone.get_submodule(
+                        named_param.replace(".weight", ""))
+                    break
+
+        if hasattr(self.config, "to_dict"):
+            dict_config = self.config.to_dict()
+        else:
+            dict_config = self.config
+
+        backbone = {
+            'config': dict_config,
+            'word_embeddings': word_embeddings,
+            'transformer_backbone_name': transformer_backbone_name,
+        }
+        _backbone_cache[self.base_model] = backbone
+        return backbone
+
+    def _setup_prompt_encoder(self, adapter_name):
+        config = self._peft_config[adapter_name]
+
+        if not hasattr(self, "prompt_encoder"):
+            self.prompt_encoder = torch.nn.ModuleDict({})
+
+        backbone = self._resolve_backbone()
+        if backbone['transformer_backbone_name'] is not None:
+            self.transformer_backbone_name = backbone['transformer_backbone_name']
+        self.word_embeddings = backbone['word_embeddings']
+
         if config.num_transformer_submodules is None:
             config.num_transformer_submodules = 2
 
-        for named_param, value in list(transformer_backbone.named_parameters()):
-            deepspeed_distributed_tensor_shape = getattr(
-                value, "ds_shape", None)
-
-            if value.shape[0] == self.base_model.config.vocab_size or (
-                deepspeed_distributed_tensor_shape is not None
-                and deepspeed_distributed_tensor_shape[0] == self.base_model.config.vocab_size
-            ):
-                self.word_embeddings = transformer_backbone.get_submodule(
-                    named_param.replace(".weight", ""))
-                break
-        
         if 'partial_embedding' in config.__dict__ and config.partial_embedding:
             prompt_encoder = PartialPromptEmbedding(config, self.word_embeddings)
         else:
@@ -132,64 +203,159 @@ class PeftModel(PushToHubMixin, torch.nn.Module):
 
         self.prompt_encoder.update(
             torch.nn.ModuleDict({adapter_name: prompt_encoder}))
-        self.prompt_tokens[adapter_name] = torch.arange(
-            config.num_virtual_tokens * config.num_transformer_submodules
-        ).long()
 
     def get_prompt_embedding_to_save(self, adapter_name='default'):
         prompt_encoder = self.prompt_encoder[adapter_name]
-        prompt_tokens = (
-            self.prompt_tokens[adapter_name]
-            .unsqueeze(0)
-            .expand(1, -1)
-            .to(prompt_encoder.embeddings.weight.device)
-        )
+        return prompt_encoder.get_weight().detach().cpu()
+
+    def _get_num_virtual_tokens(self, adapter_name=None):
+        prompt_config = self._peft_config[adapter_name or self.adapter_name]
+        num_virtual_tokens = prompt_config.num_virtual_tokens
+        if prompt_config.fusion == 'cat':
+            num_virtual_tokens *= 2
+        return num_virtual_tokens
+
+    def get_prompt_ids(self, adapter_names):
+        """
+        Converts adapter names into the `prompt_ids` used to route prompts per row.
+
+        `adapter_names` holds one entry per row, either the name of a single attached prompt or a list of
+        names whose prompts are fused in the given order with the configured fusion method. All rows need the
+        same number of prompts, a single name counts as a list of one.
+        """
+        index = {name: i for i, name in enumerate(self.prompt_encoder.keys())}
+        if all(isinstance(name, str) for name in adapter_names):
+            return torch.tensor([index[name] for name in adapter_names]).long()
 
-        prompt_embeddings = prompt_encoder(prompt_tokens)
-        return prompt_embeddings[0].detach().cpu()
+        adapter_names = [[names] if isinstance(names, str) else list(names) for names in adapter_names]
+        if len({len(names) for names in adapter_names}) > 1:
+            raise ValueError(f'All rows need the same number of prompts to fuse, got {adapter_names}')
+        return torch.tensor([[index[name] for name in names] for names in adapter_names]).long()
+
+    def get_nested_prompt(self, adapter_names, dtype=None):
+        """
+        Returns the prompts of every row as nested `PromptTuningForSeq2SeqLM` models prepend them, as a
+        `[batch_size, num_virtual_tokens, token_dim]` tensor.
+
+        `adapter_names` holds one list of attached prompts per row, in the order the models were nested, e.g.
+        `[language_prompt, task_prompt]`. Nested models share the prompts they attach, so every model prepends the
+        prompts of the row fused with its own config, the innermost model first. A row with one prompt gets it as a
+        single attached prompt would. The prompts at one position need the same config in all rows.
+        """
+        prompt_ids = self.get_prompt_ids([list(names) for names in adapter_names])
+        prompts = []
+        for names in zip(*adapter_names):
+            configs = {
+                name: (self._peft_config[name].fusion, self._peft_config[name].num_virtual_tokens) for name in names}
+            if len(set(configs.values())) > 1:
+                raise ValueError(f'Nested prompts at one position need the same fusion and size, got {configs}')
+            prompts.append(self._get_routed_prompt(prompt_ids, dtype=dtype, adapter_name=names[0]))
+        return torch.cat(prompts, dim=1)
+
+    def get_prompt(self, batch_size, prompt_ids=None, dtype=None):
+        """
+        Returns the prompt as a `[batch_size, num_virtual_tokens, token_dim]` tensor.
 
-    def get_prompt(self, batch_size):
+        Only the rows that are prepended to the input are taken from the prompt weights and they are
+        broadcast over the batch with `expand`, so no per-row copy is made. The view stays attached to
+        the prompt parameters, gradients from all rows are summed into them during training.
+
+        If `prompt_ids` is given (see `get_prompt_ids`), every row gets its own prompt or fused set of
+        prompts, gathered from the stacked prompts of all attached adapters.
+
+        If `dtype` differs from the prompt weights, the prompt is cast before it is expanded. Outside of
+        training the cast copy is cached.
+        """
         prompt_config = self._peft_config[self.adapter_name]
+        num_virtual_tokens = self._get_num_virtual_tokens()
 
-        if len(list(self.prompt_encoder.keys())) == 1:
+        if prompt_ids is not None:
+            return self._get_routed_prompt(prompt_ids, dtype=dtype)
+
+        if len(self.prompt_encoder) == 1:
             prompt_encoder = self.prompt_encoder[self.adapter_name]
+            prompt = prompt_encoder.get_weight()[:num_virtual_tokens]
+            if dtype is not None and prompt.dtype != dtype:
+                prompt = self._get_cached_prompt(
+                    ('single', num_virtual_tokens, dtype), lambda: prompt.to(dtype))
+        else:
+            prompt = self._get_cached_prompt(
+                ('fused', prompt_config.fusion, num_virtual_tokens, dtype),
+                lambda: self._get_fused_prompt().to(dtype))
 
-            prompt_tokens = (
-                self.prompt_tokens[self.adapter_name]
-                .unsqueeze(0)
-                .expand(batch_size, -1)
-                .to(prompt_encoder.embeddings.weight.device)
-            )
-            if prompt_config.inference_mode:
-                return prompt_encoder.embeddings.weight.repeat(batch_size, 1, 1)
-            else:
-                return prompt_encoder(prompt_tokens)
+        return prompt.unsqueeze(0).expand(batch_size, -1, -1)
+
+    def _get_fused_prompt(self):
+        prompt_config = self._peft_config[self.adapter_name]
+        num_virtual_tokens = self._get_num_virtual_tokens()
+
+        prompt_embeddings = [
+            prompt_encoder.get_weight()[:prompt_config.num_virtual_tokens]
+            for prompt_encoder in self.prompt_encoder.values()
+        ]
+
+        if prompt_config.fusion == 'avg':
+            return torch.mean(torch.stack(prompt_embeddings, dim=0), dim=0)
+        elif prompt_config.fusion == 'cat' or prompt_config.fusion == 'none':
+            return torch.cat(prompt_embeddings, dim=0)[:num_virtual_tokens]
         else:
-            prompt_embeddings = []
-            for adapter_name in self.prompt_encoder.keys():
-                prompt_encoder = self.prompt_encoder[adapter_name]
-                # prompt_config = self._peft_config[adapter_name]
-                prompt_tokens = (
-                    self.prompt_tokens[adapter_name]
-                    .unsqueeze(0)
-                    .expand(batch_size, -1)
-                    .to(prompt_encoder.embeddings.weight.device)
-                )
-                if prompt_config.inference_mode:
-                    prompt_embeddings.append(
-                        prompt_encoder.embeddings.weight.repeat(batch_size, 1, 1)[:, :prompt_config.num_virtual_tokens])
-                else:
-                    prompt_embeddings.append(prompt_encoder(prompt_tokens)[
-                                             :, :prompt_config.num_virtual_tokens])
-
-            if prompt_config.fusion == 'avg':
-                prompt_embeddings = torch.stack(prompt_embeddings, dim=1)
-                return torch.mean(prompt_embeddings, dim=1)
-            elif prompt_config.fusion == 'cat' or prompt_config.fusion == 'none':
-                return torch.cat(prompt_embeddings, dim=1)
-            else:
-                raise ValueError(
-                    f"Invalid fusion method: {prompt_config.fusion}")
+            raise ValueError(
+                f"Invalid fusion method: {prompt_config.fusion}")
+
+    def _get_cached_prompt(self, key, compute_prompt, extra_tensors=()):
+        """
+        Returns `compute_prompt()`, cached while no gradients flow into the prompts.
+
+        The cache is keyed by the attached adapters and the storage and version of every prompt tensor and of
+        `extra_tensors`, so adding or deleting an adapter, loading weights, moving the model or an optimizer
+        step all invalidate it.
+        """
+        if torch.is_grad_enabled() and any(param.requires_grad for param in self.prompt_encoder.parameters()):
+            return compute_prompt()
+
+        tensors = itertools.chain(
+            *(itertools.chain(prompt_encoder.parameters(), prompt_encoder.buffers())
+              for prompt_encoder in self.prompt_encoder.values()),
+            extra_tensors,
+        )
+        versions = tuple((tensor.data_ptr(), tensor._version) for tensor in tensors)
+        cache_key = (tuple(self.prompt_encoder.keys()), versions)
+
+        cached = self._prompt_cache.get(key)
+        if cached is None or cached[0] != cache_key:
+            with torch.no_grad():
+                cached = (cache_key, compute_prompt())
+            self._prompt_cache[key] = cached
+        return cached[1]
+
+    def _get_routed_prompt(self, prompt_ids, dtype=None, adapter_name=None):
+        # several prompts of a row are fused with the config of `adapter_name`, the active adapter by default
+        prompt_config = self._peft_config[adapter_name or self.adapter_name]
+        num_virtual_tokens = self._get_num_virtual_tokens(adapter_name)
+
+        if prompt_ids.dim() == 1:
+            prompt_ids = prompt_ids.unsqueeze(1)
+        num_prompts = prompt_ids.shape[1]
+
+        # a row with one prompt uses it as a single attached prompt would, several prompts are fused
+        num_rows = num_virtual_tokens if num_prompts == 1 else prompt_config.num_virtual_tokens
+        sizes = {name: self._peft_config[name].num_virtual_tokens for name in self.prompt_encoder.keys()}
+        if len(set(sizes.values())) > 1:
+            raise ValueError(f'Prompts routed per row need the same number of virtual tokens, got {sizes}')
+        stacked_prompts = self._get_cached_prompt(('stacked', num_rows, dtype), lambda: torch.stack([
+            prompt_encoder.get_weight()[:num_rows] for prompt_encoder in self.prompt_encoder.values()
+        ]).to(dtype))
+        prompts = stacked_prompts[prompt_ids.to(stacked_prompts.device)]
+
+        if num_prompts == 1:
+            return prompts[:, 0]
+        elif prompt_config.fusion == 'avg':
+            return torch.mean(prompts, dim=1)
+        elif prompt_config.fusion == 'cat' or prompt_config.fusion == 'none':
+            return prompts.flatten(1, 2)[:, :num_virtual_tokens]
+        else:
+            raise ValueError(
+                f"Invalid fusion method: {prompt_config.fusion}")
 
     def __getattr__(self, name: str):
         """Forward missing attributes to the wrapped module."""
@@ -215,17 +381,24 @@ class PeftModel(PushToHubMixin, torch.nn.Module):
     def get_base_model(self):
         return self.base_model
 
-    def load_adapter(self, model_id, adapter_name='default', is_trainable=False, **kwargs):
+    def load_adapter(self, model_id, adapter_name='default', is_trainable=False, prompt_name=None, **kwargs):
         hf_hub_download_kwargs, kwargs = self._split_kwargs(kwargs)
         torch_device = infer_device()
 
         adapter_weights = load_adapter_weights(
-            model_id, device=torch_device, **hf_hub_download_kwargs)
+            model_id, device=torch_device, prompt_name=prompt_name or adapter_name, **hf_hub_download_kwargs)
+        # a trained prompt keeps a float32 master copy, a frozen one is stored in the dtype of the model
+        dtype = torch.float32 if is_trainable else self.word_embeddings.weight.dtype
+        # fp16 and int8 exports are dequantized here, once, when the prompt is attached
+        adapter_weights = dequantize_state_dict(adapter_weights, dtype=dtype)
         load_result = set_peft_model_state_dict(
             self, adapter_weights, adapter_name=adapter_name)
+        self.prompt_encoder[adapter_name].to(dtype)
         if (
             (getattr(self, 'hf_device_map', None) is not None)
             and (len(set(self.hf_device_map.values()).intersection({'cpu', 'disk'})) > 0)
+            # a base model executed on the CPU with offloaded weights already runs where the prompt encoder is
+            and (len(set(self.hf_device_map.values()) - {'cpu', 'disk'}) > 0)
             and len(self._peft_config) == 1
         ):
             device_map = kwargs.get('device_map', 'auto')
@@ -268,15 +441,20 @@ class PeftModel(PushToHubMixin, torch.nn.Module):
 
     def add_adapter(self, adapter_name, prompt_config):
         self._peft_config[adapter_name] = prompt_config
-        if hasattr(self.config, "to_dict"):
-            dict_config = self.config.to_dict()
-        else:
-            dict_config = self.config
-
         prompt_config = _prepare_prompt_learning_config(
-            prompt_config, dict_config)
+            prompt_config, self._resolve_backbone()['config'])
         self._setup_prompt_encoder(adapter_name)
 
+    def delete_adapter(self, adapter_name):
+        if adapter_name not in self._peft_config:
+            raise ValueError(f"Adapter {adapter_name} does not exist")
+        if adapter_name == self.adapter_name:
+            raise ValueError(f"Adapter {adapter_name} is the active adapter and can not be deleted")
+
+        del self._peft_config[adapter_name]
+        del self.prompt_encoder[adapter_name]
+        self._prompt_cache.clear()
+
     def prepare_inputs_for_generation(self, *args, **kwargs):
         model_kwargs = self.base_model_prepare_inputs_for_generation(
             *args, **kwargs)
@@ -290,10 +468,6 @@ class PromptTuningForSeq2SeqLM(PeftModel):
         super().__init__(model, peft_config, adapter_name=adapter_name)
 
         self.base_model_prepare_inputs_for_generation = self.base_model.prepare_inputs_for_generation
-        self._prepare_encoder_decoder_kwargs_for_generation = self.base_model._prepare_encoder_decoder_kwargs_for_generation
-        self.base_model_prepare_encoder_decoder_kwargs_for_generation = (
-            self.base_model._prepare_encoder_decoder_kwargs_for_generation
-        )
 
     def forward(
         self,
@@ -307,14 +481,12 @@ class PromptTuningForSeq2SeqLM(PeftModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
+        prompt_ids=None,
         **kwargs
     ):
-        prompt_config = self._peft_config[self.adapter_name]
         batch_size = _get_batch_size(input_ids, inputs_embeds)
 
-        num_virtual_tokens = prompt_config.num_virtual_tokens
-        if prompt_config.fusion == 'cat':
-            num_virtual_tokens *= 2
+        num_virtual_tokens = self._get_num_virtual_tokens()
 
         if decoder_attention_mask is not None:
             prefix_attention_mask = torch.ones(
@@ -339,11 +511,10 @@ class PromptTuningForSeq2SeqLM(PeftModel):
             kwargs["attention_mask"] = torch.cat(
                 (prefix_attention_mask, attention_mask), dim=1)
 
-        prompts = self.get_prompt(batch_size=batch_size)
-        prompts = prompts.to(inputs_embeds.dtype)
+        prompts = self.get_prompt(
+            batch_size=batch_size, prompt_ids=prompt_ids, dtype=inputs_embeds.dtype)
         inputs_embeds = torch.cat(
-            (prompts[:, :num_virtual_tokens], inputs_embeds), dim=1)
-        # logging.info(f"inputs_embeds: {inputs_embeds.shape}")
+            (prompts, inputs_embeds), dim=1)
 
         return self.base_model(
             inputs_embeds=inputs_embeds,
@@ -352,57 +523,98 @@ class PromptTuningForSeq2SeqLM(PeftModel):
             **kwargs
         )
 
-    def generate(self, **kwargs):
-        prompt_config = self._peft_config[self.adapter_name]
-        self.base_model.prepare_inputs_for_generation = self.prepare_inputs_for_generation
-        self.base_model._prepare_encoder_decoder_kwargs_for_generation = (
-            self.base_model_prepare_encoder_decoder_kwargs_for_generation
-        )
-        try:
-            if 'input_ids' not in kwargs and 'inputs_embeds' in kwargs:
-                return self.base_model.generate(**kwargs)
+    def get_prompted_inputs(self, input_ids=None, attention_mask=None, inputs_embeds=None, prompt_ids=None):
+        """
+        Returns the encoder inputs with the prompts prepended and the attention mask extended to cover them.
 
-            # kwargs['position_ids'] = None
-            # kwargs['token_type_ids'] = None
+        Prompts of wrapped `PromptTuningForSeq2SeqLM` models are prepended too, as `forward` does when it
+        calls the wrapped model.
+        """
+        if inputs_embeds is None:
+            inputs_embeds = self.word_embeddings(input_ids)
+        batch_size = inputs_embeds.shape[0]
 
-            num_virtual_tokens = prompt_config.num_virtual_tokens
-            if prompt_config.fusion == 'cat':
-                num_virtual_tokens *= 2
+        if attention_mask is not None:
+            prefix_attention_mask = torch.ones(batch_size, self._get_num_virtual_tokens()).to(
+                attention_mask.device
+            )
+            attention_mask = torch.cat(
+                (prefix_attention_mask, attention_mask), dim=1)
 
-            kwargs = deepcopy(kwargs)
+        prompts = self.get_prompt(
+            batch_size=batch_size, prompt_ids=prompt_ids, dtype=inputs_embeds.dtype)
+        inputs_embeds = torch.cat(
+            (prompts, inputs_embeds), dim=1)
 
-            if 'encoder_outputs' in kwargs:
-                del kwargs['encoder_outputs']
+        if isinstance(self.base_model, PromptTuningForSeq2SeqLM):
+            return self.base_model.get_prompted_inputs(
+                attention_mask=attention_mask, inputs_embeds=inputs_embeds)
+        return inputs_embeds, attention_mask
 
-            input_ids = kwargs.pop('input_ids', None)
-            inputs_embeds = self.word_embeddings(input_ids)
-            batch_size = inputs_embeds.shape[0]
-            prompts = self.get_prompt(batch_size=batch_size)
-            prompts = prompts.to(inputs_embeds.dtype)
+    def get_transformer_model(self):
+        model = self.base_model
+        while isinstance(model, PeftModel):
+            model = model.base_model
+        return model
 
-            inputs_embeds = torch.cat(
-                (prompts[:, :num_virtual_tokens], inputs_embeds), dim=1)
-            kwargs['inputs_embeds'] = inputs_embeds
+    def encode(self, input_ids=None, attention_mask=None, prompt_ids=None, **kwargs):
+        """
+        Runs the encoder over the prompted inputs once.
 
-            if 'attention_mask' in kwargs:
-                prefix_attention_mask = torch.ones(batch_size, num_virtual_tokens).to(
-                    kwargs['attention_mask'].device
-                )
-                kwargs['attention_mask'] = torch.cat(
-                    (prefix_attention_mask, kwargs['attention_mask']), dim=1)
-            return self.base_model.generate(**kwargs)
-        except:
-            self.base_model.prepare_inputs_for_generation = self.base_model_prepare_inputs_for_generation
-            self.base_model._prepare_encoder_decoder_kwargs_for_generation = (
-                self.base_model_prepare_encoder_decoder_kwargs_for_generation
-            )
-            raise
-        else:
-            self.base_model.prepare_inputs_for_generation = self.base_model_prepare_inputs_for_generation
-            self.base_model._prepare_encoder_decoder_kwargs_for_generation = (
-                self.base_model_prepare_encoder_decoder_kwargs_for_generation
-            )
-            return outputs
+        Returns the encoder outputs and the extended attention mask, which can be passed to `generate` of the
+        transformer model as `encoder_outputs` and `attention_mask`.
+        """
+        inputs_embeds, attention_mask = self.get_prompted_inputs(
+            input_ids=input_ids, attention_mask=attention_mask, prompt_ids=prompt_ids)
+
+        model = self.get_transformer_model()
+        # the model's own helper also sets up the adapters forward context and accelerate device hooks
+        model_kwargs = model._prepare_encoder_decoder_kwargs_for_generation(
+            inputs_embeds, {'attention_mask': attention_mask, **kwargs}, 'inputs_embeds')
+        return model_kwargs['encoder_outputs'], attention_mask
+
+    def _split_generate_kwargs(self, kwargs):
+        kwargs = dict(kwargs)
+        kwargs.pop('encoder_outputs', None)
+        encode_kwargs = {
+            'input_ids': kwargs.pop('input_ids', None),
+            'attention_mask': kwargs.pop('attention_mask', None),
+            'prompt_ids': kwargs.pop('prompt_ids', None),
+        }
+        return encode_kwargs, kwargs
+
+    def generate(self, **kwargs):
+        if 'input_ids' not in kwargs and 'inputs_embeds' in kwargs:
+            return self.get_transformer_model().generate(**kwargs)
+
+        encode_kwargs, kwargs = self._split_generate_kwargs(kwargs)
+        encoder_outputs, attention_mask = self.encode(**encode_kwargs)
+        return self.get_transformer_model().generate(
+            encoder_outputs=encoder_outputs, attention_mask=attention_mask, **kwargs)
+
+    def generate_many(self, generation_kwargs, **kwargs):
+        """
+        Generates with several decoding configurations, e.g. `[{'num_beams': 1}, {'num_beams': 4}]`, for the
+        same inputs. The prompted inputs are encoded once and the encoder outputs are reused by every run.
+
+        `kwargs` are the inputs and the generation arguments shared by all runs, one output is returned per
+        entry of `generation_kwargs`.
+        """
+        encode_kwargs, kwargs = self._split_generate_kwargs(kwargs)
+        encoder_outputs, attention_mask = self.encode(**encode_kwargs)
+
+        model = self.get_transformer_model()
+        outputs = []
+        for run_kwargs in generation_kwargs:
+            if isinstance(run_kwargs, GenerationConfig):
+                run_kwargs = {'generation_config': run_kwargs}
+            # beam search expands the tensors of the encoder outputs in place, every run gets its own container
+            outputs.append(model.generate(
+                encoder_outputs=encoder_outputs.__class__(**encoder_outputs),
+                attention_mask=attention_mask,
+                **{**kwargs, **run_kwargs},
+            ))
+        return outputs
 
     def prepare_inputs_for_generation(self, *args, **kwargs):
         model_kwargs = self.base_model_prepare_inputs_for_generation(
@@ -427,12 +639,9 @@ class PeftModelForCausalLM(PeftModel):
         return_dict=None,
         **kwargs,
     ):
-        prompt_config = self._peft_config[self.adapter_name]
         batch_size = _get_batch_size(input_ids, inputs_embeds)
 
-        num_virtual_tokens = prompt_config.num_virtual_tokens
-        if prompt_config.fusion == 'cat':
-            num_virtual_tokens *= 2
+        num_virtual_tokens = self._get_num_virtual_tokens()
 
         if attention_mask is not None:
             prefix_attention_mask = torch.ones(
@@ -459,8 +668,7 @@ class PeftModelForCausalLM(PeftModel):
             kwargs['labels'] = torch.cat(
                 (prefix_labels, labels), dim=1)
 
-        prompts = self.get_prompt(batch_size=batch_size)
-        prompts = prompts.to(inputs_embeds.dtype)
+        prompts = self.get_prompt(batch_size=batch_size, dtype=inputs_embeds.dtype)
         inputs_embeds = torch.cat(
             (prompts, inputs_embeds), dim=1)
         return self.base_model(
@@ -469,6 +677,17 @@ class PeftModelForCausalLM(PeftModel):
         )
 
     def generate(self, **kwargs):
+        # the attention mask covers the virtual tokens, so the base model derives the position ids of the
+        # inputs and of every generated token from it
+        kwargs = dict(kwargs)
+        input_ids = kwargs['input_ids']
+        attention_mask = kwargs.get('attention_mask', None)
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        prefix_attention_mask = torch.ones(
+            input_ids.shape[0], self._get_num_virtual_tokens(), dtype=attention_mask.dtype).to(attention_mask.device)
+        kwargs['attention_mask'] = torch.cat((prefix_attention_mask, attention_mask), dim=1)
+
         self.base_model.prepare_inputs_for_generation = self.prepare_inputs_for_generation
         if hasattr(self.base_model, 'model'):
             self.base_model.model.generation_config = self.generation_config
@@ -483,15 +702,65 @@ class PeftModelForCausalLM(PeftModel):
             self.base_model.prepare_inputs_for_generation = self.base_model_prepare_inputs_for_generation
             return outputs
 
+    def get_prefix_key_values(self, dtype=None):
+        """
+        Returns the key/value cache of the virtual tokens for a batch of one, computed by running the base
+        model over the prompt once.
+
+        The cache is stored like the fused prompt (see `_get_cached_prompt`), it is also invalidated when
+        a trainable parameter of the base model changes. None is returned for models whose cache does not
+        have the batch as its first dimension.
+        """
+        base_parameters = [param for param in self.base_model.parameters() if param.requires_grad]
+
+        def compute_prefix_key_values():
+            prompts = self.get_prompt(batch_size=1, dtype=dtype)
+            outputs = self.base_model(inputs_embeds=prompts, use_cache=True, return_dict=True)
+            return outputs.past_key_values
+
+        past_key_values = self._get_cached_prompt(
+            ('prefix_key_values', dtype), compute_prefix_key_values, extra_tensors=base_parameters)
+        if any(tensor.shape[0] != 1 for layer in past_key_values for tensor in layer):
+            return None
+        return past_key_values
+
     def prepare_inputs_for_generation(self, *args, **kwargs):
-        prompt_config = self._peft_config[self.adapter_name]
+        past_key_values = kwargs.get("past_key_values", None)
+        if past_key_values is not None:
+            # the cache holds the virtual tokens, the attention mask and position ids already cover them
+            return self.base_model_prepare_inputs_for_generation(*args, **kwargs)
+
+        input_ids = args[0] if args else kwargs["input_ids"]
+        inputs_embeds = self.word_embeddings(input_ids[:, :1])
+        prefix_key_values = self.get_prefix_key_values(dtype=inputs_embeds.dtype)
+        if prefix_key_values is None or kwargs.get("attention_mask", None) is None:
+            return self._prepare_prompted_inputs_for_generation(*args, **kwargs)
+
+        model_kwargs = self.base_model_prepare_inputs_for_generation(*args, **kwargs)
+        if model_kwargs.get("position_ids", None) is not None:
+            model_kwargs["position_ids"] = model_kwargs["position_ids"][:, -input_ids.shape[1]:]
+
+        if kwargs.get("token_type_ids", None) is not None:
+            model_kwargs["token_type_ids"] = None
+
+        # rows are expanded by beam search and sampling before the first step, the prefix is broadcast to them
+        batch_size = input_ids.shape[0]
+        model_kwargs["past_key_values"] = tuple(
+            tuple(tensor.expand(batch_size, *tensor.shape[1:]) for tensor in layer)
+            for layer in prefix_key_values
+        )
+        return model_kwargs
+
+    def _prepare_prompted_inputs_for_generation(self, *args, **kwargs):
+        # prepends the prompt to the inputs, used when the prefix can not be passed as a cache
+        num_virtual_tokens = self._get_num_virtual_tokens()
+        attention_mask = kwargs.get("attention_mask", None)
+        if attention_mask is not None:
+            kwargs["attention_mask"] = attention_mask[:, num_virtual_tokens:]
+
         model_kwargs = self.base_model_prepare_inputs_for_generation(
             *args, **kwargs)
 
-        num_virtual_tokens = prompt_config.num_virtual_tokens
-        if prompt_config.fusion == 'cat':
-            num_virtual_tokens *= 2
-
         if model_kwargs.get("attention_mask", None) is not None:
             size = model_kwargs["input_ids"].shape[0], num_virtual_tokens
             prefix_attention_mask = torch.ones(size).to(
@@ -506,14 +775,12 @@ class PeftModelForCausalLM(PeftModel):
         if kwargs.get("token_type_ids", None) is not None:
             model_kwargs["token_type_ids"] = None
 
-        if model_kwargs["past_key_values"] is None:
-            inputs_embeds = self.word_embeddings(model_kwargs["input_ids"])
-            prompts = self.get_prompt(
-                batch_size=model_kwargs["input_ids"].shape[0])
-            prompts = prompts.to(inputs_embeds.dtype)
-            model_kwargs["inputs_embeds"] = torch.cat(
-                (prompts, inputs_embeds), dim=1)
-            model_kwargs["input_ids"] = None
+        inputs_embeds = self.word_embeddings(model_kwargs["input_ids"])
+        prompts = self.get_prompt(
+            batch_size=model_kwargs["input_ids"].shape[0], dtype=inputs_embeds.dtype)
+        model_kwargs["inputs_embeds"] = torch.cat(
+            (prompts, inputs_embeds), dim=1)
+        model_kwargs["input_ids"] = None
 
         return model_kwargs
 
@@ -548,14 +815,11 @@ class PeftModelForQuestionAnswering(PeftModel):
         return_dict=None,
         **kwargs,
     ):
-        prompt_config = self._peft_config[self.adapter_name]
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
         batch_size = _get_batch_size(input_ids, inputs_embeds)
 
-        num_virtual_tokens = prompt_config.num_virtual_tokens
-        if prompt_config.fusion == 'cat':
-            num_virtual_tokens *= 2
+        num_virtual_tokens = self._get_num_virtual_tokens()
 
         if attention_mask is not None:
             prefix_attention_mask = torch.ones(
@@ -587,7 +851,6 @@ class PeftModelForQuestionAnswering(PeftModel):
         if inputs_embeds is None:
             inputs_embeds = self.word_embeddings(input_ids)
 
-        prompts = self.get_prompt(batch_size=batch_size)
-        prompts = prompts.to(inputs_embeds.dtype)
+        prompts = self.get_prompt(batch_size=batch_size, dtype=inputs_embeds.dtype)
         inputs_embeds = torch.cat((prompts, inputs_embeds), dim=1)
         return self.base_model(inputs_embeds=inputs_embeds, **kwargs)
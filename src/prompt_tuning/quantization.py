@@ -0,0 +1,50 @@
+import torch
+
+PROMPT_KEY = 'prompt_embeddings'
+SCALE_SUFFIX = '_scale'
+QUANTIZATION_TYPES = ('float16', 'int8')
+
+
+def quantize_prompt(prompt, quantization):
+    """
+    Quantizes a `[num_rows, token_dim]` prompt for export.
+
+    `float16` returns the prompt cast to half precision and no scales. `int8` quantizes every row
+    symmetrically with its own scale, `prompt ≈ quantized * scale` with a `[num_rows, 1]` float32 scale.
+    """
+    prompt = prompt.detach().float()
+    if quantization == 'float16':
+        return prompt.half(), None
+    if quantization == 'int8':
+        scale = prompt.abs().amax(dim=-1, keepdim=True).clamp(min=torch.finfo(torch.float32).tiny) / 127
+        quantized = torch.round(prompt / scale).clamp(-127, 127).to(torch.int8)
+        return quantized, scale
+    raise ValueError(f"Unknown prompt quantization '{quantization}', expected one of {QUANTIZATION_TYPES}")
+
+
+def dequantize_prompt(prompt, scale=None, dtype=torch.float32):
+    if scale is not None:
+        return (prompt.float() * scale.float()).to(dtype)
+    return prompt.to(dtype)
+
+
+def quantize_state_dict(state_dict, quantization=None):
+    if quantization is None:
+        return state_dict
+
+    state_dict = dict(state_dict)
+    prompt, scale = quantize_prompt(state_dict[PROMPT_KEY], quantization)
+    state_dict[PROMPT_KEY] = prompt
+    if scale is not None:
+        state_dict[PROMPT_KEY + SCALE_SUFFIX] = scale
+    return state_dict
+
+
+def dequantize_state_dict(state_dict, dtype=torch.float32):
+    """
+    Returns the state dict with the prompt dequantized into `dtype` and the scales removed.
+    """
+    state_dict = dict(state_dict)
+    scale = state_dict.pop(PROMPT_KEY + SCALE_SUFFIX, None)
+    state_dict[PROMPT_KEY] = dequantize_prompt(state_dict[PROMPT_KEY], scale, dtype=dtype)
+    return state_dict
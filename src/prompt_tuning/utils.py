@@ -5,8 +5,14 @@ import os
 from contextlib import nullcontext
 import accelerate
 from accelerate.hooks import add_hook_to_module, remove_hook_from_module
+from huggingface_hub import hf_hub_download
+from huggingface_hub.utils import EntryNotFoundError
+from safetensors import safe_open
+
+from prompt_tuning.bank import is_prompt_bank, open_prompt_bank
 
 WEIGHTS_NAME = 'adapter_model.bin'
+SAFETENSORS_WEIGHTS_NAME = 'adapter_model.safetensors'
 
 
 def _prepare_prompt_learning_config(prompt_config, model_config):
@@ -68,7 +74,7 @@ def get_peft_model_state_dict(model, state_dict=None, adapter_name='default'):
 
     to_return = {}
     if config.inference_mode:
-        prompt_embeddings = model.prompt_encoder[adapter_name].embeddings.weight
+        prompt_embeddings = model.prompt_encoder[adapter_name].get_weight()
     else:
         prompt_embeddings = model.get_prompt_embedding_to_save(
             adapter_name)
@@ -93,9 +99,8 @@ def set_peft_model_state_dict(model, peft_model_state_dict, adapter_name='defaul
 
     peft_model_state_dict = state_dict
     load_result = model.load_state_dict(peft_model_state_dict, strict=False)
-    model.prompt_encoder[adapter_name].embeddings.load_state_dict(
-        {"weight": peft_model_state_dict["prompt_embeddings"]}, strict=True
-    )
+    model.prompt_encoder[adapter_name].set_weight(
+        peft_model_state_dict["prompt_embeddings"])
     return load_result
 
 
@@ -106,12 +111,43 @@ def infer_device():
         return "cpu"
 
 
-def load_adapter_weights(model_id, device=None):
+def load_weights_file(filename, device='cpu'):
+    """
+    Loads a state dict from a safetensors file, or from a `torch.save` file without unpickling objects.
+    """
+    if filename.endswith('.safetensors'):
+        with safe_open(filename, framework='pt', device=str(device)) as f:
+            return {key: f.get_tensor(key) for key in f.keys()}
+
+    try:
+        return torch.load(filename, map_location=device, weights_only=True, mmap=True)
+    except RuntimeError:
+        # files written before the zip serialization can not be memory-mapped
+        return torch.load(filename, map_location=device, weights_only=True)
+
+
+def get_weights_file(model_id, **hf_hub_download_kwargs):
+    if os.path.isdir(model_id):
+        if os.path.isfile(os.path.join(model_id, SAFETENSORS_WEIGHTS_NAME)):
+            return os.path.join(model_id, SAFETENSORS_WEIGHTS_NAME)
+        return os.path.join(model_id, WEIGHTS_NAME)
+
+    try:
+        return hf_hub_download(model_id, SAFETENSORS_WEIGHTS_NAME, **hf_hub_download_kwargs)
+    except EntryNotFoundError:
+        return hf_hub_download(model_id, WEIGHTS_NAME, **hf_hub_download_kwargs)
+
+
+def load_adapter_weights(model_id, device=None, prompt_name=None, **hf_hub_download_kwargs):
     if device is None:
         device = infer_device()
 
-    adapter_weights = torch.load(os.path.join(
-        model_id, WEIGHTS_NAME), map_location=device)
+    if is_prompt_bank(model_id):
+        prompt_bank = open_prompt_bank(model_id)
+        return prompt_bank.get_state_dict(prompt_name, device=device)
+
+    adapter_weights = load_weights_file(
+        get_weights_file(model_id, **hf_hub_download_kwargs), device=device)
     return adapter_weights
 
 
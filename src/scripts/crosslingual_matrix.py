@@ -0,0 +1,394 @@
+"""
+Evaluates the cross-lingual matrix of `scripts/crosslingual.py` in one process, e.g.
+
+python -m scripts.crosslingual_matrix --trained_language english --test_languages czech slovak --task qa
+
+The backbone and the tokenizer are loaded once. Adapters are loaded into the backbone the first time a cell
+needs them and only activated per cell, prompts are attached to the backbone per cell. The test set of a
+language is tokenized once and shared by all configurations, and the next language is loaded and tokenized
+in the background while the cells of the current one run. All metrics are written into one csv table.
+
+With `--num_workers`, the cells run in a pool of CPU processes. The backbone weights are loaded once into shared
+memory and every worker maps them read-only into its own model, on which it attaches the prompts and adapters of
+its cells. The CPU threads are split evenly between the workers.
+
+With `--batch_split`, the cells made of adapters only run for all test languages together: the test sets share
+batches and every row is routed to the adapters of its cell with a `BatchSplit` setup (see
+`task_modeling/batch_split.py`).
+"""
+import argparse
+import csv
+import os
+import re
+import time
+import torch
+import torch.multiprocessing as mp
+import adapters
+from adapters import AdapterConfig, Stack
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from transformers import (
+    AutoConfig, AutoModelForSeq2SeqLM, AutoTokenizer, DataCollatorForSeq2Seq, Seq2SeqTrainingArguments
+)
+from transformers.trainer_utils import PredictionOutput
+
+from prompt_tuning.prompt_tuning import PromptTuningForSeq2SeqLM
+from scripts.crosslingual import get_dataset_from_language
+from task_modeling.adapter_weights import use_safetensors_weights
+from task_modeling.args import DataTrainingArguments, ModelArguments
+from task_modeling.batch_split import BatchSplitGenerator
+from task_modeling.trainer_seq2seq_qa import QuestionAnsweringSeq2SeqTrainer
+from task_modeling.utils import get_model, get_path
+from tasks import dataset_factory
+from tasks.utils import convert_language
+
+os.environ['WANDB_MODE'] = 'disabled'
+
+CONFIGURATIONS = [
+    'inference', 'adapter', 'prompt', 'adapter_adapter', 'adapter_prompt', 'prompt_adapter', 'prompt_prompt',
+]
+# configurations whose modules are all adapters, their cells can share batches with --batch_split
+BATCH_SPLIT_CONFIGURATIONS = ['adapter', 'adapter_adapter']
+
+
+def get_cell_modules(configuration, language, trained_language, trained_dataset_name, results_dir):
+    """
+    Returns the language and the task module of a cell as `(type, path)` or None, with the paths of
+    `scripts/crosslingual.py`.
+    """
+    trained_lang_code = convert_language(trained_language)
+
+    if configuration == 'inference':
+        return None, None
+    if configuration == 'adapter':
+        return None, ('adapter', f'{results_dir}/{trained_dataset_name}_{trained_lang_code}_adapter_100k/{trained_dataset_name}')
+    if configuration == 'prompt':
+        return None, ('prompt', f'{results_dir}/{trained_dataset_name}_{trained_lang_code}_prompt_100k/{trained_dataset_name}_prompt')
+
+    language_type, task_type = configuration.split('_')
+    task_dir = trained_dataset_name if task_type == 'adapter' else f'{trained_dataset_name}_prompt'
+    return (
+        (language_type, f'ivykopal/{language}_{language_type}_100k'),
+        (task_type, f'{results_dir}/{trained_language}_{language_type}_{trained_dataset_name}_{task_type}_100k/{task_dir}'),
+    )
+
+
+def load_shared_model(model_name_or_path, state_dict):
+    """
+    Builds the model around the tensors of a state dict, e.g. in shared memory, without copying them.
+    """
+    with torch.device('meta'):
+        model = AutoModelForSeq2SeqLM.from_config(AutoConfig.from_pretrained(model_name_or_path))
+    model.load_state_dict(state_dict, assign=True)
+    missing = [name for name, tensor in model.state_dict().items() if tensor.is_meta]
+    if missing:
+        raise ValueError(f'The shared state dict has no tensors for {missing[:10]}')
+    return model.eval()
+
+
+class MatrixEvaluator:
+    def __init__(self, model_name_or_path, output_dir, per_device_eval_batch_size=32, max_seq_length=256,
+                 max_answer_length=30, max_predict_samples=None, eval_token_budget=None, model=None, use_cpu=False):
+        self.max_answer_length = max_answer_length
+        self.max_predict_samples = max_predict_samples
+        self.eval_token_budget = eval_token_budget
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+        # test sets are tokenized in a background thread, a fast tokenizer can not be shared between threads
+        self.preprocess_tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+        self.max_seq_length = min(max_seq_length, self.tokenizer.model_max_length)
+
+        if model is None:
+            model_args = ModelArguments(model_name_or_path=model_name_or_path)
+            model = get_model(model_args, AutoConfig.from_pretrained(model_name_or_path))
+            model.to(torch.device('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.model = model
+        adapters.init(self.model)
+        self.adapter_names = {}
+
+        self.training_args = Seq2SeqTrainingArguments(
+            output_dir=output_dir,
+            per_device_eval_batch_size=per_device_eval_batch_size,
+            predict_with_generate=True,
+            report_to=[],
+            use_cpu=use_cpu,
+        )
+        self._test_sets = {}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _load_test_set(self, dataset_name, language):
+        dataset = dataset_factory(dataset_name=dataset_name, language=language)
+        data_args = DataTrainingArguments(
+            dataset_name=dataset_name,
+            max_seq_length=self.max_seq_length,
+            max_answer_length=self.max_answer_length,
+            pad_to_max_length=self.eval_token_budget is None,
+        )
+
+        predict_examples = dataset.get_dataset('test')
+        if self.max_predict_samples is not None:
+            predict_examples = predict_examples.select(range(min(len(predict_examples), self.max_predict_samples)))
+        predict_dataset = predict_examples.map(
+            partial(dataset.preprocess_validation_function, tokenizer=self.preprocess_tokenizer,
+                    data_args=data_args, max_seq_length=self.max_seq_length),
+            batched=True,
+            remove_columns=dataset.get_columns('test'),
+            desc=f'Running tokenizer on {dataset_name} {language}',
+        )
+        if self.max_predict_samples is not None:
+            predict_dataset = predict_dataset.select(range(min(len(predict_dataset), self.max_predict_samples)))
+
+        return {
+            'dataset': dataset,
+            'predict_examples': predict_examples,
+            'predict_dataset': predict_dataset,
+            'metric': dataset.get_metric(),
+        }
+
+    def prefetch(self, dataset_name, language):
+        if (dataset_name, language) not in self._test_sets:
+            self._test_sets[(dataset_name, language)] = self._executor.submit(
+                self._load_test_set, dataset_name, language)
+
+    def get_test_set(self, dataset_name, language):
+        self.prefetch(dataset_name, language)
+        return self._test_sets[(dataset_name, language)].result()
+
+    def release_test_set(self, dataset_name, language):
+        self._test_sets.pop((dataset_name, language), None)
+
+    def _load_adapter(self, path):
+        if path not in self.adapter_names:
+            adapter_path = get_path(path)
+            # adapters of different cells are often saved under the same name, they are loaded under their path
+            name = re.sub(r'\W', '_', path)
+            self.model.load_adapter(
+                adapter_path, config=AdapterConfig.load(f'{adapter_path}/adapter_config.json'), load_as=name)
+            self.adapter_names[path] = name
+        return self.adapter_names[path]
+
+    def get_cell_model(self, language_module, task_module, language, dataset_name):
+        """
+        Activates the adapters of a cell on the backbone and attaches its prompts as `task_modeling.run` does.
+        """
+        modules = [module for module in (language_module, task_module) if module is not None]
+        adapter_names = [self._load_adapter(path) for type, path in modules if type == 'adapter']
+        if len(adapter_names) > 1:
+            self.model.set_active_adapters(Stack(*adapter_names))
+        else:
+            self.model.set_active_adapters(adapter_names[0] if adapter_names else None)
+
+        model = self.model
+        for module, adapter_name in ((language_module, f'{language}_prompt'), (task_module, f'{dataset_name}_prompt')):
+            if module is not None and module[0] == 'prompt':
+                model = PromptTuningForSeq2SeqLM.from_pretrained(
+                    model, get_path(module[1], type='prompt'), adapter_name=adapter_name)
+        return model
+
+    def evaluate_cell(self, model, test_set):
+        # the adapter and prompt trainers only differ from this one in saving and loading
+        trainer = QuestionAnsweringSeq2SeqTrainer(
+            model=model,
+            args=self.training_args,
+            tokenizer=self.tokenizer,
+            data_collator=DataCollatorForSeq2Seq(self.tokenizer, model=self.model, label_pad_token_id=-100),
+            compute_metrics=lambda p: test_set['metric'].compute(predictions=p.predictions, references=p.label_ids),
+            post_process_function=partial(test_set['dataset'].post_processing_function, tokenizer=self.tokenizer),
+            eval_token_budget=self.eval_token_budget,
+        )
+        return trainer.predict(test_set['predict_dataset'], test_set['predict_examples']).metrics
+
+    def run_cell(self, cell, trained_language, trained_dataset_name, results_dir):
+        dataset_name, language, configuration = cell
+        language_module, task_module = get_cell_modules(
+            configuration, language, trained_language, trained_dataset_name, results_dir)
+        start = time.perf_counter()
+        test_set = self.get_test_set(dataset_name, language)
+        model = self.get_cell_model(language_module, task_module, language, dataset_name)
+        metrics = self.evaluate_cell(model, test_set)
+        print(f'{language} {configuration}: {metrics}')
+        return {
+            'trained_language': trained_language,
+            'test_language': language,
+            'dataset': dataset_name,
+            'configuration': configuration,
+            **metrics,
+            'cell_runtime': time.perf_counter() - start,
+        }
+
+    def run_batch_split_cells(self, cells, trained_language, trained_dataset_name, results_dir):
+        """
+        Evaluates cells with the same number of adapters in shared batches, each row with the adapters of its cell.
+
+        The generation time of the shared batches is split between the cells by their number of features.
+        """
+        start = time.perf_counter()
+        setups, test_sets = [], []
+        for dataset_name, language, configuration in cells:
+            modules = [
+                module for module in get_cell_modules(
+                    configuration, language, trained_language, trained_dataset_name, results_dir)
+                if module is not None
+            ]
+            if any(type != 'adapter' for type, _ in modules):
+                raise ValueError(f'Only cells of adapters can be batch split, not {configuration}')
+            setups.append(tuple(self._load_adapter(path) for _, path in modules))
+            test_sets.append(self.get_test_set(dataset_name, language))
+
+        outputs = BatchSplitGenerator(self.model).predict(
+            [test_set['predict_dataset'] for test_set in test_sets], setups, self.tokenizer,
+            self.training_args.per_device_eval_batch_size)
+        runtime = time.perf_counter() - start
+        num_features = sum(len(test_set['predict_dataset']) for test_set in test_sets)
+
+        rows = []
+        for (dataset_name, language, configuration), test_set, (predictions, label_ids) in zip(
+                cells, test_sets, outputs):
+            predictions = test_set['dataset'].post_processing_function(
+                test_set['predict_examples'], test_set['predict_dataset'],
+                PredictionOutput(predictions=predictions, label_ids=label_ids, metrics=None), 'predict',
+                tokenizer=self.tokenizer)
+            metrics = test_set['metric'].compute(predictions=predictions.predictions, references=predictions.label_ids)
+            metrics = {f'test_{key}': value for key, value in metrics.items()}
+            print(f'{language} {configuration}: {metrics}')
+            rows.append({
+                'trained_language': trained_language,
+                'test_language': language,
+                'dataset': dataset_name,
+                'configuration': configuration,
+                **metrics,
+                'cell_runtime': runtime * len(test_set['predict_dataset']) / num_features,
+            })
+        return rows
+
+
+_worker_evaluator = None
+
+
+def init_worker(model_name_or_path, state_dict, num_threads, evaluator_kwargs):
+    global _worker_evaluator
+    use_safetensors_weights()
+    torch.set_num_threads(num_threads)
+    model = load_shared_model(model_name_or_path, state_dict)
+    _worker_evaluator = MatrixEvaluator(model_name_or_path, model=model, **evaluator_kwargs)
+
+
+def run_worker_cell(cell, trained_language, trained_dataset_name, results_dir):
+    # a worker moves on to the next language once the cells of the previous one are taken
+    for dataset_name, language in list(_worker_evaluator._test_sets):
+        if (dataset_name, language) != cell[:2]:
+            _worker_evaluator.release_test_set(dataset_name, language)
+    return _worker_evaluator.run_cell(cell, trained_language, trained_dataset_name, results_dir)
+
+
+def run_pool(args, cells, trained_dataset_name, results_dir, evaluator_kwargs, output_file):
+    """
+    Runs the cells in `args.num_workers` processes sharing one copy of the backbone weights.
+    """
+    num_threads = max(1, len(os.sched_getaffinity(0)) // args.num_workers)
+    model = get_model(ModelArguments(model_name_or_path=args.model_name_or_path),
+                      AutoConfig.from_pretrained(args.model_name_or_path))
+    # moves the weights into shared memory, the workers receive handles to them instead of copies
+    state_dict = {name: tensor.share_memory_() for name, tensor in model.state_dict().items()}
+
+    context = mp.get_context('spawn')
+    rows = []
+    with context.Pool(
+        args.num_workers,
+        initializer=init_worker,
+        initargs=(args.model_name_or_path, state_dict, num_threads, {**evaluator_kwargs, 'use_cpu': True}),
+    ) as pool:
+        run_cell = partial(
+            run_worker_cell, trained_language=args.trained_language, trained_dataset_name=trained_dataset_name,
+            results_dir=results_dir)
+        # the cells of a language follow each other, so the workers mostly reuse the test sets they tokenized
+        for row in pool.imap_unordered(run_cell, cells):
+            rows.append(row)
+            write_results(sort_rows(rows), output_file)
+    return sort_rows(rows)
+
+
+def sort_rows(rows):
+    return sorted(rows, key=lambda row: (row['test_language'], CONFIGURATIONS.index(row['configuration'])))
+
+
+def write_results(rows, output_file):
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+    with open(output_file, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('In-process cross-lingual evaluation matrix')
+    parser.add_argument('--model_name_or_path', type=str, default='bigscience/mt0-base')
+    parser.add_argument('--trained_language', type=str, default='english')
+    parser.add_argument('--test_languages', nargs='+', type=str, default=['czech'])
+    parser.add_argument('--task', type=str, default='qa')
+    parser.add_argument('--configurations', nargs='+', type=str, default=CONFIGURATIONS, choices=CONFIGURATIONS)
+    parser.add_argument('--results_dir', type=str, default=None,
+                        help='Directory with the trained adapters and prompts, ../results/{task} by default')
+    parser.add_argument('--output_file', type=str, default=None)
+    parser.add_argument('--per_device_eval_batch_size', type=int, default=32)
+    parser.add_argument('--max_seq_length', type=int, default=256)
+    parser.add_argument('--max_answer_length', type=int, default=30)
+    parser.add_argument('--max_predict_samples', type=int, default=None)
+    parser.add_argument('--eval_token_budget', type=int, default=None)
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='Number of CPU processes evaluating cells in parallel on one shared copy of the backbone')
+    parser.add_argument('--batch_split', action='store_true',
+                        help='Evaluate the adapter cells of all test languages together in shared batches')
+    args = parser.parse_args()
+    use_safetensors_weights()
+    if args.batch_split and args.num_workers > 1:
+        parser.error('--batch_split runs in a single process, it can not be combined with --num_workers')
+
+    results_dir = args.results_dir or f'../results/{args.task}'
+    output_file = args.output_file or f'{results_dir}/inference/{args.trained_language}_matrix.csv'
+    trained_dataset_name = get_dataset_from_language(args.trained_language, args.task)
+
+    evaluator_kwargs = dict(
+        output_dir=f'{results_dir}/inference/{args.trained_language}',
+        per_device_eval_batch_size=args.per_device_eval_batch_size,
+        max_seq_length=args.max_seq_length,
+        max_answer_length=args.max_answer_length,
+        max_predict_samples=args.max_predict_samples,
+        eval_token_budget=args.eval_token_budget,
+    )
+    datasets = [(get_dataset_from_language(language, args.task), language) for language in args.test_languages]
+    cells = [
+        (dataset_name, language, configuration)
+        for dataset_name, language in datasets for configuration in args.configurations
+    ]
+
+    start = time.perf_counter()
+    if args.num_workers > 1:
+        rows = run_pool(args, cells, trained_dataset_name, results_dir, evaluator_kwargs, output_file)
+    else:
+        evaluator = MatrixEvaluator(args.model_name_or_path, **evaluator_kwargs)
+        rows = []
+        configurations = args.configurations
+        if args.batch_split:
+            for configuration in [c for c in configurations if c in BATCH_SPLIT_CONFIGURATIONS]:
+                rows.extend(evaluator.run_batch_split_cells(
+                    [(dataset_name, language, configuration) for dataset_name, language in datasets],
+                    args.trained_language, trained_dataset_name, results_dir))
+                write_results(sort_rows(rows), output_file)
+            configurations = [c for c in configurations if c not in BATCH_SPLIT_CONFIGURATIONS]
+
+        for i, (dataset_name, language) in enumerate(datasets):
+            evaluator.get_test_set(dataset_name, language)
+            if i + 1 < len(datasets):
+                evaluator.prefetch(*datasets[i + 1])
+
+            for configuration in configurations:
+                rows.append(evaluator.run_cell(
+                    (dataset_name, language, configuration), args.trained_language, trained_dataset_name,
+                    results_dir))
+                write_results(sort_rows(rows), output_file)
+
+            evaluator.release_test_set(dataset_name, language)
+
+    print(f'Saved {len(rows)} cells to {output_file} in {time.perf_counter() - start:.1f}s')
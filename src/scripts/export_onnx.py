@@ -0,0 +1,114 @@
+"""
+Exports the mt0 backbone with the prompt as a graph input to ONNX and compares it with PyTorch on the CPU, e.g.
+
+python -m scripts.export_onnx --prompts english_prompt=ivykopal/english_prompt_100k \
+    --prompt_bank ../results/prompts.safetensors --dataset_name xnli --language english
+
+The backbone is exported once and every prompt is passed to the same graphs at runtime. For every prompt the
+encoder outputs and the greedily generated tokens of onnxruntime are checked against PyTorch on the test split
+of the dataset, and the generation time of both is printed.
+"""
+import argparse
+import time
+import numpy as np
+import torch
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+
+from prompt_tuning.bank import open_prompt_bank
+from prompt_tuning.export import OnnxPromptedSeq2SeqLM, export_onnx, get_prompt_embeddings
+from prompt_tuning.prompt_tuning import PromptTuningForSeq2SeqLM
+from serving.model import load_prompt_config, parse_named_paths
+from task_modeling.adapter_weights import use_safetensors_weights
+from task_modeling.utils import get_path
+from tasks import dataset_factory
+
+
+def load_prompts(model, prompt_sources):
+    first_name, first_path = prompt_sources[0]
+    model = PromptTuningForSeq2SeqLM.from_pretrained(model, first_path, adapter_name=first_name)
+    for name, path in prompt_sources[1:]:
+        if name not in model._peft_config:
+            model.add_adapter(name, load_prompt_config(path, name))
+        model.load_adapter(path, adapter_name=name)
+    return model.eval()
+
+
+def get_batches(tokenizer, args):
+    dataset = dataset_factory(dataset_name=args.dataset_name, language=args.language)
+    examples = dataset.get_dataset('test')
+    examples = examples.select(range(min(len(examples), args.max_predict_samples)))
+    inputs, _ = dataset.preprocess(examples[:])
+    return [
+        tokenizer(inputs[start:start + args.batch_size], max_length=args.max_seq_length, padding=True,
+                  truncation=True, return_tensors='pt', return_token_type_ids=False)
+        for start in range(0, len(inputs), args.batch_size)
+    ]
+
+
+def pad(token_ids, width, pad_token_id):
+    return np.pad(token_ids, ((0, 0), (0, width - token_ids.shape[1])), constant_values=pad_token_id)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('ONNX export of the prompted backbone')
+    parser.add_argument('--model_name_or_path', type=str, default='bigscience/mt0-base')
+    parser.add_argument('--prompts', nargs='*', type=str, default=[], help='name=path of every prompt')
+    parser.add_argument('--prompt_bank', type=str, default=None)
+    parser.add_argument('--output_dir', type=str, default='../results/onnx')
+    parser.add_argument('--dataset_name', type=str, default='xnli')
+    parser.add_argument('--language', type=str, default='english')
+    parser.add_argument('--max_seq_length', type=int, default=256)
+    parser.add_argument('--max_new_tokens', type=int, default=10)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--max_predict_samples', type=int, default=64)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--opset_version', type=int, default=14)
+    args = parser.parse_args()
+    use_safetensors_weights()
+
+    prompt_sources = [(name, get_path(path, type='prompt')) for name, path in parse_named_paths(args.prompts).items()]
+    if args.prompt_bank is not None:
+        prompt_sources += [(name, args.prompt_bank) for name in open_prompt_bank(args.prompt_bank).names]
+    if not prompt_sources:
+        raise ValueError('Pass the prompts to compare with --prompts or --prompt_bank')
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    model = load_prompts(AutoModelForSeq2SeqLM.from_pretrained(args.model_name_or_path).eval(), prompt_sources)
+
+    export_onnx(model, args.output_dir, opset_version=args.opset_version)
+    onnx_model = OnnxPromptedSeq2SeqLM(args.output_dir, intra_op_num_threads=args.num_threads)
+    batches = get_batches(tokenizer, args)
+    pad_token_id = model.get_transformer_model().config.pad_token_id
+
+    print(f"{'prompt':<24} {'max |Δ| encoder':>16} {'same tokens':>12} {'torch s':>8} {'onnx s':>8} {'speedup':>8}")
+    for name, _ in prompt_sources:
+        # rows are routed to the prompt, its configuration sets the number of virtual tokens
+        model.adapter_name = name
+        max_difference, same, torch_s, onnx_s = 0.0, [], 0.0, 0.0
+        for batch in batches:
+            prompt_ids = model.get_prompt_ids([name] * len(batch['input_ids']))
+            prompt_embeddings = get_prompt_embeddings(model, len(batch['input_ids']), prompt_ids).numpy()
+
+            with torch.no_grad():
+                encoder_outputs, _ = model.encode(**batch, prompt_ids=prompt_ids)
+                start = time.perf_counter()
+                torch_tokens = model.generate(
+                    **batch, prompt_ids=prompt_ids, max_new_tokens=args.max_new_tokens, num_beams=1,
+                    do_sample=False).numpy()
+                torch_s += time.perf_counter() - start
+
+            encoder_hidden_states, _ = onnx_model.encode(batch['input_ids'], batch['attention_mask'], prompt_embeddings)
+            start = time.perf_counter()
+            onnx_tokens = onnx_model.generate(
+                batch['input_ids'], batch['attention_mask'], prompt_embeddings, max_new_tokens=args.max_new_tokens)
+            onnx_s += time.perf_counter() - start
+
+            max_difference = max(
+                max_difference, float(np.abs(encoder_outputs.last_hidden_state.numpy() - encoder_hidden_states).max()))
+            width = max(torch_tokens.shape[1], onnx_tokens.shape[1])
+            same.extend((pad(torch_tokens, width, pad_token_id) == pad(onnx_tokens, width, pad_token_id)).all(axis=1))
+
+        print(f'{name:<24} {max_difference:>16.2e} {np.mean(same):>12.3f} {torch_s:>8.2f} {onnx_s:>8.2f} '
+              f'{torch_s / onnx_s:>8.2f}')
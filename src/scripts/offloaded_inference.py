@@ -0,0 +1,87 @@
+"""
+Compares in-memory and disk-offloaded CPU inference of `task_modeling.run` per task and memory budget, e.g.
+
+python -m scripts.offloaded_inference --model_name_or_path CohereForAI/aya-101 --max_cpu_memory 16GB 32GB \
+    --setups xnli:english:prompt:ivykopal/xnli_en_prompt_100k --max_predict_samples 100 --skip_in_memory
+
+A setup is `dataset:language`, optionally followed by `:adapter:path` or `:prompt:path` of the trained task module.
+Every budget predicts the test split with the backbone weights beyond it read from the disk, the metrics, the
+throughput and the resident memory from `predict_results.json` are printed next to each other.
+"""
+import argparse
+import json
+import os
+
+from scripts.crosslingual import inference_params
+from scripts.quantized_inference import MEMORY_METRICS, default_params, get_module_params
+
+os.environ['WANDB_MODE'] = 'disabled'
+
+IN_MEMORY = 'in memory'
+
+
+def predict(args, dataset_name, language, module_params, output_dir, max_cpu_memory):
+    params = default_params + module_params + [
+        f'--model_name_or_path {args.model_name_or_path}',
+        f'--dataset_name {dataset_name}',
+        f'--language {language}',
+        f'--max_answer_length {args.max_answer_length}',
+        f'--output_dir {output_dir}',
+    ]
+    if args.max_predict_samples is not None:
+        params.append(f'--max_predict_samples {args.max_predict_samples}')
+    if max_cpu_memory != IN_MEMORY:
+        params.append(f'--max_cpu_memory {max_cpu_memory}')
+    os.system(
+        f'python -m task_modeling.run {" ".join(params)}'
+    )
+
+    with open(os.path.join(output_dir, 'predict_results.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Metrics, throughput and memory of in-memory and disk-offloaded CPU inference')
+    parser.add_argument('--setups', nargs='+', type=str, required=True,
+                        help='dataset:language[:adapter|prompt:path] of every task')
+    parser.add_argument('--model_name_or_path', type=str, default='bigscience/mt0-base')
+    parser.add_argument('--max_cpu_memory', nargs='+', type=str, required=True,
+                        help='Memory budgets of the backbone weights, e.g. 8GB')
+    parser.add_argument('--skip_in_memory', action='store_true',
+                        help='Do not run the backbone fully in memory, e.g. when it is larger than the memory')
+    parser.add_argument('--max_answer_length', type=int, default=30)
+    parser.add_argument('--max_predict_samples', type=int, default=None)
+    parser.add_argument('--output_dir', type=str, default='../results/offloaded_inference')
+    args = parser.parse_args()
+
+    modes = ([] if args.skip_in_memory else [IN_MEMORY]) + args.max_cpu_memory
+    results = {}
+    for setup in args.setups:
+        dataset_name, language, *module = setup.split(':', 3)
+        module_params = get_module_params(*module) if module else inference_params
+        name = '_'.join([dataset_name, language] + module[:1])
+        results[name] = {
+            mode: predict(args, dataset_name, language, module_params,
+                          os.path.join(args.output_dir, name, mode.replace(' ', '_')), mode)
+            for mode in modes
+        }
+
+    for name, result in results.items():
+        reference = next(iter(result.values()))
+        metrics = [
+            key for key, value in reference.items()
+            if isinstance(value, float) and not key.endswith(('_runtime', '_per_second')) and key not in MEMORY_METRICS
+        ]
+        print(name)
+        print(f"{'mode':<10} " + ' '.join(f'{metric:>20}' for metric in metrics)
+              + f" {'runtime s':>10} {'samples/s':>10} {'RSS MiB':>8} {'peak MiB':>9}")
+        for mode, values in result.items():
+            print(
+                f'{mode:<10} '
+                + ' '.join(f'{values[metric]:>20.4f}' for metric in metrics)
+                + f" {values['test_runtime']:>10.2f} {values['test_samples_per_second']:>10.2f}"
+                f" {values['predict_rss_mb']:>8.0f} {values['predict_peak_rss_mb']:>9.0f}"
+            )
+
+    with open(os.path.join(args.output_dir, 'offload_results.json'), 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
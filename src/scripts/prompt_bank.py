@@ -0,0 +1,47 @@
+"""
+Packs trained prompts into a single prompt bank file, e.g.
+
+python -m scripts.prompt_bank --output ../results/prompts.safetensors \
+    --prompts english_prompt=ivykopal/english_prompt_mt0 german_prompt=ivykopal/german_prompt_mt0 [--quantization int8]
+
+The names are the adapter names the prompts are loaded under, `PromptTuningForSeq2SeqLM.from_pretrained`
+looks a prompt up in the bank by its adapter name.
+"""
+import argparse
+
+from prompt_tuning.bank import PromptBank
+from prompt_tuning.config import PromptTuningConfig
+from prompt_tuning.quantization import PROMPT_KEY, QUANTIZATION_TYPES, dequantize_state_dict
+from prompt_tuning.utils import load_adapter_weights
+from task_modeling.utils import get_path
+
+
+def parse_prompts(prompts):
+    parsed = {}
+    for prompt in prompts:
+        if '=' not in prompt:
+            raise ValueError(f"Expected 'name=path', got '{prompt}'")
+        name, path = prompt.split('=', 1)
+        parsed[name] = path
+    return parsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Convert prompt checkpoints into a prompt bank')
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--prompts', nargs='+', type=str, required=True,
+                        help='Prompts to pack as name=path, the path is a local directory or a Hub repository')
+    parser.add_argument('--quantization', type=str, default=None, choices=QUANTIZATION_TYPES,
+                        help='Store the prompts as float16 or as int8 with per-row scales')
+    args = parser.parse_args()
+
+    prompts = {}
+    configs = {}
+    for name, path in parse_prompts(args.prompts).items():
+        path = get_path(path, type='prompt')
+        configs[name] = PromptTuningConfig.from_pretrained(path)
+        prompts[name] = dequantize_state_dict(load_adapter_weights(path, device='cpu'))[PROMPT_KEY]
+        print(f'{name}: {path} {tuple(prompts[name].shape)}')
+
+    PromptBank.save(args.output, prompts, configs, quantization=args.quantization)
+    print(f'Saved {len(prompts)} prompts to {args.output}')
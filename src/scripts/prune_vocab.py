@@ -0,0 +1,132 @@
+"""
+Prunes the vocabulary of mt0 to the tokens used by the given languages, e.g.
+
+python -m scripts.prune_vocab --languages english czech slovak --tasks qa nli \
+    --output_dir ../results/pruned/mt0-base-en-cs-sk
+
+The token ids are collected from all splits of the task datasets of every language, the inputs and targets as
+`task_modeling.run` builds them, and from the first `--wikipedia_articles` articles of the Wikipedia subset of the
+language, on which the language adapters and prompts were trained. The pruned model is saved with the tokenizer of
+the full vocabulary and used as any other model by `--model_name_or_path`, its tokenizer is wrapped by
+`task_modeling.vocab_pruning.wrap_pruned_tokenizer`. Greedy generation of the full and the pruned model is compared
+on the test inputs of every task dataset.
+"""
+import argparse
+import json
+import os
+import time
+import numpy as np
+import torch
+from datasets import load_dataset
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+
+from scripts.crosslingual import get_dataset_from_language
+from task_modeling.vocab_pruning import PrunedTokenizer, collect_token_ids, prune_vocabulary
+from tasks import dataset_factory
+from tasks.utils import convert_language
+
+
+def get_task_texts(dataset, splits=('train', 'validation', 'test'), batch_size=1000):
+    for split in splits:
+        if dataset.splits.get(split) not in dataset.dataset:
+            continue
+        examples = dataset.get_dataset(split)
+        for start in range(0, len(examples), batch_size):
+            inputs, targets = dataset.preprocess(examples[start:start + batch_size])
+            yield from inputs
+            yield from targets
+    yield from getattr(dataset, 'label_names', None) or []
+
+
+def get_wikipedia_texts(language, num_articles, date):
+    articles = load_dataset(
+        'wikimedia/wikipedia', f'{date}.{convert_language(language)}', split='train', streaming=True)
+    for article in articles.take(num_articles):
+        yield article['text']
+
+
+def count_parameters(module):
+    return sum(parameter.numel() for parameter in module.parameters())
+
+
+@torch.no_grad()
+def compare_generation(model, pruned_model, tokenizer, pruned_tokenizer, texts, args):
+    same, full_s, pruned_s = [], 0.0, 0.0
+    for start in range(0, len(texts), args.batch_size):
+        batch = texts[start:start + args.batch_size]
+        kwargs = dict(max_length=args.max_seq_length, truncation=True, padding=True, return_tensors='pt',
+                      return_token_type_ids=False)
+
+        begin = time.perf_counter()
+        full_tokens = model.generate(**tokenizer(batch, **kwargs), max_new_tokens=args.max_new_tokens).numpy()
+        full_s += time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        pruned_tokens = pruned_model.generate(
+            **pruned_tokenizer(batch, **kwargs), max_new_tokens=args.max_new_tokens).numpy()
+        pruned_s += time.perf_counter() - begin
+
+        pruned_tokens = pruned_tokenizer.to_original_ids(pruned_tokens)
+        width = max(full_tokens.shape[1], pruned_tokens.shape[1])
+        same.extend((pad(full_tokens, width, tokenizer.pad_token_id)
+                     == pad(pruned_tokens, width, tokenizer.pad_token_id)).all(axis=1))
+    return np.mean(same), full_s, pruned_s
+
+
+def pad(token_ids, width, pad_token_id):
+    return np.pad(token_ids, ((0, 0), (0, width - token_ids.shape[1])), constant_values=pad_token_id)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Vocabulary pruning of mt0 for a set of languages')
+    parser.add_argument('--model_name_or_path', type=str, default='bigscience/mt0-base')
+    parser.add_argument('--languages', nargs='+', type=str, required=True)
+    parser.add_argument('--tasks', nargs='*', type=str, default=['qa', 'ner', 'nli'])
+    parser.add_argument('--wikipedia_articles', type=int, default=100000)
+    parser.add_argument('--wikipedia_date', type=str, default='20231101')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--max_seq_length', type=int, default=256)
+    parser.add_argument('--max_new_tokens', type=int, default=30)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--max_predict_samples', type=int, default=200)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    token_ids = set()
+    test_texts = {}
+    for language in args.languages:
+        for dataset_name in dict.fromkeys(get_dataset_from_language(language, task) for task in args.tasks):
+            dataset = dataset_factory(dataset_name=dataset_name, language=language)
+            token_ids.update(collect_token_ids(tokenizer, get_task_texts(dataset)))
+            examples = dataset.get_dataset('test')
+            examples = examples.select(range(min(len(examples), args.max_predict_samples)))
+            test_texts[f'{dataset_name} {language}'] = dataset.preprocess(examples[:])[0]
+        if args.wikipedia_articles:
+            token_ids.update(collect_token_ids(
+                tokenizer, get_wikipedia_texts(language, args.wikipedia_articles, args.wikipedia_date)))
+        print(f'{language}: {len(token_ids)} tokens')
+
+    model = AutoModelForSeq2SeqLM.from_pretrained(args.model_name_or_path).eval()
+    pruned_model = prune_vocabulary(AutoModelForSeq2SeqLM.from_pretrained(args.model_name_or_path).eval(),
+                                    tokenizer, token_ids)
+    pruned_model.save_pretrained(args.output_dir)
+    tokenizer.save_pretrained(args.output_dir)
+    pruned_tokenizer = PrunedTokenizer(tokenizer, pruned_model.config.pruned_token_ids)
+
+    results = {
+        'vocab_size': len(tokenizer),
+        'pruned_vocab_size': len(pruned_tokenizer),
+        'parameters': count_parameters(model),
+        'pruned_parameters': count_parameters(pruned_model),
+        'generation': {},
+    }
+    print(f"vocabulary {results['vocab_size']} -> {results['pruned_vocab_size']}, "
+          f"parameters {results['parameters'] / 1e6:.1f}M -> {results['pruned_parameters'] / 1e6:.1f}M")
+    print(f"{'test set':<24} {'same tokens':>12} {'full s':>8} {'pruned s':>9} {'speedup':>8}")
+    for name, texts in test_texts.items():
+        same, full_s, pruned_s = compare_generation(model, pruned_model, tokenizer, pruned_tokenizer, texts, args)
+        results['generation'][name] = {'same_tokens': same, 'full_s': full_s, 'pruned_s': pruned_s}
+        print(f'{name:<24} {same:>12.3f} {full_s:>8.2f} {pruned_s:>9.2f} {full_s / pruned_s:>8.2f}')
+
+    with open(os.path.join(args.output_dir, 'pruning_results.json'), 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, default=float)
@@ -0,0 +1,105 @@
+"""
+Compares float32 and dynamically quantized int8 CPU inference of `task_modeling.run` per task, e.g.
+
+python -m scripts.quantized_inference --setups xnli:english:prompt:ivykopal/xnli_en_prompt_100k \
+    mlqa:english:adapter:ivykopal/mlqa_en_adapter_100k --max_predict_samples 1000
+
+A setup is `dataset:language`, optionally followed by `:adapter:path` or `:prompt:path` of the trained task module.
+Both modes predict the test split on the CPU, the metrics, the prediction runtime and the resident memory from
+`predict_results.json` are printed next to each other.
+"""
+import argparse
+import json
+import os
+
+from prompt_tuning.config import PromptTuningConfig
+from scripts.crosslingual import adapter_params, inference_params, prompt_params
+from task_modeling.utils import get_path
+
+os.environ['WANDB_MODE'] = 'disabled'
+
+default_params = [
+    '--do_predict',
+    '--predict_with_generate',
+    '--per_device_eval_batch_size 32',
+    '--max_seq_length 256',
+    '--overwrite_output_dir',
+    '--pad_to_max_length',
+    '--use_cpu',
+]
+
+MEMORY_METRICS = ('predict_rss_mb', 'predict_peak_rss_mb')
+
+
+def get_module_params(module_type, path):
+    if module_type == 'adapter':
+        path = get_path(path)
+        return adapter_params + [f'--adapter_config {path}/adapter_config.json', f'--load_adapter {path}']
+    if module_type == 'prompt':
+        path = get_path(path, type='prompt')
+        num_virtual_tokens = PromptTuningConfig.from_pretrained(path).num_virtual_tokens
+        params = [param for param in prompt_params if not param.startswith('--num_virtual_tokens')]
+        return params + [f'--num_virtual_tokens {num_virtual_tokens}', f'--load_task_prompt {path}']
+    raise ValueError(f'Invalid module type: {module_type}')
+
+
+def predict(args, dataset_name, language, module_params, output_dir, quantize):
+    params = default_params + module_params + [
+        f'--model_name_or_path {args.model_name_or_path}',
+        f'--dataset_name {dataset_name}',
+        f'--language {language}',
+        f'--max_answer_length {args.max_answer_length}',
+        f'--output_dir {output_dir}',
+    ]
+    if args.max_predict_samples is not None:
+        params.append(f'--max_predict_samples {args.max_predict_samples}')
+    if quantize:
+        params.append('--quantize_dynamic')
+    os.system(
+        f'python -m task_modeling.run {" ".join(params)}'
+    )
+
+    with open(os.path.join(output_dir, 'predict_results.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Metrics, latency and memory of float32 and int8 CPU inference')
+    parser.add_argument('--setups', nargs='+', type=str, required=True,
+                        help='dataset:language[:adapter|prompt:path] of every task')
+    parser.add_argument('--model_name_or_path', type=str, default='bigscience/mt0-base')
+    parser.add_argument('--max_answer_length', type=int, default=30)
+    parser.add_argument('--max_predict_samples', type=int, default=None)
+    parser.add_argument('--output_dir', type=str, default='../results/quantized_inference')
+    args = parser.parse_args()
+
+    results = {}
+    for setup in args.setups:
+        dataset_name, language, *module = setup.split(':', 3)
+        module_params = get_module_params(*module) if module else inference_params
+        name = '_'.join([dataset_name, language] + module[:1])
+        results[name] = {
+            mode: predict(args, dataset_name, language, module_params,
+                          os.path.join(args.output_dir, name, mode), mode == 'int8')
+            for mode in ('float32', 'int8')
+        }
+
+    for name, result in results.items():
+        float32 = result['float32']
+        metrics = [
+            key for key, value in float32.items()
+            if isinstance(value, float) and not key.endswith(('_runtime', '_per_second')) and key not in MEMORY_METRICS
+        ]
+        print(name)
+        print(f"{'mode':<8} " + ' '.join(f'{metric:>20} {"delta":>8}' for metric in metrics)
+              + f" {'runtime s':>10} {'speedup':>8} {'RSS MiB':>8} {'peak MiB':>9}")
+        for mode, values in result.items():
+            print(
+                f'{mode:<8} '
+                + ' '.join(f'{values[metric]:>20.4f} {values[metric] - float32[metric]:>+8.4f}' for metric in metrics)
+                + f" {values['test_runtime']:>10.2f} {float32['test_runtime'] / values['test_runtime']:>8.2f}"
+                f" {values['predict_rss_mb']:>8.0f} {values['predict_peak_rss_mb']:>9.0f}"
+            )
+
+    with open(os.path.join(args.output_dir, 'quantization_results.json'), 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
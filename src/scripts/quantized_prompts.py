@@ -0,0 +1,111 @@
+"""
+Exports a trained task prompt as float16 and int8 and compares the downstream metrics, e.g.
+
+python -m scripts.quantized_prompts --prompt ivykopal/xnli_en_prompt_100k --dataset_name xnli \
+    --language english --max_answer_length 3
+
+Every export is evaluated with `task_modeling.run` on the test split of the dataset and the metrics from
+`predict_results.json` are printed next to the float32 prompt they were quantized from.
+"""
+import argparse
+import json
+import os
+from safetensors.torch import save_file
+
+from prompt_tuning.config import PromptTuningConfig
+from prompt_tuning.quantization import QUANTIZATION_TYPES, dequantize_state_dict, quantize_state_dict
+from prompt_tuning.utils import SAFETENSORS_WEIGHTS_NAME, load_adapter_weights
+from task_modeling.utils import get_path
+
+os.environ['WANDB_MODE'] = 'disabled'
+
+default_params = [
+    '--do_predict',
+    '--predict_with_generate',
+    '--per_device_eval_batch_size 32',
+    '--max_seq_length 256',
+    '--overwrite_output_dir',
+    '--pad_to_max_length',
+]
+
+prompt_params = [
+    '--language_adapter_type none',
+    '--task_adapter_type prompt',
+    '--prompt_tuning',
+    '--task_type SEQ_2_SEQ_LM',
+    '--fusion none'
+]
+
+
+def export_prompt(path, output_dir, quantization):
+    state_dict = dequantize_state_dict(load_adapter_weights(path, device='cpu'))
+    state_dict = quantize_state_dict(state_dict, quantization)
+
+    os.makedirs(output_dir, exist_ok=True)
+    weights_file = os.path.join(output_dir, SAFETENSORS_WEIGHTS_NAME)
+    save_file({key: value.contiguous() for key, value in state_dict.items()},
+              weights_file, metadata={'format': 'pt'})
+    PromptTuningConfig.from_pretrained(path).save_pretrained(output_dir)
+    return os.path.getsize(weights_file)
+
+
+def predict(args, prompt_path, num_virtual_tokens, output_dir):
+    params = default_params + prompt_params + [
+        f'--model_name_or_path {args.model_name_or_path}',
+        f'--dataset_name {args.dataset_name}',
+        f'--language {args.language}',
+        f'--max_answer_length {args.max_answer_length}',
+        f'--num_virtual_tokens {num_virtual_tokens}',
+        f'--load_task_prompt {prompt_path}',
+        f'--output_dir {output_dir}',
+    ]
+    os.system(
+        f'python -m task_modeling.run {" ".join(params)}'
+    )
+
+    with open(os.path.join(output_dir, 'predict_results.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Metrics of float16 and int8 task prompts')
+    parser.add_argument('--prompt', type=str, required=True,
+                        help='Trained task prompt, a local directory or a Hub repository')
+    parser.add_argument('--model_name_or_path', type=str, default='bigscience/mt0-base')
+    parser.add_argument('--dataset_name', type=str, default='xnli')
+    parser.add_argument('--language', type=str, default='english')
+    parser.add_argument('--max_answer_length', type=int, default=30)
+    parser.add_argument('--quantization', nargs='+', type=str, default=list(QUANTIZATION_TYPES),
+                        choices=QUANTIZATION_TYPES)
+    parser.add_argument('--output_dir', type=str, default='../results/quantized_prompts')
+    args = parser.parse_args()
+
+    prompt_path = get_path(args.prompt, type='prompt')
+    num_virtual_tokens = PromptTuningConfig.from_pretrained(prompt_path).num_virtual_tokens
+    output_dir = os.path.join(args.output_dir, f'{args.dataset_name}_{args.language}')
+
+    sizes = {'float32': export_prompt(prompt_path, os.path.join(output_dir, 'prompts', 'float32'), None)}
+    prompts = {'float32': prompt_path}
+    for quantization in args.quantization:
+        prompts[quantization] = os.path.join(output_dir, 'prompts', quantization)
+        sizes[quantization] = export_prompt(prompt_path, prompts[quantization], quantization)
+
+    results = {
+        name: predict(args, path, num_virtual_tokens, os.path.join(output_dir, name))
+        for name, path in prompts.items()
+    }
+
+    metrics = [
+        key for key, value in results['float32'].items()
+        if isinstance(value, float) and not key.endswith(('_runtime', '_per_second'))
+    ]
+    print(f"{'prompt':<10} {'KiB':>8} " + ' '.join(f'{metric:>20} {"delta":>8}' for metric in metrics))
+    for name, result in results.items():
+        print(
+            f'{name:<10} {sizes[name] / 2 ** 10:>8.1f} '
+            + ' '.join(f'{result[metric]:>20.4f} {result[metric] - results["float32"][metric]:>+8.4f}'
+                       for metric in metrics)
+        )
+
+    with open(os.path.join(output_dir, 'quantization_results.json'), 'w', encoding='utf-8') as f:
+        json.dump({'sizes': sizes, 'results': results}, f, indent=2)
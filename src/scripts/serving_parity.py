@@ -0,0 +1,105 @@
+"""
+Checks that the inference server answers as the models evaluated by `task_modeling.run` with a language and a task
+prompt, e.g.
+
+python -m scripts.serving_parity --language english --dataset_name xnli \
+    --language_prompt ivykopal/english_prompt_100k --task_prompt ivykopal/xnli_en_prompt_100k
+
+The test inputs of the dataset are encoded and answered in batches by `serving.model.ServingModel` and one by one by
+the nested prompt models of `task_modeling.utils.get_updated_model`. The encoder outputs and the greedy answers of
+every input have to be the same, the script exits with status 1 otherwise.
+"""
+import argparse
+import sys
+import adapters
+import torch
+from transformers import AutoModelForSeq2SeqLM
+
+from language_modeling.args import PromptTuningArguments
+from serving.model import ServingModel
+from task_modeling.args import ModelArguments
+from task_modeling.utils import get_updated_model
+from tasks import dataset_factory
+
+
+def get_nested_model(args, device):
+    model_args = ModelArguments(
+        model_name_or_path=args.model_name_or_path,
+        language_adapter_type='prompt',
+        task_adapter_type='prompt',
+        load_language_prompt=args.language_prompt,
+        load_task_prompt=args.task_prompt,
+    )
+    model = AutoModelForSeq2SeqLM.from_pretrained(args.model_name_or_path)
+    adapters.init(model)
+    model = get_updated_model(
+        model, model_args, None, PromptTuningArguments(language=args.language), dataset_name=args.dataset_name)
+    return model.to(device).eval()
+
+
+@torch.no_grad()
+def compare(serving_model, nested_model, requests, batch_size, max_new_tokens):
+    key = serving_model.batch_key(requests[0])
+    serving_model.set_adapters(key[0])
+
+    max_difference, different_outputs = 0.0, 0
+    for start in range(0, len(requests), batch_size):
+        batch = requests[start:start + batch_size]
+        encoder_outputs, attention_mask = serving_model.encode(key, batch)
+        outputs = serving_model.run_batch(key, batch)
+
+        for i, request in enumerate(batch):
+            single = serving_model.tokenize([request])
+            nested_outputs, nested_mask = nested_model.encode(**single)
+            length = nested_mask.shape[1]
+            if int(attention_mask[i].sum()) != length:
+                raise ValueError(f'The server encodes {int(attention_mask[i].sum())} positions instead of {length}')
+            difference = encoder_outputs.last_hidden_state[i, :length] - nested_outputs.last_hidden_state[0]
+            max_difference = max(max_difference, difference.abs().max().item())
+
+            nested_ids = nested_model.generate(**single, max_new_tokens=max_new_tokens, num_beams=1)
+            nested_output = serving_model.tokenizer.batch_decode(nested_ids, skip_special_tokens=True)[0]
+            different_outputs += nested_output != outputs[i]
+    return max_difference, different_outputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Parity of the inference server with the nested prompt models of task_modeling')
+    parser.add_argument('--model_name_or_path', type=str, default='bigscience/mt0-base')
+    parser.add_argument('--language', type=str, required=True)
+    parser.add_argument('--dataset_name', type=str, required=True)
+    parser.add_argument('--language_prompt', type=str, required=True)
+    parser.add_argument('--task_prompt', type=str, required=True)
+    parser.add_argument('--max_samples', type=int, default=32)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--max_seq_length', type=int, default=256)
+    parser.add_argument('--max_new_tokens', type=int, default=30)
+    parser.add_argument('--atol', type=float, default=1e-4, help='Largest allowed difference of the encoder outputs')
+    args = parser.parse_args()
+
+    serving_model = ServingModel(
+        args.model_name_or_path,
+        prompt_paths={
+            f'{args.language}_prompt': args.language_prompt,
+            f'{args.dataset_name}_prompt': args.task_prompt,
+        },
+        max_seq_length=args.max_seq_length,
+        generation_kwargs={'max_new_tokens': args.max_new_tokens, 'num_beams': 1},
+    )
+    nested_model = get_nested_model(args, serving_model.device)
+
+    dataset = dataset_factory(dataset_name=args.dataset_name, language=args.language)
+    examples = dataset.get_dataset('test')
+    examples = examples.select(range(min(len(examples), args.max_samples)))
+    requests = [{
+        'inputs': text,
+        'language': args.language,
+        'task': args.dataset_name,
+        'language_adapter_type': 'prompt',
+        'task_adapter_type': 'prompt',
+    } for text in dataset.preprocess(examples[:])[0]]
+
+    max_difference, different_outputs = compare(
+        serving_model, nested_model, requests, args.batch_size, args.max_new_tokens)
+    print(f'inputs {len(requests)} max encoder difference {max_difference:.2e} different answers {different_outputs}')
+    sys.exit(int(max_difference > args.atol or different_outputs > 0))
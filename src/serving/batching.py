@@ -0,0 +1,170 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MicroBatcher:
+    """
+    Groups concurrent requests into micro-batches.
+
+    Requests with the same key are collected until `max_batch_size` of them are waiting or the oldest one
+    has waited `max_wait_ms`, full batches and then the oldest requests go first. Batches run one after
+    another on a single worker thread, so the model is never used concurrently, and requests arriving while
+    a batch runs are collected into the next one.
+    """
+
+    def __init__(self, run_batch, max_batch_size=32, max_wait_ms=10.0):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = {'requests': 0, 'batches': 0, 'busy_s': 0.0}
+
+        self._pending = {}
+        self._wakeup = None
+        self._worker = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._worker.cancel()
+        self._executor.shutdown(wait=True)
+
+    async def submit(self, key, item):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(key, []).append((item, future, time.perf_counter()))
+        self._wakeup.set()
+        return await future
+
+    async def _next_batch(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            key = max(self._pending, key=lambda key: (
+                len(self._pending[key]) >= self.max_batch_size, -self._pending[key][0][2]))
+            pending = self._pending[key]
+            wait = pending[0][2] + self.max_wait - time.perf_counter()
+            if len(pending) >= self.max_batch_size or wait <= 0:
+                batch = pending[:self.max_batch_size]
+                del pending[:self.max_batch_size]
+                if not pending:
+                    del self._pending[key]
+                return key, batch
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            key, batch = await self._next_batch()
+            items = [item for item, _, _ in batch]
+
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self._executor, self.run_batch, key, items)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.stats['busy_s'] += time.perf_counter() - start
+
+            self.stats['requests'] += len(batch)
+            self.stats['batches'] += 1
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class ContinuousBatcher:
+    """
+    Decodes requests with iteration-level scheduling on a `serving.continuous.ContinuousDecoder`.
+
+    Before every decoding step, waiting requests are admitted into the free rows of the decoder and the rows that
+    finished are answered right away, so short answers do not wait for the longest one of their batch. The rows of
+    a step share the adapter setup, the first element of the request key. The decoder starts on the setup of the
+    oldest waiting request and keeps admitting requests of its setup until a request of another setup has waited
+    `max_wait_ms` since it arrived or since the switch to the current setup, it then switches once its rows are done.
+    """
+
+    def __init__(self, decoder, max_wait_ms=10.0):
+        self.decoder = decoder
+        self.max_wait = max_wait_ms / 1000
+        self.stats = {'requests': 0, 'steps': 0, 'rows': 0, 'busy_s': 0.0}
+
+        self._pending = {}
+        self._switched = 0.0
+        self._wakeup = None
+        self._worker = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._worker.cancel()
+        self._executor.shutdown(wait=True)
+
+    async def submit(self, key, item):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(key[0], []).append((key, item, future, time.perf_counter()))
+        self._wakeup.set()
+        return await future
+
+    def _admit(self):
+        now = time.perf_counter()
+        if self.decoder.num_rows:
+            setup = self.decoder.adapter_names
+            oldest = min([pending[0][3] for other, pending in self._pending.items() if other != setup], default=now)
+            if now - max(oldest, self._switched) > self.max_wait:
+                return []
+        else:
+            setup = min(self._pending, key=lambda setup: self._pending[setup][0][3])
+            self._switched = now
+
+        pending = self._pending.get(setup, [])
+        admitted = pending[:self.decoder.num_free_rows]
+        del pending[:len(admitted)]
+        if setup in self._pending and not pending:
+            del self._pending[setup]
+        return admitted
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.decoder.num_rows and not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            admitted = self._admit()
+            start = time.perf_counter()
+            try:
+                finished = await loop.run_in_executor(
+                    self._executor, self.decoder.step, [(key, item, future) for key, item, future, _ in admitted])
+            except Exception as e:
+                # the rows of a failed step can not be decoded further
+                for future in self.decoder.reset() + [future for _, _, future, _ in admitted]:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.stats['busy_s'] += time.perf_counter() - start
+
+            self.stats['steps'] += 1
+            self.stats['rows'] += self.decoder.num_rows + len(finished)
+            self.stats['requests'] += len(finished)
+            for future, result in finished:
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,223 @@
+"""
+Greedy decoding with iteration-level scheduling for `serving.model.ServingModel`.
+
+A static batch decodes until its longest answer is done, the rows of short answers, e.g. the label of an XNLI
+request next to the entity list of a NER one, are carried along as padding. `ContinuousDecoder` instead keeps up
+to `max_batch_size` rows that each decode one token per step: requests are admitted into free rows at every step and
+rows are retired as soon as they generate the end of sequence token or `max_new_tokens` tokens.
+
+Every row keeps its own encoder outputs, with the prompts of its request, and its cross-attention cache, padded on the
+right to the longest encoder input of the batch. The self-attention cache is aligned on the right, a row admitted
+later has masked padding in front of its tokens. mt5 only uses relative positions, so the padding does not change
+the attention of a row, and a row decodes the same tokens as with `generate`. The rows of a step share the active
+adapters, the encoder inputs of admitted requests are still routed to their own prompts.
+"""
+import torch
+from transformers.modeling_outputs import BaseModelOutput
+
+
+def pad_to(tensor, length, dim, left=False):
+    """
+    Pads `tensor` with zeros along `dim` to `length`.
+    """
+    shape = list(tensor.shape)
+    shape[dim] = length - tensor.shape[dim]
+    if shape[dim] == 0:
+        return tensor
+    padding = tensor.new_zeros(shape)
+    return torch.cat((padding, tensor) if left else (tensor, padding), dim=dim)
+
+
+class DecoderRows:
+    """
+    Decoding state of a set of rows, the cache and masks of every row are the rows of the tensors.
+    """
+
+    def __init__(self, handles, tokens, encoder_hidden_states, encoder_mask, past_key_values):
+        self.handles = handles
+        self.tokens = tokens
+        self.encoder_hidden_states = encoder_hidden_states
+        self.encoder_mask = encoder_mask
+        self.decoder_mask = torch.ones(
+            (len(handles), past_key_values[0][0].shape[2]), dtype=torch.long, device=encoder_mask.device)
+        # per layer the self-attention keys and values, then the cross-attention keys and values
+        self.past_key_values = [list(layer) for layer in past_key_values]
+
+    def __len__(self):
+        return len(self.handles)
+
+    @property
+    def next_tokens(self):
+        return torch.tensor([tokens[-1] for tokens in self.tokens], device=self.encoder_mask.device)
+
+    def extend(self, rows):
+        """
+        Appends `rows`, aligning the self-attention caches on the right and padding the encoder outputs on the right.
+        """
+        decoder_length = max(self.decoder_mask.shape[1], rows.decoder_mask.shape[1])
+        encoder_length = max(self.encoder_mask.shape[1], rows.encoder_mask.shape[1])
+
+        def merge(a, b, length, dim, left=False):
+            return torch.cat((pad_to(a, length, dim, left=left), pad_to(b, length, dim, left=left)))
+
+        self.handles = self.handles + rows.handles
+        self.tokens = self.tokens + rows.tokens
+        self.decoder_mask = merge(self.decoder_mask, rows.decoder_mask, decoder_length, 1, left=True)
+        self.encoder_mask = merge(self.encoder_mask, rows.encoder_mask, encoder_length, 1)
+        self.encoder_hidden_states = merge(
+            self.encoder_hidden_states, rows.encoder_hidden_states, encoder_length, 1)
+        self.past_key_values = [
+            [merge(a, b, decoder_length, 2, left=True) for a, b in zip(layer[:2], other[:2])]
+            + [merge(a, b, encoder_length, 2) for a, b in zip(layer[2:], other[2:])]
+            for layer, other in zip(self.past_key_values, rows.past_key_values)
+        ]
+
+    def update(self, next_tokens, past_key_values):
+        for tokens, token in zip(self.tokens, next_tokens.tolist()):
+            tokens.append(token)
+        self.decoder_mask = torch.cat((self.decoder_mask, self.decoder_mask.new_ones((len(self), 1))), dim=1)
+        self.past_key_values = [list(layer) for layer in past_key_values]
+
+    def select(self, keep):
+        """
+        Keeps the rows at the indices `keep` and drops the cache columns that are padding in all of them.
+        """
+        self.handles = [self.handles[i] for i in keep]
+        self.tokens = [self.tokens[i] for i in keep]
+        index = torch.tensor(keep, device=self.encoder_mask.device)
+        decoder_mask = self.decoder_mask[index]
+        encoder_mask = self.encoder_mask[index]
+        decoder_start = int(decoder_mask.any(dim=0).nonzero()[0])
+        encoder_end = int(encoder_mask.any(dim=0).nonzero()[-1]) + 1
+
+        self.decoder_mask = decoder_mask[:, decoder_start:]
+        self.encoder_mask = encoder_mask[:, :encoder_end]
+        self.encoder_hidden_states = self.encoder_hidden_states[index, :encoder_end]
+        self.past_key_values = [
+            [tensor[index, :, decoder_start:] for tensor in layer[:2]]
+            + [tensor[index, :, :encoder_end] for tensor in layer[2:]]
+            for layer in self.past_key_values
+        ]
+
+
+class ContinuousDecoder:
+    """
+    Greedy decoding of up to `max_batch_size` requests at a time, admitted and retired at every step.
+
+    All rows decode under the same adapter setup, the first element of `ServingModel.batch_key`, requests of
+    another setup can be admitted once all rows are retired.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_new_tokens=30):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        generation_config = model.transformer.generation_config
+        self.decoder_start_token_id = generation_config.decoder_start_token_id
+        eos_token_id = generation_config.eos_token_id
+        self.eos_token_ids = set(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id])
+        self.adapter_names = None
+        self.rows = None
+
+    @property
+    def num_rows(self):
+        return len(self.rows) if self.rows is not None else 0
+
+    @property
+    def num_free_rows(self):
+        return self.max_batch_size - self.num_rows
+
+    def reset(self):
+        """
+        Drops all rows and returns their handles.
+        """
+        handles = self.rows.handles if self.rows is not None else []
+        self.rows = None
+        return handles
+
+    def _forward(self, encoder_hidden_states, encoder_mask, decoder_input_ids, decoder_attention_mask=None,
+                 past_key_values=None):
+        outputs = self.model.transformer(
+            encoder_outputs=BaseModelOutput(last_hidden_state=encoder_hidden_states),
+            attention_mask=encoder_mask,
+            decoder_input_ids=decoder_input_ids,
+            decoder_attention_mask=decoder_attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        return outputs.logits[:, -1].argmax(dim=-1), outputs.past_key_values
+
+    def _is_finished(self, tokens):
+        return tokens[-1] in self.eos_token_ids or len(tokens) >= self.max_new_tokens
+
+    def _retire(self, rows):
+        """
+        Returns the `(handle, output)` of the finished rows and the remaining rows, or None if all finished.
+        """
+        finished = [i for i, tokens in enumerate(rows.tokens) if self._is_finished(tokens)]
+        if not finished:
+            return [], rows
+        outputs = self.model.tokenizer.batch_decode([rows.tokens[i] for i in finished], skip_special_tokens=True)
+        results = list(zip([rows.handles[i] for i in finished], outputs))
+        keep = sorted(set(range(len(rows))) - set(finished))
+        if not keep:
+            return results, None
+        rows.select(keep)
+        return results, rows
+
+    def _admit(self, key, requests, handles):
+        """
+        Encodes requests of one batch key and decodes their first token.
+        """
+        encoder_outputs, attention_mask = self.model.encode(key, requests)
+        encoder_hidden_states = encoder_outputs.last_hidden_state
+        decoder_input_ids = torch.full(
+            (len(requests), 1), self.decoder_start_token_id, dtype=torch.long, device=attention_mask.device)
+        next_tokens, past_key_values = self._forward(encoder_hidden_states, attention_mask, decoder_input_ids)
+        rows = DecoderRows(
+            list(handles), [[token] for token in next_tokens.tolist()], encoder_hidden_states, attention_mask,
+            past_key_values)
+
+        finished, rows = self._retire(rows)
+        if rows is not None and self.rows is not None:
+            self.rows.extend(rows)
+        elif rows is not None:
+            self.rows = rows
+        return finished
+
+    @torch.no_grad()
+    def step(self, admitted=()):
+        """
+        Admits `admitted`, a list of `(batch_key, request, handle)`, and decodes one token for every row.
+
+        Returns the `(handle, output)` of the rows that finished.
+        """
+        if len(admitted) > self.num_free_rows:
+            raise ValueError(f'{len(admitted)} requests were admitted into {self.num_free_rows} free rows')
+
+        finished = []
+        groups = {}
+        for key, request, handle in admitted:
+            groups.setdefault(key, []).append((request, handle))
+        for key, group in groups.items():
+            if self.rows is not None and key[0] != self.adapter_names:
+                raise ValueError(f'Adapters {key[0]} can not be admitted while {self.adapter_names} decode')
+            if self.rows is None:
+                self.adapter_names = key[0]
+                self.model.set_adapters(self.adapter_names)
+            requests, handles = zip(*group)
+            finished += self._admit(key, list(requests), handles)
+
+        if self.rows is None:
+            return finished
+        # the rows admitted in this step are already in `self.rows` and decode their second token
+        rows = self.rows
+        decoder_attention_mask = torch.cat((rows.decoder_mask, rows.decoder_mask.new_ones((len(rows), 1))), dim=1)
+        next_tokens, past_key_values = self._forward(
+            rows.encoder_hidden_states, rows.encoder_mask, rows.next_tokens[:, None], decoder_attention_mask,
+            rows.past_key_values)
+        rows.update(next_tokens, past_key_values)
+
+        retired, self.rows = self._retire(rows)
+        return finished + retired
@@ -0,0 +1,123 @@
+"""
+Load generator for `serving.server`, e.g.
+
+python -m serving.load --concurrency 64 --num_requests 2000 \
+    --setups english:xnli:prompt:prompt german:xnli:prompt:prompt english:xnli:adapter:adapter
+
+Every connection sends its requests one after another over keep-alive, the setups are cycled as
+language:task:language_adapter_type:task_adapter_type. Requests can also be read from a jsonl file with
+`--requests_file`. Prints the throughput, the p50/p99 latency and the mean batch size of the server.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+import numpy as np
+
+
+class Client:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, payload=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        self.writer.write(
+            f'{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n'
+            f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body
+        )
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split(b' ', 2)[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        response = json.loads(await self.reader.readexactly(int(headers['content-length'])))
+        if status != 200:
+            raise RuntimeError(f'{status}: {response}')
+        return response
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def parse_setups(setups, text):
+    requests = []
+    for setup in setups:
+        language, task, language_adapter_type, task_adapter_type = setup.split(':')
+        requests.append({
+            'inputs': text,
+            'language': language,
+            'task': task,
+            'language_adapter_type': language_adapter_type,
+            'task_adapter_type': task_adapter_type,
+        })
+    return requests
+
+
+async def run_load(host, port, requests, num_requests, concurrency):
+    payloads = itertools.islice(itertools.cycle(requests), num_requests)
+    latencies = []
+
+    async def worker():
+        client = Client(host, port)
+        try:
+            for payload in payloads:
+                start = time.perf_counter()
+                await client.request('POST', '/generate', payload)
+                latencies.append(time.perf_counter() - start)
+        finally:
+            client.close()
+
+    stats_client = Client(host, port)
+    stats_before = await stats_client.request('GET', '/stats')
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    stats_after = await stats_client.request('GET', '/stats')
+    stats_client.close()
+
+    # a continuously batching server counts the rows of every decoding step instead of batches
+    batches_key, rows_key = ('steps', 'rows') if 'steps' in stats_after else ('batches', 'requests')
+    batches = stats_after[batches_key] - stats_before[batches_key]
+    return {
+        'requests': len(latencies),
+        'elapsed_s': elapsed,
+        'throughput_rps': len(latencies) / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'mean_batch_size': (stats_after[rows_key] - stats_before[rows_key]) / max(batches, 1),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Load generator for the local inference server')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--num_requests', type=int, default=1000)
+    parser.add_argument('--setups', nargs='+', type=str, default=['english:xnli:prompt:prompt'])
+    parser.add_argument('--inputs', type=str,
+                        default='Premise: The cat sat on the mat. Hypothesis: A cat is sitting. Answer:')
+    parser.add_argument('--requests_file', type=str, default=None)
+    args = parser.parse_args()
+
+    if args.requests_file is not None:
+        with open(args.requests_file, 'r', encoding='utf-8') as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+    else:
+        requests = parse_setups(args.setups, args.inputs)
+
+    results = asyncio.run(run_load(args.host, args.port, requests, args.num_requests, args.concurrency))
+    print(json.dumps(results, indent=2))
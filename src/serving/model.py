@@ -0,0 +1,142 @@
+import torch
+import adapters
+from adapters import AdapterConfig, Stack
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+
+from prompt_tuning.bank import is_prompt_bank, open_prompt_bank
+from prompt_tuning.config import PromptTuningConfig
+from prompt_tuning.prompt_tuning import PromptTuningForSeq2SeqLM
+from prompt_tuning.utils import infer_device
+from task_modeling.utils import get_path
+from task_modeling.vocab_pruning import wrap_pruned_tokenizer
+
+
+def parse_named_paths(values):
+    parsed = {}
+    for value in values or []:
+        if '=' not in value:
+            raise ValueError(f"Expected 'name=path', got '{value}'")
+        name, path = value.split('=', 1)
+        parsed[name] = path
+    return parsed
+
+
+def load_prompt_config(path, name):
+    if is_prompt_bank(path):
+        return open_prompt_bank(path).get_config(name)
+    return PromptTuningConfig.from_pretrained(path)
+
+
+class ServingModel:
+    """
+    One resident mt0 backbone with every prompt and adapter attached, answering batches of requests.
+
+    Prompts are routed per row, so requests for different languages share a batch. A request with a language and
+    a task prompt gets the encoder input of the nested prompt models of `task_modeling.run`, see
+    `PeftModel.get_nested_prompt`. Adapters are activated for the whole model, requests are therefore grouped by
+    `batch_key`, the active adapter setup and the fusion method and size of every prompt.
+
+    A request names its `language` and `task` and the `language_adapter_type` and `task_adapter_type`
+    (`prompt`, `adapter` or `none`). Prompts are looked up as `{language}_prompt` and `{task}_prompt`, the
+    adapter names `task_modeling.run` uses, and adapters as `{language}_adapter` and `{task}_adapter`.
+    """
+
+    def __init__(self, model_name_or_path, prompt_paths=None, prompt_bank=None, adapter_paths=None, device=None,
+                 max_seq_length=256, generation_kwargs=None):
+        self.device = device or infer_device()
+        self.max_seq_length = max_seq_length
+        self.generation_kwargs = generation_kwargs or {}
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_name_or_path)
+        self.tokenizer = wrap_pruned_tokenizer(self.tokenizer, model.config)
+        adapters.init(model)
+        for name, path in (adapter_paths or {}).items():
+            path = get_path(path)
+            model.load_adapter(path, config=AdapterConfig.load(f'{path}/adapter_config.json'), load_as=name)
+
+        prompt_sources = [(name, get_path(path, type='prompt')) for name, path in (prompt_paths or {}).items()]
+        if prompt_bank is not None:
+            prompt_sources += [(name, prompt_bank) for name in open_prompt_bank(prompt_bank).names]
+        if prompt_sources:
+            first_name, first_path = prompt_sources[0]
+            model = PromptTuningForSeq2SeqLM.from_pretrained(model, first_path, adapter_name=first_name)
+            for name, path in prompt_sources[1:]:
+                if name not in model._peft_config:
+                    model.add_adapter(name, load_prompt_config(path, name))
+                model.load_adapter(path, adapter_name=name)
+
+        self.model = model.to(self.device).eval()
+        self.prompt_model = model if isinstance(model, PromptTuningForSeq2SeqLM) else None
+        self.transformer = model.get_transformer_model() if self.prompt_model is not None else model
+
+    @property
+    def prompt_names(self):
+        return list(self.prompt_model.prompt_encoder.keys()) if self.prompt_model is not None else []
+
+    @property
+    def adapter_names(self):
+        return list(self.transformer.adapters_config.adapters.keys())
+
+    def resolve(self, request):
+        """
+        Returns the prompts and the adapters of a request, checking that they are attached.
+        """
+        prompts, adapter_names = [], []
+        for kind in ('language', 'task'):
+            adapter_type = request.get(f'{kind}_adapter_type', 'none')
+            if adapter_type == 'none':
+                continue
+            if adapter_type not in ('prompt', 'adapter'):
+                raise ValueError(f"Invalid {kind}_adapter_type '{adapter_type}'")
+            name = f"{request[kind]}_{adapter_type}"
+            if name not in (self.prompt_names if adapter_type == 'prompt' else self.adapter_names):
+                raise KeyError(f"No {adapter_type} '{name}' is attached")
+            (prompts if adapter_type == 'prompt' else adapter_names).append(name)
+        return tuple(prompts), tuple(adapter_names)
+
+    def batch_key(self, request):
+        prompts, adapter_names = self.resolve(request)
+        configs = [self.prompt_model._peft_config[name] for name in prompts]
+        return adapter_names, tuple((config.fusion, config.num_virtual_tokens) for config in configs)
+
+    def set_adapters(self, adapter_names):
+        self.transformer.set_active_adapters(
+            Stack(*adapter_names) if len(adapter_names) > 1 else (adapter_names[0] if adapter_names else None))
+
+    def tokenize(self, requests):
+        batch = self.tokenizer(
+            [request['inputs'] for request in requests],
+            max_length=self.max_seq_length, truncation=True, padding=True, return_tensors='pt',
+        ).to(self.device)
+        batch.pop('token_type_ids', None)
+        return batch
+
+    @torch.no_grad()
+    def encode(self, key, requests):
+        """
+        Runs the encoder over requests of one batch key, with their prompts, under the active adapters.
+
+        Returns the encoder outputs and the attention mask covering the prompts.
+        """
+        batch = self.tokenize(requests)
+        inputs, attention_mask, input_name = batch['input_ids'], batch['attention_mask'], 'input_ids'
+        if key[1]:
+            inputs_embeds = self.prompt_model.word_embeddings(inputs)
+            prompts = self.prompt_model.get_nested_prompt(
+                [self.resolve(request)[0] for request in requests], dtype=inputs_embeds.dtype)
+            inputs, input_name = torch.cat((prompts, inputs_embeds), dim=1), 'inputs_embeds'
+            attention_mask = torch.cat((attention_mask.new_ones(prompts.shape[:2]), attention_mask), dim=1)
+
+        # the model's own helper also sets up the adapters forward context
+        model_kwargs = self.transformer._prepare_encoder_decoder_kwargs_for_generation(
+            inputs, {'attention_mask': attention_mask}, input_name)
+        return model_kwargs['encoder_outputs'], attention_mask
+
+    @torch.no_grad()
+    def run_batch(self, key, requests):
+        self.set_adapters(key[0])
+        encoder_outputs, attention_mask = self.encode(key, requests)
+        outputs = self.transformer.generate(
+            encoder_outputs=encoder_outputs, attention_mask=attention_mask, **self.generation_kwargs)
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
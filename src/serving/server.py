@@ -0,0 +1,170 @@
+"""
+Local inference server keeping one backbone with its prompts and adapters resident, e.g.
+
+python -m serving.server --model_name_or_path bigscience/mt0-base \
+    --prompt_bank ../results/prompts.safetensors \
+    --adapters english_adapter=ivykopal/english_adapter_100k xnli_adapter=ivykopal/xnli_en_adapter_100k
+
+POST /generate {"inputs": "...", "language": "english", "task": "xnli",
+                "language_adapter_type": "prompt", "task_adapter_type": "prompt"}
+returns {"output": "..."}. GET /health lists the attached prompts and adapters, GET /stats the batching
+counters. With --continuous_batching, requests are admitted into and retired from the running batch at every
+decoding step, see `serving.continuous`.
+"""
+import argparse
+import asyncio
+import json
+import logging
+
+from serving.batching import ContinuousBatcher, MicroBatcher
+from serving.continuous import ContinuousDecoder
+from serving.model import ServingModel, parse_named_paths
+from task_modeling.adapter_weights import use_safetensors_weights
+
+logger = logging.getLogger(__name__)
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+async def read_request(reader):
+    """
+    Reads a request from `reader`, returns None at the end of the stream and raises `ValueError` if it is malformed.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    parts = request_line.decode('latin-1').split(' ', 2)
+    if len(parts) != 3:
+        raise ValueError(f'Malformed request line {request_line!r}')
+    method, path, _ = parts
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, separator, value = line.decode('latin-1').partition(':')
+        if not separator:
+            raise ValueError(f'Malformed header {line!r}')
+        headers[name.strip().lower()] = value.strip()
+
+    content_length = headers.get('content-length', '0')
+    if not content_length.isdigit():
+        raise ValueError(f'Invalid Content-Length {content_length!r}')
+    body = await reader.readexactly(int(content_length))
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    writer.write(
+        f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+        f'Content-Type: application/json\r\n'
+        f'Content-Length: {len(body)}\r\n'
+        f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1') + body
+    )
+
+
+class InferenceServer:
+    def __init__(self, model, max_batch_size=32, max_wait_ms=10.0, continuous_batching=False):
+        self.model = model
+        if continuous_batching:
+            decoder = ContinuousDecoder(
+                model, max_batch_size=max_batch_size, max_new_tokens=model.generation_kwargs['max_new_tokens'])
+            self.batcher = ContinuousBatcher(decoder, max_wait_ms=max_wait_ms)
+        else:
+            self.batcher = MicroBatcher(model.run_batch, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+    async def generate(self, request):
+        if not isinstance(request.get('inputs'), str):
+            raise ValueError("The request needs 'inputs' with the input text")
+        return {'output': await self.batcher.submit(self.model.batch_key(request), request)}
+
+    async def route(self, method, path, body):
+        if method == 'POST' and path == '/generate':
+            request = json.loads(body)
+            if not isinstance(request, dict):
+                raise ValueError('The request body needs to be a JSON object')
+            return 200, await self.generate(request)
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok', 'prompts': self.model.prompt_names, 'adapters': self.model.adapter_names}
+        if method == 'GET' and path == '/stats':
+            return 200, self.batcher.stats
+        return 404, {'error': f'{method} {path} not found'}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except ValueError as e:
+                    # the rest of the stream can not be parsed, the connection is closed after the answer
+                    write_response(writer, 400, {'error': str(e)}, keep_alive=False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                try:
+                    status, payload = await self.route(method, path, body)
+                except (ValueError, KeyError) as e:
+                    status, payload = 400, {'error': str(e)}
+                except Exception as e:
+                    logger.exception('Request failed')
+                    status, payload = 500, {'error': str(e)}
+
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                write_response(writer, status, payload, keep_alive=keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        self.batcher.start()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logger.info(f'Serving on http://{host}:{port}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Local dynamic-batching inference server')
+    parser.add_argument('--model_name_or_path', type=str, default='bigscience/mt0-base')
+    parser.add_argument('--prompts', nargs='*', type=str, default=[],
+                        help='Prompts to attach as name=path, e.g. english_prompt=ivykopal/english_prompt_100k')
+    parser.add_argument('--prompt_bank', type=str, default=None)
+    parser.add_argument('--adapters', nargs='*', type=str, default=[],
+                        help='Adapters to attach as name=path, e.g. english_adapter=ivykopal/english_adapter_100k')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_wait_ms', type=float, default=10.0)
+    parser.add_argument('--max_seq_length', type=int, default=256)
+    parser.add_argument('--max_new_tokens', type=int, default=30)
+    parser.add_argument('--num_beams', type=int, default=1)
+    parser.add_argument('--continuous_batching', action='store_true',
+                        help='Admit and retire requests at every decoding step instead of running whole batches')
+    args = parser.parse_args()
+    use_safetensors_weights()
+    if args.continuous_batching and args.num_beams > 1:
+        parser.error('--continuous_batching decodes greedily, it can not be used with --num_beams')
+
+    logging.basicConfig(level=logging.INFO)
+    model = ServingModel(
+        args.model_name_or_path,
+        prompt_paths=parse_named_paths(args.prompts),
+        prompt_bank=args.prompt_bank,
+        adapter_paths=parse_named_paths(args.adapters),
+        max_seq_length=args.max_seq_length,
+        generation_kwargs={'max_new_tokens': args.max_new_tokens, 'num_beams': args.num_beams},
+    )
+    server = InferenceServer(model, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                             continuous_batching=args.continuous_batching)
+    asyncio.run(server.serve(args.host, args.port))
@@ -0,0 +1,64 @@
+"""
+Safetensors weights for the `adapters` library.
+
+adapters 0.1.2 only reads and writes pickled `pytorch_adapter.bin` / `pytorch_model_head.bin` files. After
+`use_safetensors_weights()` the weights are also written as `.safetensors` next to them and loaded from
+there when present, memory-mapped and without unpickling. The `.bin` file is still written because
+adapters resolves local adapter and head directories by it, and it is read as a fallback for older
+checkpoints.
+"""
+import logging
+import os
+import torch
+from adapters.loading import WeightsLoaderHelper
+from safetensors.torch import save_file
+
+from prompt_tuning.utils import load_weights_file
+
+logger = logging.getLogger(__name__)
+
+
+def safe_weights_name(weights_name):
+    return os.path.splitext(weights_name)[0] + '.safetensors'
+
+
+def save_weights(self, save_directory, filter_func):
+    os.makedirs(save_directory, exist_ok=True)
+
+    state_dict = self.state_dict(filter_func)
+    torch.save(state_dict, os.path.join(save_directory, self.weights_name))
+    output_file = os.path.join(save_directory, safe_weights_name(self.weights_name))
+    # a file of an earlier save would be loaded instead of the .bin file if this one can not be written
+    if os.path.isfile(output_file):
+        os.remove(output_file)
+    try:
+        save_file({k: v.detach().contiguous() for k, v in state_dict.items()},
+                  output_file, metadata={'format': 'pt'})
+    except RuntimeError as e:
+        # e.g. heads whose weights share memory, they are only kept in the .bin file
+        logger.warning(f'Could not save {output_file}, the weights are only saved in {self.weights_name}: {e}')
+        if os.path.isfile(output_file):
+            os.remove(output_file)
+        return
+    logger.info(f'Module weights saved in {output_file}')
+
+
+def load_weights(self, save_directory, filter_func, rename_func=None, loading_info=None, in_base_model=False):
+    weights_file = os.path.join(save_directory, safe_weights_name(self.weights_name))
+    if not os.path.isfile(weights_file):
+        weights_file = os.path.join(save_directory, self.weights_name)
+
+    try:
+        state_dict = load_weights_file(weights_file, device='cpu')
+    except Exception:
+        raise OSError(f'Unable to load weights from {weights_file}')
+    logger.info(f'Loading module weights from {weights_file}')
+
+    return self.load_weights_from_state_dict(
+        state_dict, filter_func, rename_func=rename_func, loading_info=loading_info, in_base_model=in_base_model
+    )
+
+
+def use_safetensors_weights():
+    WeightsLoaderHelper.save_weights = save_weights
+    WeightsLoaderHelper.load_weights = load_weights
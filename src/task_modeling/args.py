@@ -63,6 +63,25 @@ class ModelArguments:
         metadata={
             "help": "The path to the task prompt to use."},
     )
+    quantize_dynamic: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to quantize the linear layers of the backbone to int8 with dynamic quantization for CPU "
+                "inference. Adapters and prompts stay in float32."
+            )
+        },
+    )
+    max_cpu_memory: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "CPU inference with the backbone weights that do not fit into this much memory, e.g. 8GB, offloaded "
+                "to the disk and read memory-mapped from the safetensors checkpoint layer by layer. The embeddings, "
+                "adapters and prompts stay in memory."
+            )
+        },
+    )
     # language_prompt_config: Optional[str] = field(
     #     default=None,
     #     metadata={
@@ -209,6 +228,37 @@ class DataTrainingArguments:
             "help": "Whether to ignore the tokens corresponding to padded labels in the loss computation or not."
         },
     )
+    rank_classification: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to predict classification tasks by scoring every label name in one teacher-forced pass "
+                "instead of generating and parsing text."
+            )
+        },
+    )
+    prediction_cache: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Path of an sqlite file caching generated predictions by model, adapter and prompt weights, "
+                "generation arguments and input ids, so that repeated evaluations only generate for new inputs."
+            )
+        },
+    )
+    prediction_cache_size_mb: int = field(
+        default=1024,
+        metadata={"help": "Size of the prediction cache above which the least recently used entries are evicted."},
+    )
+    eval_token_budget: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "If set, evaluation and prediction features are not padded to `max_seq_length`, they are batched "
+                "by length so that a batch holds at most this many tokens and are padded per batch."
+            )
+        },
+    )
 
     def __post_init__(self):
         if (
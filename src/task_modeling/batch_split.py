@@ -0,0 +1,137 @@
+import numpy as np
+import torch
+from adapters import BatchSplit, Stack
+
+
+def get_split_setup(setups, batch_sizes):
+    """
+    Returns the adapter setup routing consecutive slices of `batch_sizes` rows to `setups`, tuples of adapter
+    names stacked in this order, e.g. `(language_adapter, task_adapter)`.
+
+    Every position of the stack is split on its own, an adapter shared by all rows there, e.g. the task adapter,
+    runs once on the whole batch. A split of stacks is not used, adapters does not compute it correctly for
+    bottleneck adapters.
+    """
+    if len({len(setup) for setup in setups}) != 1 or not setups[0]:
+        raise ValueError(f'All rows of a batch split need the same number of stacked adapters, got {setups}')
+
+    blocks = []
+    for adapter_names in zip(*setups):
+        names, sizes = [], []
+        for name, batch_size in zip(adapter_names, batch_sizes):
+            if names and names[-1] == name:
+                sizes[-1] += batch_size
+            else:
+                names.append(name)
+                sizes.append(batch_size)
+        blocks.append(names[0] if len(names) == 1 else BatchSplit(*names, batch_sizes=sizes))
+    return Stack(*blocks) if len(blocks) > 1 else blocks[0]
+
+
+class BatchSplitGenerator:
+    """
+    Generates for batches whose rows use different adapters, e.g. the language adapters of many test sets stacked
+    under one task adapter, in one forward pass with a `BatchSplit` setup.
+
+    The rows of a batch are grouped by their setup for the split and put back into their order afterwards.
+    Generation runs the encoder once per row and the decoder on `num_beams` copies of every row next to each
+    other, the split is scaled to the batch size of every encoder and decoder call. Invertible adapters apply the
+    first adapter of a setup to the whole batch and can only be shared by all rows.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.splits = []
+
+    def _scale_split(self, module, args, kwargs):
+        inputs = args[0] if args else kwargs.get('input_ids')
+        if inputs is None:
+            inputs = kwargs['inputs_embeds']
+        for split, batch_sizes in self.splits:
+            num_copies, remainder = divmod(inputs.shape[0], sum(batch_sizes))
+            if remainder:
+                raise ValueError(f'A batch of {inputs.shape[0]} rows can not be split into {batch_sizes}')
+            split.batch_sizes = [batch_size * num_copies for batch_size in batch_sizes]
+
+    def _check_setups(self, setups):
+        first_adapters = {setup[0] for setup in setups}
+        if len(first_adapters) < 2:
+            return
+        for module in self.model.modules():
+            invertible_adapters = first_adapters & set(getattr(module, 'invertible_adapters', None) or {})
+            if invertible_adapters:
+                raise ValueError(f'{sorted(invertible_adapters)} have invertible adapters, which can not be split')
+
+    @torch.no_grad()
+    def generate(self, inputs, setups, **gen_kwargs):
+        """
+        Generates for a batch of `inputs` with the adapter setup of every row in `setups`.
+        """
+        groups = list(dict.fromkeys(setups))
+        self._check_setups(groups)
+        order = np.argsort([groups.index(setup) for setup in setups], kind='stable')
+        batch_size = len(setups)
+        inputs = {
+            key: value[order] if isinstance(value, torch.Tensor) and value.shape[0] == batch_size else value
+            for key, value in inputs.items()
+        }
+
+        setup = get_split_setup(groups, [setups.count(setup) for setup in groups])
+        blocks = setup.children if isinstance(setup, Stack) else [setup]
+        self.splits = [(block, list(block.batch_sizes)) for block in blocks if isinstance(block, BatchSplit)]
+        previous_setup = self.model.active_adapters
+        hooks = [
+            stack.register_forward_pre_hook(self._scale_split, with_kwargs=True)
+            for stack in (self.model.get_encoder(), self.model.get_decoder())
+        ]
+        self.model.set_active_adapters(setup)
+        try:
+            outputs = self.model.generate(**inputs, **gen_kwargs)
+        finally:
+            for hook in hooks:
+                hook.remove()
+            self.model.set_active_adapters(previous_setup)
+            self.splits = []
+
+        # beams are already dropped, every row has num_return_sequences outputs
+        num_return_sequences = outputs.shape[0] // batch_size
+        restore = np.argsort(order)
+        return outputs.view(batch_size, num_return_sequences, -1)[restore].view(outputs.shape)
+
+    def predict(self, datasets, setups, tokenizer, batch_size, **gen_kwargs):
+        """
+        Generates for the features of several datasets, each with its own adapter setup, in shared batches.
+
+        Returns the generated tokens and the labels of every dataset, padded with the pad token and -100 like
+        the outputs of `Trainer.predict`.
+        """
+        row_setups = [setup for dataset, setup in zip(datasets, setups) for _ in range(len(dataset))]
+        features = [
+            {'input_ids': input_ids, 'attention_mask': attention_mask}
+            for dataset in datasets
+            for input_ids, attention_mask in zip(dataset['input_ids'], dataset['attention_mask'])
+        ]
+
+        device = next(self.model.parameters()).device
+        generated = []
+        for start in range(0, len(features), batch_size):
+            inputs = tokenizer.pad(features[start:start + batch_size], return_tensors='pt').to(device)
+            outputs = self.generate(dict(inputs), row_setups[start:start + batch_size], **gen_kwargs)
+            generated.extend(outputs.cpu().numpy())
+
+        results = []
+        start = 0
+        for dataset in datasets:
+            predictions = pad_rows(generated[start:start + len(dataset)], tokenizer.pad_token_id)
+            label_ids = pad_rows([np.asarray(labels) for labels in dataset['labels']], -100)
+            results.append((predictions, label_ids))
+            start += len(dataset)
+        return results
+
+
+def pad_rows(rows, pad_value):
+    width = max([len(row) for row in rows], default=0)
+    padded = np.full((len(rows), width), pad_value, dtype=np.int64)
+    for i, row in enumerate(rows):
+        padded[i, :len(row)] = row
+    return padded
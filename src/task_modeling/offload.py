@@ -0,0 +1,142 @@
+"""
+Disk-offloaded CPU inference of backbones larger than the memory, e.g. aya101.
+
+`load_offloaded_model` builds the model without weights, adds the adapter layers with `adapters.init` and loads the
+weights from the safetensors checkpoint. The word embeddings, the LM head and as many blocks as fit into
+`max_cpu_memory` are kept in memory. The remaining blocks are dispatched with accelerate hooks that read their weights
+memory-mapped from the checkpoint right before each forward and drop them afterwards, so at most one offloaded block
+is in memory at a time. Prompts and adapters are attached to the returned model as to any other model and stay in
+memory, the prompts are put in front of the word embeddings, which are never offloaded.
+"""
+import json
+import os
+import adapters
+import torch
+from accelerate import dispatch_model, infer_auto_device_map, init_empty_weights
+from accelerate.utils import compute_module_sizes, convert_file_size_to_int, set_module_tensor_to_device
+from collections import defaultdict
+from safetensors import safe_open
+from transformers import AutoModelForSeq2SeqLM
+from transformers.utils import SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME, cached_file
+from transformers.utils.hub import get_checkpoint_shard_files
+
+
+def get_weight_files(model_name_or_path, revision=None, token=None):
+    """
+    Returns the safetensors file of every weight of a local or Hub checkpoint, sharded or not.
+    """
+    kwargs = dict(revision=revision, token=token, _raise_exceptions_for_missing_entries=False)
+    index_file = cached_file(model_name_or_path, SAFE_WEIGHTS_INDEX_NAME, **kwargs)
+    if index_file is not None:
+        shard_files, _ = get_checkpoint_shard_files(model_name_or_path, index_file, revision=revision, token=token)
+        shard_files = {os.path.basename(shard_file): shard_file for shard_file in shard_files}
+        with open(index_file, 'r', encoding='utf-8') as f:
+            weight_map = json.load(f)['weight_map']
+        return {name: shard_files[file_name] for name, file_name in weight_map.items()}
+
+    weights_file = cached_file(model_name_or_path, SAFE_WEIGHTS_NAME, **kwargs)
+    if weights_file is None:
+        raise ValueError(f'Disk offloading needs a safetensors checkpoint, {model_name_or_path} has none')
+    with safe_open(weights_file, framework='pt') as f:
+        return {name: weights_file for name in f.keys()}
+
+
+def get_resident_modules(model):
+    """
+    Returns the names of the modules kept in memory, the word embeddings under all their names and the LM head.
+    """
+    resident = (model.get_input_embeddings(), model.get_output_embeddings())
+    return [name for name, module in model.named_modules(remove_duplicate=False) if any(module is m for m in resident)]
+
+
+def place_module(model, device_map, module_name, device):
+    """
+    Sets the device of `module_name` in `device_map`, splitting the entry of the module that contains it.
+    """
+    for name in list(device_map):
+        if name == module_name:
+            device_map[name] = device
+            return device_map
+        if name == '' or module_name.startswith(f'{name}.'):
+            parent_device = device_map.pop(name)
+            parent = model.get_submodule(name)
+            prefix = f'{name}.' if name else ''
+            for child_name, _ in parent.named_children():
+                device_map[prefix + child_name] = parent_device
+            for tensor_name, _ in parent.named_parameters(recurse=False):
+                device_map[prefix + tensor_name] = parent_device
+            return place_module(model, device_map, module_name, device)
+    device_map[module_name] = device
+    return device_map
+
+
+def get_offload_device_map(model, max_cpu_memory):
+    """
+    Keeps the resident modules and as many blocks as fit into the rest of `max_cpu_memory` on the CPU and puts the
+    remaining modules on the disk. accelerate keeps room for the largest layer within the budget, the offloaded
+    blocks are loaded into it.
+    """
+    resident_modules = get_resident_modules(model)
+    module_sizes = compute_module_sizes(model)
+    resident_size = sum(module_sizes[name] for name in resident_modules if name in module_sizes)
+    # the tied names of the word embeddings share one weight
+    resident_size -= sum(
+        module_sizes[name] for name in resident_modules[1:]
+        if model.get_submodule(name) is model.get_submodule(resident_modules[0]))
+    memory = max(convert_file_size_to_int(max_cpu_memory) - resident_size, 0)
+
+    device_map = infer_auto_device_map(
+        model, max_memory={'cpu': memory}, no_split_module_classes=model._no_split_modules)
+    for name in resident_modules:
+        device_map = place_module(model, device_map, name, 'cpu')
+    return device_map
+
+
+def get_module_device(device_map, name):
+    while name not in device_map:
+        name = name.rpartition('.')[0] if '.' in name else ''
+    return device_map[name]
+
+
+def load_offloaded_model(model_name_or_path, config, max_cpu_memory, dtype=torch.float32, revision=None,
+                         token=None):
+    """
+    Loads a seq2seq model with adapter support whose weights beyond `max_cpu_memory`, e.g. '8GB', stay on the disk.
+    """
+    weight_files = get_weight_files(model_name_or_path, revision=revision, token=token)
+    with init_empty_weights():
+        model = AutoModelForSeq2SeqLM.from_config(config, torch_dtype=dtype)
+        # the attention and feed-forward layers are wrapped for LoRA before they get their weights and hooks
+        adapters.init(model)
+    model.tie_weights()
+    device_map = get_offload_device_map(model, max_cpu_memory)
+
+    tensor_names = set(model.state_dict())
+    offload_index = {}
+    resident_weights = defaultdict(list)
+    for name, weights_file in weight_files.items():
+        if name not in tensor_names:
+            continue
+        if get_module_device(device_map, name) == 'disk':
+            offload_index[name] = {
+                'safetensors_file': weights_file, 'weight_name': name, 'dtype': str(dtype).split('.')[-1]}
+        else:
+            resident_weights[weights_file].append(name)
+    for weights_file, names in resident_weights.items():
+        with safe_open(weights_file, framework='pt') as f:
+            for name in names:
+                set_module_tensor_to_device(model, name, 'cpu', value=f.get_tensor(name), dtype=dtype)
+
+    missing = [
+        name for name, tensor in model.state_dict().items()
+        if tensor.device.type == 'meta' and name not in offload_index
+    ]
+    if missing:
+        raise ValueError(f'Weights missing in the checkpoint of {model_name_or_path}: {", ".join(missing)}')
+
+    dispatch_model(model, device_map=device_map, main_device='cpu', offload_index=offload_index)
+    return model.eval()
+
+
+def is_offloaded(model):
+    return 'disk' in (getattr(model, 'hf_device_map', None) or {}).values()
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import numpy as np
+import torch
+
+from prompt_tuning.prompt_tuning import PeftModel
+from task_modeling.utils import ADAPTER_MODULE_PATTERN
+
+
+def weights_digest(model):
+    """
+    Returns a digest of the adapter and prompt weights of a model, or of all weights of a model without any.
+
+    Buffers are weights too, e.g. the fixed rows of a `PartialPromptEmbedding`.
+    """
+    tensors = list(model.named_parameters()) + list(model.named_buffers())
+    tensors = [(name, tensor) for name, tensor in tensors if ADAPTER_MODULE_PATTERN.search(name)] or tensors
+
+    digest = hashlib.sha256()
+    for name, tensor in sorted(tensors, key=lambda item: item[0]):
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def get_prompt_configs(model):
+    """
+    Returns the active prompt and the size and fusion of every attached prompt of each nested prompt model.
+    """
+    configs = []
+    while isinstance(model, PeftModel):
+        configs.append({
+            'adapter_name': model.adapter_name,
+            'prompts': {
+                name: {'num_virtual_tokens': config.num_virtual_tokens, 'fusion': config.fusion}
+                for name, config in model._peft_config.items()
+            },
+        })
+        model = model.base_model
+    return configs
+
+
+def get_model_key(model, gen_kwargs):
+    """
+    Returns the part of the cache keys shared by all inputs of a run: the base model, the digest of the adapter and
+    prompt weights, the active adapter setup, the prompt routing and configs and the generation arguments.
+    """
+    base_model = model.get_transformer_model() if hasattr(model, 'get_transformer_model') else model
+    generation_config = base_model.generation_config.to_dict()
+    generation_config.pop('transformers_version', None)
+    key = {
+        'base_model': base_model.config._name_or_path,
+        'model_class': type(model).__name__,
+        # e.g. dynamically quantized linear layers, whose weights are not parameters
+        'module_types': sorted({f'{type(module).__module__}.{type(module).__name__}' for module in model.modules()}),
+        'weights': weights_digest(model),
+        'active_adapters': str(getattr(base_model, 'active_adapters', None)),
+        'prompt': getattr(model, 'adapter_name', None),
+        # the same prompt weights prepend 2 * num_virtual_tokens rows with `cat` fusion and num_virtual_tokens without
+        'prompt_configs': get_prompt_configs(model),
+        'generation_config': generation_config,
+        'gen_kwargs': gen_kwargs,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class PredictionCache:
+    """
+    On-disk cache of generated token ids, keyed by the model key of `get_model_key` and the input ids.
+
+    Entries are kept in a sqlite database, when it grows over `max_size_mb` the least recently used ones are
+    evicted. `hits` and `misses` count the lookups of this instance.
+    """
+
+    def __init__(self, path, max_size_mb=1024):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS predictions '
+            '(key TEXT PRIMARY KEY, token_ids BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+        self.connection.commit()
+
+    @staticmethod
+    def get_key(model_key, input_ids):
+        digest = hashlib.sha256(model_key.encode())
+        digest.update(np.asarray(input_ids, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    def get(self, keys):
+        """
+        Returns the cached token ids of every key, None for the misses.
+        """
+        found = {}
+        # sqlite limits the number of query parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.connection.execute(
+                f'SELECT key, token_ids FROM predictions WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+            found.update((key, np.frombuffer(token_ids, dtype=np.int64)) for key, token_ids in rows)
+
+        if found:
+            now = time.time()
+            self.connection.executemany(
+                'UPDATE predictions SET last_used = ? WHERE key = ?', [(now, key) for key in found])
+            self.connection.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return [found.get(key) for key in keys]
+
+    def put(self, keys, token_ids):
+        now = time.time()
+        rows = []
+        for key, ids in zip(keys, token_ids):
+            blob = np.asarray(ids, dtype=np.int64).tobytes()
+            rows.append((key, blob, len(blob), now))
+        self.connection.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)', rows)
+        self.evict()
+        self.connection.commit()
+
+    def evict(self):
+        size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM predictions').fetchone()[0]
+        if size <= self.max_size:
+            return
+        # the least recently used entries, until their sizes add up to the overflow
+        self.connection.execute(
+            'DELETE FROM predictions WHERE key IN (SELECT key FROM (SELECT key, size, SUM(size) OVER '
+            '(ORDER BY last_used, key) AS freed FROM predictions) WHERE freed - size < ?)',
+            (size - self.max_size,),
+        )
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
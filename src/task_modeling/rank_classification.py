@@ -0,0 +1,49 @@
+import torch
+
+from prompt_tuning.prompt_tuning import PromptTuningForSeq2SeqLM
+
+
+def tokenize_label_names(tokenizer, label_names):
+    """
+    Tokenizes the label names once, as the targets are tokenized for training.
+
+    Returns the `[num_labels, max_label_length]` label ids, padded with -100.
+    """
+    labels = tokenizer(text_target=list(label_names), padding=True, return_tensors='pt')
+    return labels['input_ids'].masked_fill(labels['attention_mask'] == 0, -100)
+
+
+def encode(model, input_ids, attention_mask):
+    if isinstance(model, PromptTuningForSeq2SeqLM):
+        return model.encode(input_ids=input_ids, attention_mask=attention_mask)
+    # the model's own helper also sets up the adapters forward context
+    model_kwargs = model._prepare_encoder_decoder_kwargs_for_generation(
+        input_ids, {'attention_mask': attention_mask}, 'input_ids')
+    return model_kwargs['encoder_outputs'], attention_mask
+
+
+@torch.no_grad()
+def score_label_names(model, input_ids, attention_mask, label_ids):
+    """
+    Returns the `[batch_size, num_labels]` log-likelihoods of every label name given every input.
+
+    The inputs are encoded once, then one teacher-forced decoder pass scores all `batch_size * num_labels`
+    pairs, no tokens are generated.
+    """
+    encoder_outputs, attention_mask = encode(model, input_ids, attention_mask)
+    batch_size, num_labels = input_ids.shape[0], label_ids.shape[0]
+
+    hidden_states = encoder_outputs.last_hidden_state.repeat_interleave(num_labels, dim=0)
+    attention_mask = attention_mask.repeat_interleave(num_labels, dim=0)
+    labels = label_ids.to(input_ids.device).repeat(batch_size, 1)
+
+    transformer = model.get_transformer_model() if isinstance(model, PromptTuningForSeq2SeqLM) else model
+    logits = transformer(
+        encoder_outputs=(hidden_states,),
+        attention_mask=attention_mask,
+        decoder_input_ids=transformer.prepare_decoder_input_ids_from_labels(labels=labels),
+    ).logits
+
+    log_probs = torch.log_softmax(logits.float(), dim=-1)
+    token_log_probs = log_probs.gather(-1, labels.clamp(min=0).unsqueeze(-1)).squeeze(-1)
+    return token_log_probs.masked_fill(labels == -100, 0).sum(-1).view(batch_size, num_labels)
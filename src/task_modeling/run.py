@@ -1,3 +1,4 @@
+import dataclasses
 import logging
 import os
 import sys
@@ -17,15 +18,20 @@ from transformers import (
 )
 from language_modeling.args import PromptTuningArguments
 from transformers.trainer_utils import EvalPrediction
+from task_modeling.adapter_weights import use_safetensors_weights
 from task_modeling.args import ModelArguments, DataTrainingArguments
-from task_modeling.utils import get_model, get_updated_model
+from task_modeling.prediction_cache import PredictionCache
+from task_modeling.utils import get_model, get_updated_model, quantize_dynamic
+from task_modeling.vocab_pruning import wrap_pruned_tokenizer
 from tasks import dataset_factory
+from utils import get_peak_rss_mb, get_rss_mb
 
 
 logger = logging.getLogger(__name__)
 
 
 def main():
+    use_safetensors_weights()
     parser = HfArgumentParser(
         (ModelArguments, DataTrainingArguments, Seq2SeqTrainingArguments, AdapterArguments, PromptTuningArguments))
     if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
@@ -61,11 +67,21 @@ def main():
         revision=model_args.model_revision,
         use_auth_token=True if model_args.use_auth_token else None,
     )
+    # the ids of a model with a pruned vocabulary are mapped by the tokenizer
+    tokenizer = wrap_pruned_tokenizer(tokenizer, config)
+
+    if model_args.quantize_dynamic and (training_args.do_train or training_args.device.type != "cpu"):
+        raise ValueError("Dynamic quantization is a CPU inference mode, use it with --use_cpu and without --do_train")
+    if model_args.max_cpu_memory is not None and (
+            training_args.do_train or training_args.device.type != "cpu" or model_args.quantize_dynamic):
+        raise ValueError(
+            "Disk offloading is a CPU inference mode, use it with --use_cpu, without --do_train and --quantize_dynamic")
 
     model = get_model(model_args, config)
-    device = torch.device(
-        "cuda" if torch.cuda.is_available() else "cpu")
-    model.to(device)
+    if model_args.max_cpu_memory is None:
+        device = torch.device(
+            "cuda" if torch.cuda.is_available() else "cpu")
+        model.to(device)
 
     # Convert the model into an adapter model
     if not model_args.full_finetuning:
@@ -114,10 +130,15 @@ def main():
         max_seq_length=max_seq_length
     )
 
+    # with a token budget the evaluation features are padded per batch by the data collator
+    validation_data_args = (
+        dataclasses.replace(data_args, pad_to_max_length=False)
+        if data_args.eval_token_budget is not None else data_args
+    )
     preprocess_validation_function = partial(
         dataset.preprocess_validation_function,
         tokenizer=tokenizer,
-        data_args=data_args,
+        data_args=validation_data_args,
         max_seq_length=max_seq_length
     )
 
@@ -205,10 +226,19 @@ def main():
     def compute_metrics(p: EvalPrediction):
         return metric.compute(predictions=p.predictions, references=p.label_ids)
 
-    post_processing_function = partial(
-        dataset.post_processing_function,
-        tokenizer=tokenizer,
-    )
+    if data_args.rank_classification:
+        if getattr(dataset, 'label_names', None) is None:
+            raise ValueError(
+                f"Rank classification needs a dataset with `label_names`, {data_args.dataset_name} has none")
+        post_processing_function = partial(
+            dataset.post_processing_rank_classification,
+            tokenizer=tokenizer,
+        )
+    else:
+        post_processing_function = partial(
+            dataset.post_processing_function,
+            tokenizer=tokenizer,
+        )
 
     # Setup adapters
     # if adapter_args.train_adapter:
@@ -218,6 +248,9 @@ def main():
         model = get_updated_model(
             model, model_args, adapter_args, prompt_args, data_args.dataset_name or "mlm")
 
+    if model_args.quantize_dynamic:
+        model = quantize_dynamic(model.to("cpu"))
+
     # Initialize our Trainer
     if adapter_args.train_adapter and model_args.load_language_prompt is not None:
         trainer_class = QuestionAnsweringSeq2SeqAdapterTrainerWithPrompt
@@ -230,6 +263,11 @@ def main():
 
     print(trainer_class)
 
+    prediction_cache = (
+        PredictionCache(data_args.prediction_cache, data_args.prediction_cache_size_mb)
+        if data_args.prediction_cache is not None else None
+    )
+
     trainer = trainer_class(
         model=model,
         args=training_args,
@@ -240,6 +278,9 @@ def main():
         data_collator=data_collator,
         compute_metrics=compute_metrics if training_args.predict_with_generate else None,
         post_process_function=post_processing_function,
+        eval_token_budget=data_args.eval_token_budget,
+        rank_classification_labels=dataset.label_names if data_args.rank_classification else None,
+        prediction_cache=prediction_cache,
     )
 
     # Training
@@ -274,6 +315,8 @@ def main():
         max_eval_samples = data_args.max_eval_samples if data_args.max_eval_samples is not None else len(
             eval_dataset)
         metrics["eval_samples"] = min(max_eval_samples, len(eval_dataset))
+        metrics["eval_rss_mb"] = get_rss_mb()
+        metrics["eval_peak_rss_mb"] = get_peak_rss_mb()
 
         trainer.log_metrics("eval", metrics)
         trainer.save_metrics("eval", metrics)
@@ -290,6 +333,8 @@ def main():
         )
         metrics["predict_samples"] = min(
             max_predict_samples, len(predict_dataset))
+        metrics["predict_rss_mb"] = get_rss_mb()
+        metrics["predict_peak_rss_mb"] = get_peak_rss_mb()
 
         trainer.log_metrics("predict", metrics)
         trainer.save_metrics("predict", metrics)
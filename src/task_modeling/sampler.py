@@ -0,0 +1,51 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Evaluation batches of features with similar lengths, each holding at most `token_budget` padded tokens.
+
+    Features are sorted by length, longest first, and cut into batches whose `batch_size * (max_length +
+    extra_tokens)` stays within the budget, so short features are no longer padded to the longest one in the
+    test set. `extra_tokens` counts the tokens the model adds to every row, e.g. the virtual tokens of a
+    prompt. `order` holds the feature indices in the order the batches yield them.
+    """
+
+    def __init__(self, lengths, token_budget, extra_tokens=0, max_batch_size=None):
+        lengths = np.asarray(lengths)
+        self.order = np.argsort(-lengths, kind='stable')
+
+        self.batches = []
+        batch = []
+        for index in self.order:
+            # the first feature of a batch is its longest one
+            row_tokens = (lengths[batch[0]] if batch else lengths[index]) + extra_tokens
+            if batch and ((len(batch) + 1) * row_tokens > token_budget or len(batch) == max_batch_size):
+                self.batches.append(batch)
+                batch = []
+            batch.append(int(index))
+        if batch:
+            self.batches.append(batch)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def restore_order(output, order):
+    """
+    Puts the predictions and labels of an evaluation loop output back into the order of the features.
+    """
+    def restore(array):
+        if array is None:
+            return None
+        if isinstance(array, tuple):
+            return tuple(restore(a) for a in array)
+        restored = np.empty_like(array)
+        restored[order] = array
+        return restored
+
+    return output._replace(predictions=restore(output.predictions), label_ids=restore(output.label_ids))
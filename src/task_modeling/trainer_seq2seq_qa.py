@@ -17,6 +17,7 @@ A subclass of `Trainer` specific to Question-Answering tasks
 """
 import math
 import time
+import numpy as np
 import safetensors
 import torch
 from torch import nn
@@ -26,7 +27,7 @@ from adapters.composition import AdapterCompositionBlock, Fuse
 import os
 
 
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset
 
 from adapters import AdapterTrainer
 from transformers import Seq2SeqTrainer
@@ -41,6 +42,10 @@ import logging
 
 from language_modeling.PromptSeq2SeqTrainer import SAFE_WEIGHTS_NAME, TRAINING_ARGS_NAME, WEIGHTS_NAME, PromptSeq2SeqTrainer, is_peft_available, unwrap_model
 from prompt_tuning.prompt_tuning import PeftModel
+from task_modeling.offload import is_offloaded
+from task_modeling.prediction_cache import PredictionCache, get_model_key
+from task_modeling.rank_classification import score_label_names, tokenize_label_names
+from task_modeling.sampler import TokenBudgetBatchSampler, restore_order
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -48,10 +53,137 @@ logging.basicConfig(level=logging.INFO)
 
 # , PromptSeq2SeqTrainer):
 class QuestionAnsweringSeq2SeqTrainer(Seq2SeqTrainer):
-    def __init__(self, *args, eval_examples=None, post_process_function=None, **kwargs):
+    def __init__(self, *args, eval_examples=None, post_process_function=None, eval_token_budget=None,
+                 rank_classification_labels=None, prediction_cache=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.eval_examples = eval_examples
         self.post_process_function = post_process_function
+        self.eval_token_budget = eval_token_budget
+        self.prediction_cache = prediction_cache
+        self._prediction_cache_model_key = None
+        # with label names, predictions are the indices of the most likely label instead of generated text
+        self.rank_classification_label_ids = (
+            tokenize_label_names(self.tokenizer, rank_classification_labels)
+            if rank_classification_labels is not None else None
+        )
+
+    def _move_model_to_device(self, model, device):
+        # the hooks of a model with offloaded weights load them onto the CPU, one block at a time
+        if is_offloaded(model):
+            return
+        super()._move_model_to_device(model, device)
+
+    def prediction_step(self, model, inputs, prediction_loss_only, ignore_keys=None, **gen_kwargs):
+        if prediction_loss_only:
+            return super().prediction_step(
+                model, inputs, prediction_loss_only, ignore_keys=ignore_keys, **gen_kwargs)
+
+        if self.rank_classification_label_ids is not None:
+            inputs = self._prepare_inputs(inputs)
+            scores = score_label_names(
+                model, inputs['input_ids'], inputs['attention_mask'], self.rank_classification_label_ids)
+            return None, scores.argmax(dim=-1), inputs.get('labels')
+
+        if self._prediction_cache_model_key is not None:
+            return self._cached_prediction_step(model, inputs, ignore_keys=ignore_keys, **gen_kwargs)
+        return super().prediction_step(model, inputs, prediction_loss_only, ignore_keys=ignore_keys, **gen_kwargs)
+
+    def _cached_prediction_step(self, model, inputs, ignore_keys=None, **gen_kwargs):
+        """
+        Generates only for the rows of a batch that are not in `prediction_cache` and stores them in it.
+
+        The loss is only computed on the generated rows, and is None for a batch of cache hits.
+        """
+        input_ids = inputs['input_ids'].cpu().numpy()
+        attention_mask = inputs['attention_mask'].cpu().numpy().astype(bool)
+        keys = [
+            PredictionCache.get_key(self._prediction_cache_model_key, row[mask])
+            for row, mask in zip(input_ids, attention_mask)
+        ]
+        predictions = self.prediction_cache.get(keys)
+        misses = [i for i, prediction in enumerate(predictions) if prediction is None]
+
+        loss = None
+        pad_token_id = self.model.config.pad_token_id
+        if misses:
+            batch_size = len(keys)
+            miss_inputs = {
+                key: value[misses] if isinstance(value, torch.Tensor) and value.shape[0] == batch_size else value
+                for key, value in inputs.items()
+            }
+            loss, generated_tokens, _ = super().prediction_step(
+                model, miss_inputs, False, ignore_keys=ignore_keys, **gen_kwargs)
+
+            generated = []
+            for row in generated_tokens.cpu().numpy():
+                # padding to the generation length is not stored
+                tokens = np.flatnonzero(row != pad_token_id)
+                generated.append(row[:tokens[-1] + 1] if len(tokens) else row[:0])
+            self.prediction_cache.put([keys[i] for i in misses], generated)
+            for i, row in zip(misses, generated):
+                predictions[i] = row
+
+        width = max(1, max(len(row) for row in predictions))
+        tokens = np.full((len(predictions), width), pad_token_id, dtype=np.int64)
+        for i, row in enumerate(predictions):
+            tokens[i, :len(row)] = row
+
+        labels = inputs.get('labels')
+        device = labels.device if labels is not None else self.args.device
+        return loss, torch.from_numpy(tokens).to(device), labels
+
+    def _start_prediction_cache(self):
+        """
+        Keys the prediction cache by the model and the generation arguments of this run.
+
+        Returns the hit and miss counts before the run.
+        """
+        if self.prediction_cache is None or not self.args.predict_with_generate:
+            self._prediction_cache_model_key = None
+            return None
+        self._prediction_cache_model_key = get_model_key(unwrap_model(self.model), self._gen_kwargs)
+        return self.prediction_cache.hits, self.prediction_cache.misses
+
+    def _prediction_cache_metrics(self, counts, metric_key_prefix):
+        self._prediction_cache_model_key = None
+        if counts is None:
+            return {}
+        hits = self.prediction_cache.hits - counts[0]
+        misses = self.prediction_cache.misses - counts[1]
+        logger.info(f"Prediction cache: {hits} hits, {misses} misses")
+        return {
+            f"{metric_key_prefix}_prediction_cache_hits": hits,
+            f"{metric_key_prefix}_prediction_cache_misses": misses,
+        }
+
+    def _get_dataloader_and_order(self, dataset, description):
+        """
+        Returns the evaluation dataloader and, with `eval_token_budget`, the order of the features in it.
+
+        With a token budget the features are batched by length (see `TokenBudgetBatchSampler`) and padded per
+        batch by the data collator, the outputs of the loop are put back into the feature order with
+        `restore_order` before post-processing.
+        """
+        if self.eval_token_budget is None:
+            if description == 'Evaluation':
+                return self.get_eval_dataloader(dataset), None
+            return self.get_test_dataloader(dataset), None
+
+        dataset = self._remove_unused_columns(dataset, description=description)
+        model = unwrap_model(self.model)
+        batch_sampler = TokenBudgetBatchSampler(
+            [len(input_ids) for input_ids in dataset['input_ids']],
+            self.eval_token_budget,
+            extra_tokens=model._get_num_virtual_tokens() if isinstance(model, PeftModel) else 0,
+        )
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(dataloader), batch_sampler.order
 
     # def evaluate(self, eval_dataset=None, eval_examples=None, ignore_keys=None, metric_key_prefix: str = "eval"):
     def evaluate(
@@ -74,13 +206,14 @@ class QuestionAnsweringSeq2SeqTrainer(Seq2SeqTrainer):
         self._gen_kwargs = gen_kwargs
 
         eval_dataset = self.eval_dataset if eval_dataset is None else eval_dataset
-        eval_dataloader = self.get_eval_dataloader(eval_dataset)
+        eval_dataloader, order = self._get_dataloader_and_order(eval_dataset, 'Evaluation')
         eval_examples = self.eval_examples if eval_examples is None else eval_examples
 
         # Temporarily disable metric computation, we will do it in the loop here.
         compute_metrics = self.compute_metrics
         self.compute_metrics = None
         start_time = time.time()
+        cache_counts = self._start_prediction_cache()
         eval_loop = self.prediction_loop if self.args.use_legacy_prediction_loop else self.evaluation_loop
         try:
             output = eval_loop(
@@ -94,6 +227,10 @@ class QuestionAnsweringSeq2SeqTrainer(Seq2SeqTrainer):
             )
         finally:
             self.compute_metrics = compute_metrics
+            cache_metrics = self._prediction_cache_metrics(cache_counts, metric_key_prefix)
+        if order is not None:
+            output = restore_order(output, order)
+        output.metrics.update(cache_metrics)
         total_batch_size = self.args.eval_batch_size * self.args.world_size
         if f"{metric_key_prefix}_jit_compilation_time" in output.metrics:
             start_time += output.metrics[f"{metric_key_prefix}_jit_compilation_time"]
@@ -138,12 +275,13 @@ class QuestionAnsweringSeq2SeqTrainer(Seq2SeqTrainer):
     ):
         self._gen_kwargs = gen_kwargs.copy()
 
-        predict_dataloader = self.get_test_dataloader(predict_dataset)
+        predict_dataloader, order = self._get_dataloader_and_order(predict_dataset, 'Prediction')
 
         # Temporarily disable metric computation, we will do it in the loop here.
         compute_metrics = self.compute_metrics
         self.compute_metrics = None
         start_time = time.time()
+        cache_counts = self._start_prediction_cache()
         eval_loop = self.prediction_loop if self.args.use_legacy_prediction_loop else self.evaluation_loop
         try:
             output = eval_loop(
@@ -157,6 +295,10 @@ class QuestionAnsweringSeq2SeqTrainer(Seq2SeqTrainer):
             )
         finally:
             self.compute_metrics = compute_metrics
+            cache_metrics = self._prediction_cache_metrics(cache_counts, metric_key_prefix)
+        if order is not None:
+            output = restore_order(output, order)
+        output.metrics.update(cache_metrics)
 
         total_batch_size = self.args.eval_batch_size * self.args.world_size
         if f"{metric_key_prefix}_jit_compilation_time" in output.metrics:
@@ -1,14 +1,29 @@
 from adapters import setup_adapter_training, AdapterConfig
 from transformers import AutoModelForSeq2SeqLM, AutoModelForQuestionAnswering, AutoModelForCausalLM
 import os
+import re
+import torch
+from torch import nn
 
 from prompt_tuning.config import PromptTuningConfig, TaskType
 from prompt_tuning.mapping import get_prompt_tuning_model
 from prompt_tuning.prompt_tuning import PromptTuningForSeq2SeqLM
+from task_modeling.offload import load_offloaded_model
 from utils import freeze_parameters, get_promptinit, unfreeze_parameters, download_model
 
+# modules of adapters, adapter fusion, prompts and prefixes, the rest of the model is the backbone
+ADAPTER_MODULE_PATTERN = re.compile(r'adapter|prompt|prefix|heads\.')
+
 
 def get_model(model_args, config, task=None):
+    if model_args.max_cpu_memory is not None:
+        return load_offloaded_model(
+            model_args.model_name_or_path,
+            config,
+            model_args.max_cpu_memory,
+            revision=model_args.model_revision,
+            token=True if model_args.use_auth_token else None,
+        )
 
     model = AutoModelForSeq2SeqLM.from_pretrained(
         model_args.model_name_or_path,
@@ -183,3 +198,28 @@ def get_updated_model(model, model_args, adapter_args, prompt_args, dataset_name
         return model
     else:
         raise ValueError("Invalid adapter configuration")
+
+
+def quantize_dynamic(model):
+    """
+    Replaces the linear layers of the backbone with dynamically quantized int8 ones for CPU inference.
+
+    Adapter and prompt modules are kept in float32. `adapters.init` wraps the attention and feed-forward layers in
+    LoRA layers, the ones without LoRA weights are turned back into plain linear layers to be quantized.
+    """
+    modules = dict(model.named_modules())
+    module_names = set()
+    for name, module in modules.items():
+        if not isinstance(module, nn.Linear) or ADAPTER_MODULE_PATTERN.search(name):
+            continue
+        if type(module) is not nn.Linear:
+            if getattr(module, 'loras', None):
+                continue
+            with torch.device('meta'):
+                linear = nn.Linear(module.in_features, module.out_features, bias=module.bias is not None)
+            linear.weight, linear.bias = module.weight, module.bias
+            parent_name, _, child_name = name.rpartition('.')
+            setattr(modules[parent_name] if parent_name else model, child_name, linear)
+        module_names.add(name)
+
+    return torch.ao.quantization.quantize_dynamic(model, module_names, dtype=torch.qint8, inplace=True)
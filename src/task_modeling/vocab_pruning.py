@@ -0,0 +1,175 @@
+"""
+Vocabulary pruning of mt0 for the languages of a deployment.
+
+`prune_vocabulary` keeps only the rows of the given token ids in the word embeddings and the LM head and stores the
+kept ids in the model config as `pruned_token_ids`. The kept ids are sorted and always contain the special tokens,
+so the pad, eos and unknown tokens of mt5 keep their ids. A pruned model is saved and loaded like any other model,
+its tokenizer is wrapped in `PrunedTokenizer` by `wrap_pruned_tokenizer`, which maps the ids of the full vocabulary
+to the kept rows and back.
+
+Greedy generation is the same as with the full model for every output made of kept tokens, the kept logits are
+unchanged and the argmax over them is the same. Beam search scores are normalized over the kept tokens only.
+"""
+import numpy as np
+import torch
+from torch import nn
+
+PRUNED_TOKEN_IDS = 'pruned_token_ids'
+
+
+def collect_token_ids(tokenizer, texts, batch_size=1000):
+    """
+    Returns the sorted ids of all tokens of `texts`.
+    """
+    token_ids = set()
+    batch = []
+    for text in texts:
+        batch.append(text)
+        if len(batch) == batch_size:
+            token_ids.update(np.unique(np.concatenate(tokenizer(batch)['input_ids'])).tolist())
+            batch = []
+    if batch:
+        token_ids.update(np.unique(np.concatenate(tokenizer(batch)['input_ids'])).tolist())
+    return sorted(token_ids)
+
+
+def get_pruned_token_ids(config):
+    return getattr(config, PRUNED_TOKEN_IDS, None)
+
+
+def prune_vocabulary(model, tokenizer, token_ids):
+    """
+    Keeps the rows of `token_ids` and of the special tokens of `tokenizer` in the word embeddings and the LM head of
+    a seq2seq model, in place.
+    """
+    if get_pruned_token_ids(model.config) is not None:
+        raise ValueError('The vocabulary of the model is already pruned, prune the full model instead')
+
+    token_ids = torch.tensor(sorted(set(token_ids) | set(tokenizer.all_special_ids)), dtype=torch.long)
+    input_embeddings = model.get_input_embeddings()
+    embeddings = nn.Embedding(
+        len(token_ids), input_embeddings.embedding_dim,
+        device=input_embeddings.weight.device, dtype=input_embeddings.weight.dtype)
+    embeddings.weight.data = input_embeddings.weight.data[token_ids.to(input_embeddings.weight.device)].clone()
+    model.set_input_embeddings(embeddings)
+
+    if model.config.tie_word_embeddings:
+        model.tie_weights()
+    else:
+        output_embeddings = model.get_output_embeddings()
+        lm_head = nn.Linear(
+            output_embeddings.in_features, len(token_ids), bias=output_embeddings.bias is not None,
+            device=output_embeddings.weight.device, dtype=output_embeddings.weight.dtype)
+        lm_head.weight.data = output_embeddings.weight.data[token_ids.to(output_embeddings.weight.device)].clone()
+        if output_embeddings.bias is not None:
+            lm_head.bias.data = output_embeddings.bias.data[token_ids.to(output_embeddings.bias.device)].clone()
+        model.set_output_embeddings(lm_head)
+
+    model.config.vocab_size = len(token_ids)
+    setattr(model.config, PRUNED_TOKEN_IDS, token_ids.tolist())
+    return model
+
+
+def wrap_pruned_tokenizer(tokenizer, config):
+    """
+    Returns the tokenizer of the full vocabulary wrapped for a model pruned by `prune_vocabulary`, or the tokenizer
+    itself for any other model.
+    """
+    token_ids = get_pruned_token_ids(config)
+    return PrunedTokenizer(tokenizer, token_ids) if token_ids is not None else tokenizer
+
+
+class _PrunedBackendTokenizer:
+    def __init__(self, pruned_tokenizer):
+        self.pruned_tokenizer = pruned_tokenizer
+
+    def decode_batch(self, sequences, **kwargs):
+        return self.pruned_tokenizer.tokenizer.backend_tokenizer.decode_batch(
+            [self.pruned_tokenizer.to_original_ids(sequence) for sequence in sequences], **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name == 'pruned_tokenizer':
+            raise AttributeError(name)
+        return getattr(self.pruned_tokenizer.tokenizer.backend_tokenizer, name)
+
+
+class PrunedTokenizer:
+    """
+    Tokenizer of a pruned model, wrapping the tokenizer of the full vocabulary.
+
+    Texts are tokenized exactly as by the wrapped tokenizer and the ids are mapped to the rows of the pruned model,
+    tokens without a row become the unknown token. Decoding maps the ids back. Special token ids, e.g.
+    `pad_token_id`, are mapped as well and everything else is passed through to the wrapped tokenizer.
+    """
+
+    def __init__(self, tokenizer, token_ids):
+        self.tokenizer = tokenizer
+        self.token_ids = np.asarray(token_ids, dtype=np.int64)
+        self.pruned_ids = np.full(max(len(tokenizer), self.token_ids[-1] + 1), -1, dtype=np.int64)
+        self.pruned_ids[self.token_ids] = np.arange(len(self.token_ids))
+        self.pruned_ids[self.pruned_ids < 0] = self.pruned_ids[tokenizer.unk_token_id]
+
+    @staticmethod
+    def _map(token_ids, table):
+        if isinstance(token_ids, torch.Tensor):
+            return torch.from_numpy(PrunedTokenizer._map(token_ids.cpu().numpy(), table)).to(token_ids.device)
+        if isinstance(token_ids, (int, np.integer)):
+            return int(table[token_ids]) if token_ids >= 0 else int(token_ids)
+        if isinstance(token_ids, np.ndarray) or (
+                len(token_ids) and isinstance(token_ids[0], (int, np.integer))):
+            array = np.asarray(token_ids, dtype=np.int64)
+            # negative ids, e.g. the -100 of ignored labels, are kept
+            mapped = np.where(array < 0, array, table[np.maximum(array, 0)])
+            return mapped if isinstance(token_ids, np.ndarray) else mapped.tolist()
+        return [PrunedTokenizer._map(ids, table) for ids in token_ids]
+
+    def to_pruned_ids(self, token_ids):
+        return self._map(token_ids, self.pruned_ids)
+
+    def to_original_ids(self, token_ids):
+        return self._map(token_ids, self.token_ids)
+
+    def __call__(self, *args, **kwargs):
+        encoding = self.tokenizer(*args, **kwargs)
+        for key in ('input_ids', 'labels'):
+            if key in encoding:
+                encoding[key] = self.to_pruned_ids(encoding[key])
+        return encoding
+
+    def encode(self, *args, **kwargs):
+        return self.to_pruned_ids(self.tokenizer.encode(*args, **kwargs))
+
+    def decode(self, token_ids, **kwargs):
+        return self.tokenizer.decode(self.to_original_ids(token_ids), **kwargs)
+
+    def batch_decode(self, sequences, **kwargs):
+        return self.tokenizer.batch_decode(self.to_original_ids(sequences), **kwargs)
+
+    def convert_ids_to_tokens(self, ids, **kwargs):
+        return self.tokenizer.convert_ids_to_tokens(self.to_original_ids(ids), **kwargs)
+
+    def convert_tokens_to_ids(self, tokens):
+        return self.to_pruned_ids(self.tokenizer.convert_tokens_to_ids(tokens))
+
+    def get_vocab(self):
+        kept = set(self.token_ids.tolist())
+        return {token: int(self.pruned_ids[i]) for token, i in self.tokenizer.get_vocab().items() if i in kept}
+
+    @property
+    def backend_tokenizer(self):
+        return _PrunedBackendTokenizer(self)
+
+    @property
+    def vocab_size(self):
+        return len(self.token_ids)
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('tokenizer', 'token_ids', 'pruned_ids'):
+            raise AttributeError(name)
+        value = getattr(self.tokenizer, name)
+        if value is not None and name.endswith(('_token_id', '_token_ids', 'special_ids')):
+            return self.to_pruned_ids(value)
+        return value
@@ -1,4 +1,7 @@
+import numpy as np
 from datasets import load_dataset
+from transformers.trainer_utils import EvalPrediction
+from tasks.utils import decode
 from typing import Any, Dict
 
 
@@ -111,6 +114,16 @@ class Dataset:
     def post_processing_function(self, examples, features, outputs, stage, tokenizer):
         raise NotImplementedError
 
+    def post_processing_rank_classification(self, examples, features, outputs, stage="eval", tokenizer=None):
+        """
+        Post-processing for rank classification, the predictions already are indices into `label_names`.
+        """
+        predictions = np.asarray(outputs.predictions).reshape(-1).tolist()
+
+        references = self.convert_label(decode(outputs.label_ids, tokenizer))
+
+        return EvalPrediction(predictions=predictions, label_ids=references)
+
     def get_columns(self, split: str):
         return self.dataset[self.splits[split]].column_names
 
@@ -2,12 +2,11 @@ from typing import Any, Dict
 from collections import namedtuple
 from metrics.metrics import span_f1
 from tasks.dataset import Dataset
-from tasks.utils import convert_language
+from tasks.utils import convert_language, decode, get_feature_per_example
 from datasets import load_dataset, DatasetDict
 from datasets import Dataset as HFDataset
 import datasets
 from transformers.trainer_utils import EvalLoopOutput, EvalPrediction
-import numpy as np
 import pandas as pd
 import json
 import evaluate
@@ -113,27 +112,16 @@ class MLQA(Dataset):
     def post_processing_function(
         self, examples: datasets.Dataset, features: datasets.Dataset, outputs: EvalLoopOutput, stage="eval", tokenizer: Any = None
     ):
-        preds = outputs.predictions
-        if isinstance(preds, tuple):
-            preds = preds[0]
+        decoded_preds = decode(outputs.predictions, tokenizer)
 
-        preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
-        decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True)
-
-        example_id_to_index = {k: i for i, k in enumerate(examples["id"])}
-        feature_per_example = {
-            example_id_to_index[feature["example_id"]]: i for i, feature in enumerate(features)}
-        predictions = {}
-        
-        for example_index, example in enumerate(examples):
-            feature_index = feature_per_example[example_index]
-            predictions[example["id"]] = decoded_preds[feature_index]
+        example_ids = examples["id"]
+        feature_per_example = get_feature_per_example(example_ids, features["example_id"])
+        predictions = dict(zip(example_ids, (decoded_preds[i] for i in feature_per_example)))
 
         formatted_predictions = [
             {"id": k, "prediction_text": v} for k, v in predictions.items()]
 
-        references = [{"id": ex["id"], "answers": ex['answers']}
-                      for ex in examples]
+        references = [{"id": k, "answers": answers} for k, answers in zip(example_ids, examples["answers"])]
         return EvalPrediction(predictions=formatted_predictions, label_ids=references)
 
     def get_metric(self):
@@ -534,27 +522,16 @@ class ArabicSQuAD(MLQA):
     def post_processing_function(
         self, examples: datasets.Dataset, features: datasets.Dataset, outputs: EvalLoopOutput, stage="eval", tokenizer: Any = None
     ):
-        preds = outputs.predictions
-        if isinstance(preds, tuple):
-            preds = preds[0]
-
-        preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
-        decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True)
-
-        example_id_to_index = {k: i for i, k in enumerate(examples["id"])}
-        feature_per_example = {
-            example_id_to_index[feature["example_id"]]: i for i, feature in enumerate(features)}
-        predictions = {}
+        decoded_preds = decode(outputs.predictions, tokenizer)
 
-        for example_index, example in enumerate(examples):
-            feature_index = feature_per_example[example_index]
-            predictions[example["id"]] = decoded_preds[feature_index]
+        example_ids = examples["id"]
+        feature_per_example = get_feature_per_example(example_ids, features["example_id"])
+        predictions = dict(zip(example_ids, (decoded_preds[i] for i in feature_per_example)))
 
         formatted_predictions = [
             {"id": k, "prediction_text": '--' if v == '' else v} for k, v in predictions.items()]
 
-        references = [{"id": ex["id"], "answers": ex['answers']}
-                      for ex in examples]
+        references = [{"id": k, "answers": answers} for k, answers in zip(example_ids, examples["answers"])]
         return EvalPrediction(predictions=formatted_predictions, label_ids=references)
 
     def get_metric(self):
@@ -609,26 +586,16 @@ class SberSQuAD(MLQA):
     def post_processing_function(
         self, examples: datasets.Dataset, features: datasets.Dataset, outputs: EvalLoopOutput, stage="eval", tokenizer: Any = None
     ):
-        preds = outputs.predictions
-        if isinstance(preds, tuple):
-            preds = preds[0]
-        preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
-        decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True)
+        decoded_preds = decode(outputs.predictions, tokenizer)
 
-        example_id_to_index = {k: i for i, k in enumerate(examples["id"])}
-        feature_per_example = {
-            example_id_to_index[feature["example_id"]]: i for i, feature in enumerate(features)}
-        predictions = {}
-
-        for example_index, example in enumerate(examples):
-            feature_index = feature_per_example[example_index]
-            predictions[example["id"]] = decoded_preds[feature_index]
+        example_ids = examples["id"]
+        feature_per_example = get_feature_per_example(example_ids, features["example_id"])
+        predictions = dict(zip(example_ids, (decoded_preds[i] for i in feature_per_example)))
 
         formatted_predictions = [
             {"id": k, "prediction_text": '--' if v == '' else v} for k, v in predictions.items()]
 
-        references = [{"id": ex["id"], "answers": ex['answers']}
-                      for ex in examples]
+        references = [{"id": k, "answers": answers} for k, answers in zip(example_ids, examples["answers"])]
         return EvalPrediction(predictions=formatted_predictions, label_ids=references)
 
     def get_metric(self):
@@ -725,27 +692,16 @@ class TeQuAD(MLQA):
     def post_processing_function(
         self, examples: datasets.Dataset, features: datasets.Dataset, outputs: EvalLoopOutput, stage="eval", tokenizer: Any = None
     ):
-        preds = outputs.predictions
-        if isinstance(preds, tuple):
-            preds = preds[0]
-            
-        preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
-        decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True)
-
-        example_id_to_index = {k: i for i, k in enumerate(examples["id"])}
-        feature_per_example = {
-            example_id_to_index[feature["example_id"]]: i for i, feature in enumerate(features)}
-        predictions = {}
+        decoded_preds = decode(outputs.predictions, tokenizer)
 
-        for example_index, example in enumerate(examples):
-            feature_index = feature_per_example[example_index]
-            predictions[example["id"]] = decoded_preds[feature_index]
+        example_ids = examples["id"]
+        feature_per_example = get_feature_per_example(example_ids, features["example_id"])
+        predictions = dict(zip(example_ids, (decoded_preds[i] for i in feature_per_example)))
 
         formatted_predictions = [
             {"id": k, "prediction_text": '--' if v == '' else v} for k, v in predictions.items()]
 
-        references = [{"id": ex["id"], "answers": ex['answers']}
-                      for ex in examples]
+        references = [{"id": k, "answers": answers} for k, answers in zip(example_ids, examples["answers"])]
         return EvalPrediction(predictions=formatted_predictions, label_ids=references)
 
     def get_metric(self):
@@ -798,17 +754,9 @@ class WikiANN(Dataset):
     def post_processing_function(
         self, examples: datasets.Dataset, features: datasets.Dataset, outputs: EvalLoopOutput, stage="eval", tokenizer: Any = None
     ):
-        preds = outputs.predictions
-        if isinstance(preds, tuple):
-            preds = preds[0]
-
-        preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
-        decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True)
+        decoded_preds = decode(outputs.predictions, tokenizer)
         
-        labels = outputs.label_ids
-                
-        labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
-        decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
+        decoded_labels = decode(outputs.label_ids, tokenizer)
 
         return EvalPrediction(predictions=decoded_preds, label_ids=decoded_labels)
     
@@ -945,19 +893,11 @@ class XNLI(Dataset):
     def post_processing_function(
         self, examples: datasets.Dataset, features: datasets.Dataset, outputs: EvalLoopOutput, stage="eval", tokenizer: Any = None
     ):
-        preds = outputs.predictions
-        if isinstance(preds, tuple):
-            preds = preds[0]
-
-        preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
-        decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True)
+        decoded_preds = decode(outputs.predictions, tokenizer)
         
         predictions = self.convert_label(decoded_preds)
         
-        labels = outputs.label_ids
-                
-        labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
-        decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
+        decoded_labels = decode(outputs.label_ids, tokenizer)
         
         references = self.convert_label(decoded_labels)
 
@@ -1055,18 +995,10 @@ class MultiClaimCheckWorthy(Dataset):
     def post_processing_function(
         self, examples: datasets.Dataset, features: datasets.Dataset, outputs: EvalLoopOutput, stage="eval", tokenizer: Any = None
     ):
-        preds = outputs.predictions
-        if isinstance(preds, tuple):
-            preds = preds[0]
-            
-        preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
-        decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True)
+        decoded_preds = decode(outputs.predictions, tokenizer)
         decoded_preds = self.convert_label(decoded_preds)
         
-        labels = outputs.label_ids
-                
-        labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
-        decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
+        decoded_labels = decode(outputs.label_ids, tokenizer)
         decoded_labels = self.convert_label(decoded_labels)
 
         return EvalPrediction(predictions=decoded_preds, label_ids=decoded_labels)
@@ -1126,18 +1058,11 @@ class FEVERNLI(Dataset):
     def post_processing_function(
         self, examples: datasets.Dataset, features: datasets.Dataset, outputs: EvalLoopOutput, stage="eval", tokenizer: Any = None
     ):
-        preds = outputs.predictions
-        if isinstance(preds, tuple):
-            preds = preds[0]
-        preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
-        decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True)
+        decoded_preds = decode(outputs.predictions, tokenizer)
         
         predictions = self.convert_label(decoded_preds)
         
-        labels = outputs.label_ids
-                
-        labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
-        decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
+        decoded_labels = decode(outputs.label_ids, tokenizer)
         
         references = self.convert_label(decoded_labels)
 
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def convert_language(language):
     if language == 'english':
         return 'en'
@@ -71,3 +74,45 @@ def convert_language(language):
         return 'ml'
     else:
         raise ValueError(f'Invalid language: {language}')
+
+
+def decode(token_ids, tokenizer):
+    """
+    Decodes generated or label token ids like `tokenizer.batch_decode(..., skip_special_tokens=True)`.
+
+    -100 and padding are dropped with one mask over the whole array, so every sequence is decoded at its real
+    length instead of the padded one. A fast tokenizer decodes all sequences in one call to its backend, which
+    splits them into chunks decoded in parallel.
+    """
+    if isinstance(token_ids, tuple):
+        token_ids = token_ids[0]
+    token_ids = np.asarray(token_ids)
+    if len(token_ids) == 0:
+        return []
+    mask = (token_ids != -100) & (token_ids != tokenizer.pad_token_id)
+    sequences = [
+        sequence.tolist() for sequence in np.split(token_ids[mask], np.cumsum(mask.sum(axis=1))[:-1])
+    ]
+
+    if not tokenizer.is_fast:
+        return tokenizer.batch_decode(sequences, skip_special_tokens=True)
+    texts = tokenizer.backend_tokenizer.decode_batch(sequences, skip_special_tokens=True)
+    if tokenizer.clean_up_tokenization_spaces:
+        texts = [tokenizer.clean_up_tokenization(text) for text in texts]
+    return texts
+
+
+def get_feature_per_example(example_ids, feature_example_ids):
+    """
+    Returns the index of the last feature of every example, matched by `id` and `example_id`.
+    """
+    example_ids = np.asarray(example_ids)
+    feature_example_ids = np.asarray(feature_example_ids)
+
+    # the first occurrence in the reversed features is the last one
+    unique_ids, reversed_indices = np.unique(feature_example_ids[::-1], return_index=True)
+    positions = np.searchsorted(unique_ids, example_ids).clip(max=len(unique_ids) - 1)
+    missing = unique_ids[positions] != example_ids
+    if missing.any():
+        raise KeyError(f'No feature for the examples {example_ids[missing][:10].tolist()}')
+    return len(feature_example_ids) - 1 - reversed_indices[positions]
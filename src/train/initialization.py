@@ -1,15 +1,32 @@
-from transformers import AutoTokenizer
+import json
+import logging
+import os
+from functools import lru_cache
+from transformers import AutoConfig, AutoTokenizer
+
+from task_modeling.vocab_pruning import wrap_pruned_tokenizer
+
+INIT_TOKEN_INDEX_NAME = 'init_token_index.json'
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer(tokenizer_name_or_path):
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name_or_path)
+    try:
+        config = AutoConfig.from_pretrained(tokenizer_name_or_path)
+    except (OSError, ValueError):
+        # a tokenizer without a model
+        return tokenizer
+    # init tokens of a pruned model are rows of its pruned word embeddings
+    return wrap_pruned_tokenizer(tokenizer, config)
 
 
 def init_tokens(tokenizer, size=5000):
-    vocab = tokenizer.get_vocab()
-    vocab = {k: v for k, v in sorted(vocab.items(), key=lambda item: item[1])}
-    for k in list(vocab.keys()):
-        if k in tokenizer.all_special_tokens:
-            del vocab[k]
+    special_tokens = set(tokenizer.all_special_tokens)
+    vocab = sorted((v, k) for k, v in tokenizer.get_vocab().items())
 
     # get token indexes
-    token_indexes = list(vocab.values())
+    token_indexes = [v for v, k in vocab if k not in special_tokens]
     token_indexes = token_indexes[:size]
     return token_indexes
 
@@ -17,6 +34,83 @@ def init_tokens(tokenizer, size=5000):
 def class_initialization(tokenizer, classes):
     token_indexes = []
     for class_ in classes:
-        token_indexes.append(*tokenizer.encode(class_)['input_ids'])
+        token_indexes.extend(tokenizer.encode(class_, add_special_tokens=False))
 
     return token_indexes
+
+
+def _to_ranges(token_indexes):
+    ranges = []
+    for index in token_indexes:
+        if ranges and ranges[-1][1] == index:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return ranges
+
+
+class InitTokenIndex:
+    """
+    Token ids used to initialize prompts, computed once per tokenizer.
+
+    Holds the sorted non-special token ids (as ranges) for SAMPLED init and the encoded init texts and class
+    labels for TEXT and CLASS init. The index is stored as json next to a local tokenizer, or under
+    `../cache/tokenizers/` for a Hub tokenizer, and the tokenizer is only loaded for entries that are missing.
+    """
+
+    def __init__(self, tokenizer_name_or_path):
+        self.tokenizer_name_or_path = tokenizer_name_or_path
+        if os.path.isdir(tokenizer_name_or_path):
+            self.path = os.path.join(tokenizer_name_or_path, INIT_TOKEN_INDEX_NAME)
+        else:
+            self.path = f'../cache/tokenizers/{tokenizer_name_or_path}/{INIT_TOKEN_INDEX_NAME}'
+
+        self.index = {'token_ranges': None, 'texts': {}, 'classes': {}}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.index.update(json.load(f))
+
+    @property
+    def tokenizer(self):
+        return load_tokenizer(self.tokenizer_name_or_path)
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.index, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f'Could not save the init token index to {self.path}: {e}')
+
+    def sample(self, size):
+        if self.index['token_ranges'] is None:
+            self.index['token_ranges'] = _to_ranges(init_tokens(self.tokenizer, size=None))
+            self._save()
+
+        token_indexes = []
+        for start, end in self.index['token_ranges']:
+            token_indexes.extend(range(start, min(end, start + size - len(token_indexes))))
+            if len(token_indexes) >= size:
+                break
+        return token_indexes
+
+    def encode(self, text):
+        if text not in self.index['texts']:
+            self.index['texts'][text] = self.tokenizer(text)['input_ids']
+            self._save()
+        return self.index['texts'][text]
+
+    def encode_classes(self, classes):
+        missing = [class_ for class_ in classes if class_ not in self.index['classes']]
+        if missing:
+            for class_ in missing:
+                self.index['classes'][class_] = class_initialization(self.tokenizer, [class_])
+            self._save()
+        return [index for class_ in classes for index in self.index['classes'][class_]]
+
+
+@lru_cache(maxsize=None)
+def get_init_token_index(tokenizer_name_or_path):
+    return InitTokenIndex(tokenizer_name_or_path)
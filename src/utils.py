@@ -1,4 +1,7 @@
 import os
+import resource
+from huggingface_hub import hf_hub_download
+from huggingface_hub.utils import EntryNotFoundError
 from prompt_tuning.config import PromptTuningInit
 
 
@@ -49,23 +52,47 @@ def download_model(model_name, type='adapter'):
         return f'../cache/models/{model_name}'
 
     os.makedirs(f'../cache/models/{model_name}', exist_ok=True)
+    # alternatives are tried in order, safetensors weights are preferred over pickled ones
     if type == 'adapter':
         files = [
-            'adapter_config.json',
-            'head_config.json',
-            'pytorch_adapter.bin',
-            'pytorch_model_head.bin',
+            ['adapter_config.json'],
+            ['head_config.json'],
+            # adapters resolves local adapters by the .bin file, so it is fetched next to the safetensors file
+            ['pytorch_adapter.safetensors'],
+            ['pytorch_adapter.bin'],
+            ['pytorch_model_head.safetensors'],
+            ['pytorch_model_head.bin'],
         ]
     elif type == 'prompt':
         files = [
-            'adapter_config.json',
-            'adapter_model.bin',
+            ['adapter_config.json'],
+            ['adapter_model.safetensors', 'adapter_model.bin'],
         ]
 
-    for file in files:
-        output_path = f'../cache/models/{model_name}/{file}'
-        os.system(
-            f'curl -Ls -o {output_path} https://huggingface.co/{model_name}/resolve/main/{file}?download=true'
-        )
+    for alternatives in files:
+        for file in alternatives:
+            try:
+                hf_hub_download(model_name, file, local_dir=f'../cache/models/{model_name}',
+                                local_dir_use_symlinks=False)
+                break
+            except EntryNotFoundError:
+                continue
 
     return f'../cache/models/{model_name}'
+
+
+def get_rss_mb():
+    """
+    Returns the resident memory of this process in MiB, read from /proc on Linux.
+    """
+    with open('/proc/self/statm', 'r') as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def get_peak_rss_mb():
+    """
+    Returns the peak resident memory of this process in MiB.
+    """
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10